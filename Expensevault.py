@@ -1,16 +1,36 @@
 import sys
+import os
 import csv
-from datetime import datetime
+import json
+import uuid
+import math
+import re
+import bisect
+import hashlib
+import difflib
+import zlib
+import struct
+import sqlite3
+import threading
+from contextlib import nullcontext
+from datetime import datetime, timedelta, date as date_type
+from decimal import Decimal, ROUND_HALF_UP
+from array import array
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QPushButton, QLabel, QLineEdit, QTableWidget, QTableWidgetItem,
-    QMessageBox, QInputDialog, QDateEdit, QComboBox, QDialog
+    QMessageBox, QInputDialog, QDateEdit, QComboBox, QDialog, QFileDialog,
+    QStyledItemDelegate, QHeaderView, QAbstractItemView, QDoubleSpinBox, QSpinBox,
+    QCheckBox, QFormLayout, QDialogButtonBox, QListView, QCompleter
+)
+from PyQt6.QtCore import (
+    Qt, QDate, QTimer, QEvent, QAbstractListModel, QModelIndex, QSortFilterProxyModel, QStringListModel
 )
-from PyQt6.QtCore import Qt, QDate
 # Remove QtCharts import
 # from PyQt6.QtCharts import QChart, QChartView, QPieSeries
 import mysql.connector
-from PyQt6.QtGui import QFont, QColor
+import numpy as np
+from PyQt6.QtGui import QFont, QColor, QShortcut, QKeySequence
 
 # Add matplotlib imports
 import matplotlib
@@ -31,16 +51,501 @@ DB_CONFIG = {
     "database": "expensevault"
 }
 
+# Expense archival configuration
+"""
+Expenses dated before the start of the month `archive_after_months` months ago are moved
+from the live `expenses` table into `expenses_archive` by archive_old_expenses(), which runs
+on every startup. Reads only touch the archive when the requested date range reaches back
+past the archive boundary. Set `archive_after_months` to None to disable archival.
+
+`partition_by` can be set to "month" or "year" to range-partition the live expenses table by
+date. MySQL does not allow foreign keys on partitioned tables, so enabling it drops the
+foreign keys on `expenses`; category removal deletes expenses explicitly for that reason.
+"""
+ARCHIVE_CONFIG = {
+    "archive_after_months": 24,
+    "archive_batch_size": 5000,
+    "partition_by": None
+}
+
+# Tables owned by the application. Any other table in the database is treated as a
+# category that was mistakenly created as a table (see initialize_database/clean_database).
+APP_TABLES = [
+    'users', 'categories', 'expenses', 'category_limits', 'expenses_archive', 'app_settings',
+    'change_log', 'category_closure', 'tags', 'expense_tags', 'payees', 'category_rules'
+]
+
+# Data created before multi-user support is assigned to this user
+DEFAULT_USERNAME = "default"
+
+# Offline write queue configuration
+"""
+When MySQL cannot be reached, add/update/delete operations on expenses are appended to
+an fsync'd journal file instead of being lost. A background worker retries every
+`drain_interval` seconds and replays the journal in transactions of `batch_size`
+operations. Operations the database rejects (e.g. the category was removed meanwhile)
+are moved to `rejected_path` for inspection.
+"""
+OFFLINE_QUEUE_CONFIG = {
+    "path": os.path.join(os.path.expanduser("~"), ".expensevault", "offline_queue.jsonl"),
+    "rejected_path": os.path.join(os.path.expanduser("~"), ".expensevault", "offline_rejected.jsonl"),
+    "drain_interval": 15,
+    "batch_size": 200
+}
+
+# Local read replica configuration
+"""
+When enabled, categories, expenses and limits are copied into a local SQLite file and the
+windows read from it instead of MySQL, so they open instantly and keep working offline.
+The copy is refreshed incrementally from the change log by the background sync worker
+every `OFFLINE_QUEUE_CONFIG["drain_interval"]` seconds and right after every write.
+"""
+REPLICA_CONFIG = {
+    "enabled": True,
+    "path": os.path.join(os.path.expanduser("~"), ".expensevault", "replica.sqlite3"),
+    "fetch_size": 10000
+}
+
+# In-memory cumulative daily spending per category (see SpendingIndex)
+SPENDING_INDEX_CONFIG = {
+    "enabled": True,
+    "persist": True,
+    "directory": os.path.join(os.path.expanduser("~"), ".expensevault")
+}
+
+# Budget forecasts learn from this many days of history; the daily rate is an
+# exponentially weighted average with the given half-life, and weekday/day-of-month
+# factors are shrunk towards 1 as if `shrinkage` extra average days were observed
+FORECAST_CONFIG = {
+    "history_days": 365,
+    "half_life_days": 14,
+    "shrinkage": 4
+}
+
+# An expense is flagged when its log amount is more than `z_threshold` standard
+# deviations above its category's mean, when it is over `tail_multiple` times the
+# category's `quantile` estimate, or when its category already has unusually many
+# expenses that day.
+# Statistics need `min_history` expenses (or active days) before they are trusted.
+ANOMALY_CONFIG = {
+    "z_threshold": 3.0,
+    "quantile": 0.99,
+    "tail_multiple": 1.5,
+    "frequency_z": 3.0,
+    "min_daily_count": 3,
+    "min_history": 10
+}
+
+# The category picker hands rows to its list view `batch_size` at a time and
+# lists the `recent_count` most recently used categories first
+CATEGORY_PICKER_CONFIG = {
+    "batch_size": 200,
+    "recent_count": 5
+}
+
+# Tag queries for users served by the local replica are answered from in-memory
+# tag bitmaps (see TagIndex); otherwise they are run as SQL
+TAG_INDEX_CONFIG = {
+    "enabled": True
+}
+
+# Payee entry suggests up to `suggestions` payees whose name (or a word of it)
+# starts with what was typed, most used first; when none do, names at least
+# `fuzzy_cutoff` similar to it are offered instead (see PayeePrefixIndex)
+PAYEE_INDEX_CONFIG = {
+    "suggestions": 8,
+    "fuzzy_cutoff": 0.6
+}
+
+# Bank statement import (see read_statement_csv): date formats tried in order,
+# the CSV headers read as each field, how many distinct descriptions the rule
+# matcher remembers its matches for, and how many rows go in each transaction
+IMPORT_CONFIG = {
+    "date_formats": ["%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y", "%d-%m-%Y", "%d.%m.%Y", "%d %b %Y"],
+    "columns": {
+        "date": ("date", "transaction date", "posted date", "posting date", "value date"),
+        "amount": ("amount", "debit", "withdrawal", "withdrawals"),
+        "description": ("description", "details", "narration", "memo", "particulars", "transaction"),
+        "payee": ("payee", "merchant", "counterparty", "name"),
+        "category": ("category",),
+    },
+    "match_cache_size": 100000,
+    "batch_size": 5000
+}
+
+# Expenses with the same category, amount, payee and reference are duplicates
+# when on the same date and near-duplicates when up to `near_days` apart (a card
+# payment is often posted a day or two after it was made)
+DUPLICATE_CONFIG = {
+    "near_days": 3
+}
+
+# Removed categories are purged in batches of this many expenses per transaction
+PURGE_CONFIG = {
+    "batch_size": 5000,
+    "interval": 60
+}
+
+# Read replica routing configuration
+"""
+Read-only queries can be sent to MySQL replicas of the DB_CONFIG server, so charts,
+exports and limit scans don't compete with writes on the primary. Each entry of
+`replicas` holds the DB_CONFIG keys that differ for that server (usually host and
+port). Reads go to the replicas in turn. A replica that is more than `max_lag_seconds`
+behind its source (checked at most every `lag_check_interval` seconds) is skipped until
+its next check, one that can't be reached is skipped for `retry_after` seconds, and
+reads fall back to the primary when no replica is usable. For `read_your_writes_seconds`
+after a user's write their reads stay on the primary so they see what they just saved;
+keep it above `max_lag_seconds`. Set `max_lag_seconds` to None to skip the lag check,
+e.g. when testing against a second server that isn't replicating.
+"""
+READ_ROUTING_CONFIG = {
+    "replicas": [],
+    "max_lag_seconds": 5,
+    "lag_check_interval": 10,
+    "read_your_writes_seconds": 10,
+    "retry_after": 30
+}
+
+# Last known database availability, updated by get_db_connection
+_db_state = {"available": True, "last_error": None}
+
+# Read routing state: next replica to try, (checked_at, lag) and down-until time per
+# replica index, and the last primary write per user (None for writes affecting everyone)
+_read_routing = {"next": 0, "lag": {}, "down_until": {}, "writes": {}}
+_read_routing_lock = threading.Lock()
+
+# --- Money ---
+
+class Money:
+    """An amount of money held as a whole number of cents.
+    
+    Amounts are parsed once (from user input, DECIMAL columns or the change log),
+    rounding half up, and are then added, compared and formatted exactly, so no
+    float rounding creeps into totals or limit checks. Arithmetic and comparisons
+    also accept plain numbers, read as currency units rounded to the cent
+    (`amount <= 0` works).
+    Values go to MySQL as to_decimal() and to SQLite and NumPy as cents.
+    """
+    __slots__ = ("cents",)
+    _NUMBERS = (int, float, Decimal, np.integer, np.floating)
+    
+    def __init__(self, cents=0):
+        if isinstance(cents, bool) or not isinstance(cents, (int, np.integer)):
+            raise TypeError(f"Money takes whole cents, not {type(cents).__name__}")
+        self.cents = int(cents)
+    
+    @classmethod
+    def of(cls, amount):
+        """Parse an amount in currency units (Money, str, int, Decimal or float).
+        
+        Raises:
+            ValueError: If the amount is not a finite number.
+        """
+        if isinstance(amount, Money):
+            return amount
+        try:
+            value = cls._decimal(amount)
+        except (ArithmeticError, TypeError, ValueError):
+            raise ValueError(f"'{amount}' is not a valid amount")
+        if not value.is_finite():
+            raise ValueError(f"'{amount}' is not a valid amount")
+        return cls(int((value * 100).to_integral_value(ROUND_HALF_UP)))
+    
+    def to_decimal(self):
+        return Decimal(self.cents).scaleb(-2)
+    
+    @staticmethod
+    def _decimal(number):
+        """A number as a Decimal; floats go through their shortest repr, so 0.1 is 0.1."""
+        if isinstance(number, (float, np.floating)):
+            return Decimal(repr(float(number)))
+        if isinstance(number, np.integer):
+            return Decimal(int(number))
+        return Decimal(number.strip() if isinstance(number, str) else number)
+    
+    @classmethod
+    def _is_number(cls, value):
+        return isinstance(value, cls._NUMBERS) and not isinstance(value, bool)
+    
+    @classmethod
+    def _cents_of(cls, other):
+        """Cents of a Money or plain number, or None for anything else."""
+        if isinstance(other, Money):
+            return other.cents
+        return cls.of(other).cents if cls._is_number(other) else None
+    
+    def __add__(self, other):
+        cents = self._cents_of(other)
+        return NotImplemented if cents is None else Money(self.cents + cents)
+    
+    __radd__ = __add__
+    
+    def __sub__(self, other):
+        cents = self._cents_of(other)
+        return NotImplemented if cents is None else Money(self.cents - cents)
+    
+    def __rsub__(self, other):
+        cents = self._cents_of(other)
+        return NotImplemented if cents is None else Money(cents - self.cents)
+    
+    def __mul__(self, factor):
+        if not self._is_number(factor):
+            return NotImplemented
+        scaled = Decimal(self.cents) * self._decimal(factor)
+        return Money(int(scaled.to_integral_value(ROUND_HALF_UP)))
+    
+    __rmul__ = __mul__
+    
+    def __truediv__(self, other):
+        """Money / Money is a plain ratio; Money / number is Money, rounded half up."""
+        if isinstance(other, Money):
+            return self.cents / other.cents
+        if not self._is_number(other):
+            return NotImplemented
+        scaled = Decimal(self.cents) / self._decimal(other)
+        return Money(int(scaled.to_integral_value(ROUND_HALF_UP)))
+    
+    def __neg__(self):
+        return Money(-self.cents)
+    
+    def __pos__(self):
+        return self
+    
+    def __abs__(self):
+        return Money(abs(self.cents))
+    
+    def __bool__(self):
+        return self.cents != 0
+    
+    def __float__(self):
+        return self.cents / 100
+    
+    def _compare(self, other, op):
+        cents = self._cents_of(other)
+        return NotImplemented if cents is None else op(self.cents, cents)
+    
+    def __eq__(self, other):
+        return self._compare(other, int.__eq__)
+    
+    def __lt__(self, other):
+        return self._compare(other, int.__lt__)
+    
+    def __le__(self, other):
+        return self._compare(other, int.__le__)
+    
+    def __gt__(self, other):
+        return self._compare(other, int.__gt__)
+    
+    def __ge__(self, other):
+        return self._compare(other, int.__ge__)
+    
+    def __hash__(self):
+        return hash(self.to_decimal())
+    
+    def __str__(self):
+        sign = "-" if self.cents < 0 else ""
+        units, cents = divmod(abs(self.cents), 100)
+        return f"{sign}{units}.{cents:02d}"
+    
+    def __repr__(self):
+        return f"Money('{self}')"
+    
+    def __format__(self, spec):
+        """Format like a Decimal, so f"{amount:,.2f}" is exact."""
+        return format(self.to_decimal(), spec) if spec else str(self)
+
+def _to_cents(amount):
+    """Convert an amount (Money, Decimal, float, int or str) to integer cents, rounding half up."""
+    return Money.of(amount).cents
+
+def _from_cents(cents):
+    """Wrap integer cents (int or NumPy integer) as Money."""
+    return Money(int(cents))
+
+# --- Records ---
+
+class _Record:
+    """Base of the records the data functions return.
+    
+    Subclasses declare their fields as __slots__ (listed in _fields), so rows
+    carry no per-instance dict and fields are read as attributes.
+    """
+    __slots__ = ()
+    _fields = ()
+    
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self._fields)
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        values = ", ".join(f"{field}={getattr(self, field)!r}" for field in self._fields)
+        return f"{type(self).__name__}({values})"
+
+class Expense(_Record):
+    """An expense: id, category_id, amount (Money) and date."""
+    __slots__ = _fields = ("id", "category_id", "amount", "date")
+    
+    def __init__(self, id, category_id, amount, date):
+        self.id = id
+        self.category_id = category_id
+        self.amount = amount
+        self.date = date
+
+class Category(_Record):
+    """A category with its limit settings.
+    
+    limit is Money or None if unset; period is one of BUDGET_PERIODS, with
+    rolling_days the window length of a 'rolling' period.
+    """
+    __slots__ = _fields = ("id", "name", "limit", "period", "rolling_days", "carry_over")
+    
+    def __init__(self, id, name, limit=None, period="monthly", rolling_days=None, carry_over=False):
+        self.id = id
+        self.name = name
+        self.limit = limit
+        self.period = period
+        self.rolling_days = rolling_days
+        self.carry_over = carry_over
+
+class CategoryBudgetStatus(Category):
+    """A category's budget for its current period.
+    
+    Adds period_start and period_end, spent, carried (unspent budget from the
+    previous period) and available (limit plus carried, None without a limit).
+    forecast and exceed_date are filled in by forecast_budgets; ancestors (the
+    statuses of parent categories with a limit) and anomalies by the add functions.
+    """
+    __slots__ = ("period_start", "period_end", "spent", "carried", "available",
+                 "forecast", "exceed_date", "ancestors", "anomalies")
+    _fields = Category._fields + __slots__
+    
+    def __init__(self, category, period_start, period_end, spent, carried, available):
+        super().__init__(category.id, category.name, category.limit, category.period,
+                         category.rolling_days, category.carry_over)
+        self.period_start = period_start
+        self.period_end = period_end
+        self.spent = spent
+        self.carried = carried
+        self.available = available
+        self.forecast = None
+        self.exceed_date = None
+        self.ancestors = []
+        self.anomalies = []
+    
+    @property
+    def exceeded(self):
+        return self.available is not None and self.spent > self.available
+
 # --- Database Setup and Connection Functions ---
 
-def get_db_connection():
-    """Establish a connection to the database."""
+def get_db_connection(quiet=False):
+    """Establish a connection to the database.
+    
+    An error dialog is shown only when the database goes from reachable to
+    unreachable, and never when quiet is set or outside the GUI thread.
+    """
     try:
         conn = mysql.connector.connect(**DB_CONFIG)
+        _db_state["available"] = True
+        _db_state["last_error"] = None
+        return conn
+    except mysql.connector.Error as e:
+        was_available = _db_state["available"]
+        _db_state["available"] = False
+        _db_state["last_error"] = str(e)
+        print(f"Failed to connect to database: {e}")
+        if was_available and not quiet and threading.current_thread() is threading.main_thread():
+            QMessageBox.critical(None, "Database Error", f"Failed to connect: {e}")
+        return None
+
+def is_database_available():
+    """Return whether the last connection attempt succeeded."""
+    return _db_state["available"]
+
+# --- Read Routing ---
+
+def get_read_connection(user_id=None, quiet=False):
+    """Establish a connection for read-only queries on a user's data.
+    
+    Connects to the next usable replica in READ_ROUTING_CONFIG, or to the primary
+    (see get_db_connection) when no replica is configured or usable, or when the
+    user wrote within the read-your-writes window.
+    """
+    replicas = READ_ROUTING_CONFIG.get("replicas") or []
+    now = datetime.now()
+    with _read_routing_lock:
+        if not replicas or _reads_from_primary(user_id, now):
+            order = []
+        else:
+            start = _read_routing["next"] % len(replicas)
+            _read_routing["next"] = start + 1
+            order = [
+                index for index in list(range(start, len(replicas))) + list(range(start))
+                if _read_routing["down_until"].get(index, now) <= now
+            ]
+    for index in order:
+        conn = _connect_replica(index, replicas[index], now)
+        if conn:
+            return conn
+    return get_db_connection(quiet)
+
+def _note_primary_write(user_id=None):
+    """Keep a user's reads on the primary for a while after a write (None: every user)."""
+    with _read_routing_lock:
+        _read_routing["writes"][user_id] = datetime.now()
+
+def _reads_from_primary(user_id, now):
+    """Whether the user (or everyone) wrote within the read-your-writes window."""
+    window = timedelta(seconds=READ_ROUTING_CONFIG.get("read_your_writes_seconds") or 0)
+    writes = _read_routing["writes"]
+    return any(key in writes and now - writes[key] < window for key in {None, user_id})
+
+def _connect_replica(index, settings, now):
+    """Connect to a replica, or return None if it is unreachable or lagging too far behind."""
+    name = f"{settings.get('host', DB_CONFIG['host'])}:{settings.get('port', DB_CONFIG.get('port', 3306))}"
+    max_lag = READ_ROUTING_CONFIG.get("max_lag_seconds")
+    checked_at, lag = _read_routing["lag"].get(index, (None, None))
+    fresh = checked_at is not None and (now - checked_at).total_seconds() < READ_ROUTING_CONFIG.get("lag_check_interval", 10)
+    if max_lag is not None and fresh and (lag is None or lag > max_lag):
+        return None
+    try:
+        conn = mysql.connector.connect(**{**DB_CONFIG, **settings})
+    except mysql.connector.Error as e:
+        print(f"Read replica {name} unavailable: {e}")
+        with _read_routing_lock:
+            _read_routing["down_until"][index] = now + timedelta(seconds=READ_ROUTING_CONFIG.get("retry_after", 30))
+        return None
+    if max_lag is None or fresh:
         return conn
+    try:
+        lag = _replica_lag(conn)
     except mysql.connector.Error as e:
-        QMessageBox.critical(None, "Database Error", f"Failed to connect: {e}")
+        print(f"Could not check lag of read replica {name}: {e}")
+        lag = None
+    with _read_routing_lock:
+        _read_routing["lag"][index] = (now, lag)
+    if lag is None or lag > max_lag:
+        print(f"Skipping read replica {name}: " + ("not replicating" if lag is None else f"{lag}s behind"))
+        conn.close()
         return None
+    return conn
+
+def _replica_lag(conn):
+    """Seconds a server is behind its source, or None if it isn't replicating."""
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("SHOW REPLICA STATUS")
+    except mysql.connector.Error:
+        cursor.execute("SHOW SLAVE STATUS")  # MySQL before 8.0.22
+    rows = cursor.fetchall()
+    lags = [row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master")) for row in rows]
+    if not lags or None in lags:
+        return None
+    return max(lags)
 
 def ensure_database():
     """Create the database if it doesn't exist."""
@@ -59,6 +564,29 @@ def ensure_database():
         if 'conn' in locals():
             conn.close()
 
+def _ensure_user_column(cursor, table, default_user_id):
+    """Add a user_id column to a table created before multi-user support.
+    
+    Existing rows are assigned to the default user; the column default is dropped
+    afterwards so new rows must always name their user.
+    """
+    cursor.execute(f"SHOW COLUMNS FROM {table} LIKE 'user_id'")
+    if cursor.fetchone():
+        return False
+    print(f"Adding user_id column to {table} table")
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN user_id INT NOT NULL DEFAULT {int(default_user_id)} AFTER id")
+    cursor.execute(f"ALTER TABLE {table} ALTER COLUMN user_id DROP DEFAULT")
+    return True
+
+def _ensure_index(cursor, table, index_name, definition):
+    """Add an index to a table unless an index with that name already exists."""
+    cursor.execute(f"SHOW INDEX FROM {table} WHERE Key_name = %s", (index_name,))
+    if cursor.fetchall():
+        return False
+    print(f"Adding index {index_name} to {table} table")
+    cursor.execute(f"ALTER TABLE {table} ADD {definition}")
+    return True
+
 def initialize_database():
     """Initialize tables for categories and expenses, adding missing columns if necessary."""
     print("\n--- INITIALIZING DATABASE TABLES ---")
@@ -75,20 +603,77 @@ def initialize_database():
         tables = [row[0] for row in cursor.fetchall()]
         print(f"Found tables: {tables}")
         
+        # Create users table and make sure the default user exists
+        print("Creating users table if it doesn't exist")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                username VARCHAR(64) UNIQUE NOT NULL,
+                change_seq BIGINT NOT NULL DEFAULT 0
+            )
+        """)
+        cursor.execute("SHOW COLUMNS FROM users LIKE 'change_seq'")
+        if not cursor.fetchone():
+            print("Adding change_seq column to users table")
+            cursor.execute("ALTER TABLE users ADD COLUMN change_seq BIGINT NOT NULL DEFAULT 0")
+        cursor.execute("INSERT IGNORE INTO users (username) VALUES (%s)", (DEFAULT_USERNAME,))
+        cursor.execute("SELECT id FROM users WHERE username = %s", (DEFAULT_USERNAME,))
+        default_user_id = cursor.fetchone()[0]
+        
         # Create categories table if it doesn't exist
         print("Creating categories table if it doesn't exist")
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS categories (
                 id INT AUTO_INCREMENT PRIMARY KEY,
-                name VARCHAR(255) UNIQUE NOT NULL
+                user_id INT NOT NULL,
+                name VARCHAR(255) NOT NULL,
+                parent_id INT NULL,
+                deleted_at TIMESTAMP NULL DEFAULT NULL,
+                active_name VARCHAR(255) GENERATED ALWAYS AS (IF(deleted_at IS NULL, name, NULL)) VIRTUAL,
+                UNIQUE KEY uq_categories_user_active_name (user_id, active_name),
+                INDEX idx_categories_user_parent (user_id, parent_id),
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+                FOREIGN KEY (parent_id) REFERENCES categories(id) ON DELETE SET NULL
             )
         """)
         
+        # Removed categories are hidden (deleted_at set) until their expenses are
+        # purged in the background; names only need to be unique among live ones
+        if _ensure_user_column(cursor, "categories", default_user_id):
+            cursor.execute("ALTER TABLE categories ADD FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE")
+        cursor.execute("SHOW COLUMNS FROM categories LIKE 'deleted_at'")
+        if not cursor.fetchone():
+            print("Adding deleted_at and active_name columns to categories table")
+            cursor.execute("""
+                ALTER TABLE categories
+                    ADD COLUMN deleted_at TIMESTAMP NULL DEFAULT NULL,
+                    ADD COLUMN active_name VARCHAR(255)
+                        GENERATED ALWAYS AS (IF(deleted_at IS NULL, name, NULL)) VIRTUAL
+            """)
+        _ensure_index(cursor, "categories", "uq_categories_user_active_name",
+                      "UNIQUE KEY uq_categories_user_active_name (user_id, active_name)")
+        # Categories form a tree per user (NULL parent for top-level categories)
+        cursor.execute("SHOW COLUMNS FROM categories LIKE 'parent_id'")
+        if not cursor.fetchone():
+            print("Adding parent_id column to categories table")
+            cursor.execute("""
+                ALTER TABLE categories
+                    ADD COLUMN parent_id INT NULL,
+                    ADD FOREIGN KEY (parent_id) REFERENCES categories(id) ON DELETE SET NULL
+            """)
+        _ensure_index(cursor, "categories", "idx_categories_user_parent",
+                      "INDEX idx_categories_user_parent (user_id, parent_id)")
+        # Category names used to be globally unique, then unique per user
+        cursor.execute("SHOW INDEX FROM categories WHERE Column_name = 'name' AND Non_unique = 0")
+        for index in {row[2] for row in cursor.fetchall()}:
+            print(f"Dropping unique index {index} on category names")
+            cursor.execute(f"ALTER TABLE categories DROP INDEX `{index}`")
+        
         # Check if there are tables that should be categories
         potential_categories = []
         for table in tables:
             # Skip our main tables
-            if table not in ['categories', 'expenses', 'category_limits']:
+            if table not in APP_TABLES:
                 potential_categories.append(table)
                 
         if potential_categories:
@@ -96,13 +681,19 @@ def initialize_database():
             
             # First, check if these categories already exist in the categories table
             for cat_name in potential_categories:
-                cursor.execute("SELECT COUNT(*) FROM categories WHERE name = %s", (cat_name,))
+                cursor.execute(
+                    "SELECT COUNT(*) FROM categories WHERE user_id = %s AND name = %s",
+                    (default_user_id, cat_name)
+                )
                 count = cursor.fetchone()[0]
                 
                 if count == 0:
                     print(f"Adding '{cat_name}' to categories table")
                     try:
-                        cursor.execute("INSERT INTO categories (name) VALUES (%s)", (cat_name,))
+                        cursor.execute(
+                            "INSERT INTO categories (user_id, name) VALUES (%s, %s)",
+                            (default_user_id, cat_name)
+                        )
                     except mysql.connector.Error as e:
                         print(f"Error adding '{cat_name}' to categories: {e}")
             
@@ -115,6 +706,7 @@ def initialize_database():
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS expenses (
                 id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
                 category_id INT NOT NULL,
                 amount DECIMAL(10,2) NOT NULL,
                 date DATE NOT NULL,
@@ -127,12 +719,27 @@ def initialize_database():
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS category_limits (
                 id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
                 category_id INT NOT NULL,
                 limit_amount DECIMAL(10,2) NOT NULL,
+                period VARCHAR(16) NOT NULL DEFAULT 'monthly',
+                rolling_days INT NULL,
+                carry_over TINYINT(1) NOT NULL DEFAULT 0,
                 FOREIGN KEY (category_id) REFERENCES categories(id) ON DELETE CASCADE
             )
         """)
         
+        # Budget period settings for limits created before periods existed
+        for column, definition in (
+            ("period", "VARCHAR(16) NOT NULL DEFAULT 'monthly'"),
+            ("rolling_days", "INT NULL"),
+            ("carry_over", "TINYINT(1) NOT NULL DEFAULT 0"),
+        ):
+            cursor.execute(f"SHOW COLUMNS FROM category_limits LIKE '{column}'")
+            if not cursor.fetchone():
+                print(f"Adding {column} column to category_limits table")
+                cursor.execute(f"ALTER TABLE category_limits ADD COLUMN {column} {definition}")
+        
         # Check and add category_id column to expenses if missing
         cursor.execute("SHOW COLUMNS FROM expenses LIKE 'category_id'")
         if not cursor.fetchone():
@@ -143,6 +750,176 @@ def initialize_database():
                 ADD FOREIGN KEY (category_id) REFERENCES categories(id) ON DELETE CASCADE
             """)
         
+        # Scope expenses and limits to users. Categories belong to exactly one user,
+        # so per-category indexes are already per-user; cross-category queries use
+        # indexes that lead with user_id.
+        _ensure_user_column(cursor, "expenses", default_user_id)
+        _ensure_user_column(cursor, "category_limits", default_user_id)
+        _ensure_index(cursor, "expenses", "idx_expenses_category_date",
+                      "INDEX idx_expenses_category_date (category_id, date)")
+        _ensure_index(cursor, "expenses", "idx_expenses_user_date",
+                      "INDEX idx_expenses_user_date (user_id, date, category_id)")
+        _ensure_index(cursor, "expenses", "idx_expenses_date", "INDEX idx_expenses_date (date)")
+        
+        # Idempotency keys let replays of the offline write queue skip rows that were
+        # already inserted. The date is part of the key so it stays valid when the
+        # table is partitioned by date (replays always carry the same date).
+        cursor.execute("SHOW COLUMNS FROM expenses LIKE 'idempotency_key'")
+        if not cursor.fetchone():
+            print("Adding idempotency_key column to expenses table")
+            cursor.execute("ALTER TABLE expenses ADD COLUMN idempotency_key CHAR(36) NULL")
+        _ensure_index(cursor, "expenses", "uq_expenses_idempotency",
+                      "UNIQUE KEY uq_expenses_idempotency (user_id, idempotency_key, date)")
+        _ensure_index(cursor, "category_limits", "idx_limits_user_category",
+                      "INDEX idx_limits_user_category (user_id, category_id)")
+        
+        # Create expenses_archive table for expenses past the archive horizon
+        print("Creating expenses_archive table if it doesn't exist")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS expenses_archive (
+                id INT PRIMARY KEY,
+                user_id INT NOT NULL,
+                category_id INT NOT NULL,
+                amount DECIMAL(10,2) NOT NULL,
+                date DATE NOT NULL,
+                INDEX idx_archive_category_date (category_id, date),
+                INDEX idx_archive_user_date (user_id, date, category_id),
+                INDEX idx_archive_date (date),
+                FOREIGN KEY (category_id) REFERENCES categories(id) ON DELETE CASCADE
+            ) ROW_FORMAT=COMPRESSED
+        """)
+        _ensure_user_column(cursor, "expenses_archive", default_user_id)
+        _ensure_index(cursor, "expenses_archive", "idx_archive_user_date",
+                      "INDEX idx_archive_user_date (user_id, date, category_id)")
+        
+        # Create change_log table: an append-only, per-user sequence of data changes
+        print("Creating change_log table if it doesn't exist")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS change_log (
+                user_id INT NOT NULL,
+                seq BIGINT NOT NULL,
+                entity VARCHAR(32) NOT NULL,
+                entity_id INT NOT NULL,
+                operation VARCHAR(16) NOT NULL,
+                payload JSON NULL,
+                changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, seq),
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+        """)
+        
+        # Create category_closure table: one row per (ancestor, descendant) pair of the
+        # category tree, including each category paired with itself at depth 0, so
+        # subtree queries are a single join instead of a recursive walk
+        print("Creating category_closure table if it doesn't exist")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS category_closure (
+                ancestor_id INT NOT NULL,
+                descendant_id INT NOT NULL,
+                depth INT NOT NULL,
+                PRIMARY KEY (ancestor_id, descendant_id),
+                INDEX idx_closure_descendant (descendant_id, depth),
+                FOREIGN KEY (ancestor_id) REFERENCES categories(id) ON DELETE CASCADE,
+                FOREIGN KEY (descendant_id) REFERENCES categories(id) ON DELETE CASCADE
+            )
+        """)
+        # Categories created before the tree existed are top-level
+        cursor.execute("""
+            INSERT IGNORE INTO category_closure (ancestor_id, descendant_id, depth)
+            SELECT id, id, 0 FROM categories
+        """)
+        
+        # Create tags and expense_tags tables: any number of per-user tags on each
+        # expense. expense_tags has no foreign key to expenses because an expense
+        # may live in either expenses or expenses_archive (and the live table may
+        # be partitioned); expense deletes remove their tag rows explicitly.
+        print("Creating tags and expense_tags tables if they don't exist")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS tags (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
+                name VARCHAR(64) NOT NULL,
+                UNIQUE KEY uq_tags_user_name (user_id, name),
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS expense_tags (
+                tag_id INT NOT NULL,
+                expense_id INT NOT NULL,
+                PRIMARY KEY (tag_id, expense_id),
+                INDEX idx_expense_tags_expense (expense_id),
+                FOREIGN KEY (tag_id) REFERENCES tags(id) ON DELETE CASCADE
+            )
+        """)
+        
+        # Create payees table: the merchant an expense was paid to. Names are
+        # matched on their normalized form (see _normalize_payee) so "STARBUCKS"
+        # and "Starbucks " are one payee; the first spelling seen is displayed.
+        print("Creating payees table if it doesn't exist")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS payees (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
+                name VARCHAR(128) NOT NULL,
+                normalized_name VARCHAR(128) NOT NULL,
+                UNIQUE KEY uq_payees_user_normalized (user_id, normalized_name),
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+        """)
+        # Per-payee totals and trends group on (user_id, payee_id) over a date
+        # range; the index covers those queries without touching the rows
+        for table, index_name in (("expenses", "idx_expenses_user_payee"),
+                                  ("expenses_archive", "idx_archive_user_payee")):
+            cursor.execute(f"SHOW COLUMNS FROM {table} LIKE 'payee_id'")
+            if not cursor.fetchone():
+                print(f"Adding payee_id column to {table} table")
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN payee_id INT NULL")
+            _ensure_index(cursor, table, index_name,
+                          f"INDEX {index_name} (user_id, payee_id, date, amount)")
+        
+        # Content fingerprints (see _expense_fingerprint) make duplicate checks an
+        # index probe on (user_id, fingerprint, date). reference holds the
+        # normalized statement description of imported expenses.
+        for table, index_name in (("expenses", "idx_expenses_user_fingerprint"),
+                                  ("expenses_archive", "idx_archive_user_fingerprint")):
+            cursor.execute(f"SHOW COLUMNS FROM {table} LIKE 'fingerprint'")
+            if not cursor.fetchone():
+                print(f"Adding fingerprint and reference columns to {table} table")
+                cursor.execute(
+                    f"ALTER TABLE {table} ADD COLUMN reference VARCHAR(255) NULL, ADD COLUMN fingerprint BIGINT NULL"
+                )
+                cursor.execute(f"UPDATE {table} SET fingerprint = {_FINGERPRINT_SQL}")
+            _ensure_index(cursor, table, index_name, f"INDEX {index_name} (user_id, fingerprint, date)")
+        
+        # Create category_rules table: how imported statement rows are assigned to
+        # categories, tried in priority order (see CategoryRuleMatcher)
+        print("Creating category_rules table if it doesn't exist")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS category_rules (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
+                category_id INT NOT NULL,
+                kind VARCHAR(16) NOT NULL,
+                pattern VARCHAR(255) NOT NULL DEFAULT '',
+                min_amount DECIMAL(10,2) NULL,
+                max_amount DECIMAL(10,2) NULL,
+                priority INT NOT NULL,
+                INDEX idx_rules_user_priority (user_id, priority),
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+                FOREIGN KEY (category_id) REFERENCES categories(id) ON DELETE CASCADE
+            )
+        """)
+        
+        # Create app_settings table for small pieces of application state
+        print("Creating app_settings table if it doesn't exist")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS app_settings (
+                name VARCHAR(64) PRIMARY KEY,
+                value VARCHAR(255) NOT NULL
+            )
+        """)
+        
         conn.commit()
         print("Database tables initialized successfully")
     except mysql.connector.Error as e:
@@ -167,7 +944,7 @@ def clean_database():
         tables = [row[0] for row in cursor.fetchall()]
         
         # Filter out our main tables
-        potential_categories = [t for t in tables if t not in ['categories', 'expenses', 'category_limits']]
+        potential_categories = [t for t in tables if t not in APP_TABLES]
         
         if not potential_categories:
             print("No tables to clean up")
@@ -195,87 +972,781 @@ def clean_database():
         conn.close()
         print("--- DATABASE CLEANING COMPLETE ---\n")
 
-def setup_database():
-    """Set up the database and tables."""
-    print("\n=== SETTING UP DATABASE ===")
-    ensure_database()
-    initialize_database()
-    clean_database()
-    print("=== DATABASE SETUP COMPLETE ===\n")
+def _month_start(year, month, offset=0):
+    """Return the first day of the month `offset` months away from year/month as YYYY-MM-DD."""
+    year, month = divmod(year * 12 + (month - 1) + offset, 12)
+    return f"{year:04d}-{month + 1:02d}-01"
 
-# --- Database Functions ---
+def _partition_bounds(first_date, last_date, granularity):
+    """List (partition_name, less_than_date) pairs covering first_date..last_date."""
+    bounds = []
+    if granularity == "year":
+        for year in range(first_date.year, last_date.year + 1):
+            bounds.append((f"p{year}", f"{year + 1}-01-01"))
+    else:
+        month = first_date.year * 12 + first_date.month - 1
+        last_month = last_date.year * 12 + last_date.month - 1
+        while month <= last_month:
+            year, mon = divmod(month, 12)
+            bounds.append((f"p{year:04d}{mon + 1:02d}", _month_start(year, mon + 1, 1)))
+            month += 1
+    return bounds
 
-def get_categories():
-    """Retrieve all category names."""
-    print("\n--- FETCHING CATEGORIES FROM DATABASE ---")
+def ensure_expense_partitions(granularity=None):
+    """Range-partition the expenses table by date and keep future partitions available.
+    
+    The first call converts the table (dropping its foreign keys, which MySQL does not
+    support on partitioned tables, and widening the primary key to include the date).
+    Later calls split the catch-all partition so the next period always has its own.
+    """
+    granularity = granularity or ARCHIVE_CONFIG.get("partition_by")
+    if granularity not in ("month", "year"):
+        return False
+    print(f"\n--- ENSURING EXPENSE PARTITIONS ({granularity}) ---")
     conn = get_db_connection()
     if not conn:
-        print("Error: Database connection failed in get_categories()")
-        return []
+        print("Error: Database connection failed in ensure_expense_partitions()")
+        return False
     try:
         cursor = conn.cursor()
-        # First check if the categories table exists
-        cursor.execute("SHOW TABLES LIKE 'categories'")
-        if not cursor.fetchone():
-            print("Error: 'categories' table doesn't exist!")
-            return []
+        today = datetime.now().date()
+        if granularity == "year":
+            horizon = datetime(today.year + 1, 1, 1).date()
+        else:
+            horizon = datetime.strptime(_month_start(today.year, today.month, 1), "%Y-%m-%d").date()
+        
+        cursor.execute("""
+            SELECT PARTITION_NAME, PARTITION_DESCRIPTION
+            FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'expenses'
+              AND PARTITION_NAME IS NOT NULL
+            ORDER BY PARTITION_ORDINAL_POSITION
+        """)
+        partitions = cursor.fetchall()
+        
+        if not partitions:
+            cursor.execute("""
+                SELECT CONSTRAINT_NAME FROM information_schema.TABLE_CONSTRAINTS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'expenses'
+                  AND CONSTRAINT_TYPE = 'FOREIGN KEY'
+            """)
+            for (constraint,) in cursor.fetchall():
+                print(f"Dropping foreign key {constraint} (not supported on partitioned tables)")
+                cursor.execute(f"ALTER TABLE expenses DROP FOREIGN KEY `{constraint}`")
+            cursor.execute("ALTER TABLE expenses DROP PRIMARY KEY, ADD PRIMARY KEY (id, date)")
             
-        print("Executing query: SELECT name FROM categories ORDER BY name")
-        cursor.execute("SELECT name FROM categories ORDER BY name")
-        categories = [row[0] for row in cursor.fetchall()]
-        print(f"Found {len(categories)} categories: {categories}")
-        return categories
+            cursor.execute("SELECT MIN(date) FROM expenses")
+            first_date = cursor.fetchone()[0] or today
+            bounds = _partition_bounds(first_date, horizon, granularity)
+            definitions = ", ".join(
+                f"PARTITION {name} VALUES LESS THAN ('{less_than}')" for name, less_than in bounds
+            )
+            print(f"Partitioning expenses into {len(bounds)} partitions")
+            cursor.execute(
+                f"ALTER TABLE expenses PARTITION BY RANGE COLUMNS(date) "
+                f"({definitions}, PARTITION pmax VALUES LESS THAN (MAXVALUE))"
+            )
+        else:
+            existing = {name for name, _ in partitions}
+            last_bound = max(
+                (desc.strip("'") for name, desc in partitions if name != "pmax"),
+                default=None
+            )
+            start = datetime.strptime(last_bound, "%Y-%m-%d").date() if last_bound else today
+            missing = [b for b in _partition_bounds(start, horizon, granularity) if b[0] not in existing]
+            if missing:
+                definitions = ", ".join(
+                    f"PARTITION {name} VALUES LESS THAN ('{less_than}')" for name, less_than in missing
+                )
+                print(f"Adding {len(missing)} partitions to expenses")
+                cursor.execute(
+                    f"ALTER TABLE expenses REORGANIZE PARTITION pmax INTO "
+                    f"({definitions}, PARTITION pmax VALUES LESS THAN (MAXVALUE))"
+                )
+        conn.commit()
+        return True
     except mysql.connector.Error as e:
-        print(f"Database error in get_categories: {e}")
-        return []
-    except Exception as e:
-        print(f"Unexpected error in get_categories: {e}")
-        return []
+        print(f"Error partitioning expenses: {e}")
+        return False
     finally:
         conn.close()
-        print("--- CATEGORY FETCH COMPLETE ---\n")
+        print("--- EXPENSE PARTITIONS COMPLETE ---\n")
+
+def _get_archive_boundary(cursor):
+    """Return the archive boundary date (YYYY-MM-DD) or None if nothing was ever archived.
+    
+    Every expense dated before the boundary may live in expenses_archive; everything on
+    or after it is guaranteed to be in the live expenses table.
+    """
+    cursor.execute("SELECT value FROM app_settings WHERE name = 'archive_boundary'")
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+def _expense_source(cursor, start_date=None):
+    """Return the FROM clause source for reading expenses from start_date onwards.
+    
+    The archive is only included when the requested range reaches back past the
+    archive boundary, so current-period queries never touch it.
+    """
+    boundary = _get_archive_boundary(cursor)
+    if boundary and (not start_date or str(start_date) < boundary):
+        return """(
+            SELECT id, user_id, category_id, amount, date, payee_id FROM expenses
+            UNION ALL
+            SELECT id, user_id, category_id, amount, date, payee_id FROM expenses_archive
+        )"""
+    return "expenses"
 
-def add_category(name):
-    """Add a new category."""
+# Columns moved between expenses and expenses_archive
+ARCHIVED_COLUMNS = "id, user_id, category_id, amount, date, payee_id, reference, fingerprint"
+
+def archive_old_expenses(archive_after_months=None):
+    """Move expenses older than the archive horizon into expenses_archive.
+    
+    Rows are moved in batches of ARCHIVE_CONFIG['archive_batch_size'], each batch in its
+    own transaction, so the live table is never locked for long.
+    
+    Returns:
+        int: Number of expenses archived.
+    """
+    if archive_after_months is None:
+        archive_after_months = ARCHIVE_CONFIG.get("archive_after_months")
+    if not archive_after_months:
+        return 0
+    
+    today = datetime.now()
+    cutoff = _month_start(today.year, today.month, -archive_after_months)
+    batch_size = ARCHIVE_CONFIG.get("archive_batch_size", 5000)
+    print(f"\n--- ARCHIVING EXPENSES BEFORE {cutoff} ---")
+    
     conn = get_db_connection()
     if not conn:
-        return False, "Database connection failed"
+        print("Error: Database connection failed in archive_old_expenses()")
+        return 0
+    moved = 0
     try:
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO categories (name) VALUES (%s)", (name,))
+        boundary = _get_archive_boundary(cursor)
+        if boundary and boundary >= cutoff:
+            print(f"Archive already covers expenses before {boundary}")
+            return 0
+        
+        # Publish the new boundary first: rows are always in exactly one of the two
+        # tables, so readers that union both stay correct while batches are moved.
+        cursor.execute(
+            "INSERT INTO app_settings (name, value) VALUES ('archive_boundary', %s) "
+            "ON DUPLICATE KEY UPDATE value = VALUES(value)",
+            (cutoff,)
+        )
         conn.commit()
-        return True, f"Category '{name}' added"
+        
+        while True:
+            cursor.execute(
+                "SELECT id FROM expenses WHERE date < %s ORDER BY date LIMIT %s",
+                (cutoff, batch_size)
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+            placeholders = ", ".join(["%s"] * len(ids))
+            cursor.execute(
+                f"INSERT INTO expenses_archive ({ARCHIVED_COLUMNS}) "
+                f"SELECT {ARCHIVED_COLUMNS} FROM expenses WHERE id IN ({placeholders})",
+                ids
+            )
+            cursor.execute(f"DELETE FROM expenses WHERE id IN ({placeholders})", ids)
+            conn.commit()
+            moved += len(ids)
+            print(f"Archived {moved} expenses so far")
+        
+        print(f"Archived {moved} expenses")
+        return moved
+    except mysql.connector.Error as e:
+        print(f"Error archiving expenses: {e}")
+        conn.rollback()
+        return moved
+    finally:
+        conn.close()
+        print("--- EXPENSE ARCHIVING COMPLETE ---\n")
+
+def setup_database():
+    """Set up the database and tables."""
+    print("\n=== SETTING UP DATABASE ===")
+    ensure_database()
+    initialize_database()
+    clean_database()
+    ensure_expense_partitions()
+    archive_old_expenses()
+    print("=== DATABASE SETUP COMPLETE ===\n")
+
+# --- Database Functions ---
+
+def _log_changes(cursor, user_id, changes):
+    """Append entries to a user's change log inside the caller's transaction.
+    
+    Sequence numbers are allocated from users.change_seq. The row lock taken by the
+    UPDATE is held until the caller commits, so a user's sequence numbers are gap-free
+    and become visible in order: a reader that has seen seq N has seen every change
+    up to N.
+    
+    Args:
+        cursor: Cursor of the connection performing the change.
+        user_id: Owner of the changed data.
+        changes: List of (entity, operation, entity_id, payload) tuples.
+    
+    Returns:
+        int: Sequence number of the last entry written (None if changes is empty).
+    """
+    if not changes:
+        return None
+    cursor.execute(
+        "UPDATE users SET change_seq = LAST_INSERT_ID(change_seq + %s) WHERE id = %s",
+        (len(changes), user_id)
+    )
+    cursor.execute("SELECT LAST_INSERT_ID()")
+    last_seq = cursor.fetchone()[0]
+    first_seq = last_seq - len(changes) + 1
+    cursor.executemany(
+        "INSERT INTO change_log (user_id, seq, entity, entity_id, operation, payload) "
+        "VALUES (%s, %s, %s, %s, %s, %s)",
+        [
+            (user_id, first_seq + i, entity, entity_id, operation,
+             json.dumps(payload) if payload is not None else None)
+            for i, (entity, operation, entity_id, payload) in enumerate(changes)
+        ]
+    )
+    return last_seq
+
+def _log_change(cursor, user_id, entity, operation, entity_id, payload=None):
+    """Append a single entry to a user's change log. See _log_changes."""
+    return _log_changes(cursor, user_id, [(entity, operation, entity_id, payload)])
+
+def _fetch_changes(cursor, user_id, since_seq=0, limit=None):
+    """Fetch change log entries after since_seq on an existing cursor. See get_changes_since."""
+    query = """
+        SELECT seq, entity, entity_id, operation, payload, changed_at
+        FROM change_log
+        WHERE user_id = %s AND seq > %s
+        ORDER BY seq
+    """
+    params = [user_id, since_seq]
+    if limit:
+        query += " LIMIT %s"
+        params.append(int(limit))
+    cursor.execute(query, params)
+    return [
+        {
+            'seq': seq,
+            'entity': entity,
+            'entity_id': entity_id,
+            'operation': operation,
+            'payload': json.loads(payload) if payload else None,
+            'changed_at': changed_at
+        }
+        for seq, entity, entity_id, operation, payload, changed_at in cursor.fetchall()
+    ]
+
+def get_changes_since(user_id, since_seq=0, limit=None):
+    """Retrieve a user's changes with a sequence number greater than since_seq.
+    
+    Args:
+        user_id: The user whose changes to return.
+        since_seq: Last sequence number the caller has already applied.
+        limit: Optional maximum number of changes to return.
+    
+    Returns:
+        list: Dicts with seq, entity, entity_id, operation, payload and changed_at,
+        ordered by seq. Entities are 'expense', 'category' and 'category_limit'
+        (whose entity_id is the category id); operations are 'insert', 'update'
+        and 'delete'. A category delete implies deleting its expenses and limit.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return []
+    try:
+        return _fetch_changes(conn.cursor(), user_id, since_seq, limit)
+    except mysql.connector.Error as e:
+        print(f"Error fetching changes: {e}")
+        return []
+    finally:
+        conn.close()
+
+def get_latest_change_seq(user_id):
+    """Get the sequence number of a user's most recent change (0 if none)."""
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT change_seq FROM users WHERE id = %s", (user_id,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+    except mysql.connector.Error as e:
+        print(f"Error fetching latest change sequence: {e}")
+        return None
+    finally:
+        conn.close()
+
+# --- Expense Change Notifications ---
+
+_expense_listeners = []
+
+def register_expense_listener(callback):
+    """Register callback(user_id, deltas) to be told about changes to expense totals.
+    
+    deltas is a list of (category_id, date 'YYYY-MM-DD', cents) amounts to add to
+    the affected category and day (negative for removals), or None when the change
+    can't be described that way (category added or removed, full reload, or no
+    local replica) and anything derived for the user must be recomputed. A user_id
+    of None means every user. Callbacks may run on a background thread.
+    """
+    _expense_listeners.append(callback)
+
+def _notify_expense_listeners(user_id, deltas=None):
+    for callback in list(_expense_listeners):
+        try:
+            callback(user_id, deltas)
+        except Exception as e:
+            print(f"Error in expense listener: {e}")
+
+_change_listeners = []
+
+def register_change_listener(callback):
+    """Register callback(user_id, changes) to receive the change log entries the
+    local replica has just applied, in order.
+    
+    This is for data derived from individual rows rather than totals. Full reloads
+    are not reported here; they reach the expense listeners with deltas None.
+    Callbacks may run on a background thread.
+    """
+    _change_listeners.append(callback)
+
+def _notify_change_listeners(user_id, changes):
+    for callback in list(_change_listeners):
+        try:
+            callback(user_id, changes)
+        except Exception as e:
+            print(f"Error in change listener: {e}")
+
+def get_users():
+    """Retrieve all users as (id, username) tuples."""
+    conn = get_read_connection()
+    if not conn:
+        return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, username FROM users ORDER BY username")
+        return cursor.fetchall()
+    except mysql.connector.Error as e:
+        print(f"Error fetching users: {e}")
+        return []
+    finally:
+        conn.close()
+
+def add_user(username):
+    """Add a new user.
+    
+    Returns:
+        tuple: (success, message, user_id)
+    """
+    conn = get_db_connection()
+    if not conn:
+        return False, "Database connection failed", None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO users (username) VALUES (%s)", (username,))
+        conn.commit()
+        _note_primary_write()
+        return True, f"User '{username}' added", cursor.lastrowid
+    except mysql.connector.Error as e:
+        if e.errno == 1062:  # Duplicate entry
+            return False, f"User '{username}' already exists", None
+        return False, f"Error adding user: {e}", None
+    finally:
+        conn.close()
+
+def get_categories(user_id):
+    """Retrieve all category names of a user."""
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_categories(user_id)
+    print("\n--- FETCHING CATEGORIES FROM DATABASE ---")
+    conn = get_read_connection(user_id)
+    if not conn:
+        print("Error: Database connection failed in get_categories()")
+        return []
+    try:
+        cursor = conn.cursor()
+        # First check if the categories table exists
+        cursor.execute("SHOW TABLES LIKE 'categories'")
+        if not cursor.fetchone():
+            print("Error: 'categories' table doesn't exist!")
+            return []
+            
+        print("Executing query: SELECT name FROM categories WHERE user_id = %s AND deleted_at IS NULL ORDER BY name")
+        cursor.execute(
+            "SELECT name FROM categories WHERE user_id = %s AND deleted_at IS NULL ORDER BY name",
+            (user_id,)
+        )
+        categories = [row[0] for row in cursor.fetchall()]
+        print(f"Found {len(categories)} categories: {categories}")
+        return categories
+    except mysql.connector.Error as e:
+        print(f"Database error in get_categories: {e}")
+        return []
+    except Exception as e:
+        print(f"Unexpected error in get_categories: {e}")
+        return []
+    finally:
+        conn.close()
+        print("--- CATEGORY FETCH COMPLETE ---\n")
+
+def _link_category(cursor, category_id, parent_id):
+    """Add a new category's closure rows: itself, and every ancestor of its parent."""
+    cursor.execute("""
+        INSERT INTO category_closure (ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, %s, depth + 1 FROM category_closure WHERE descendant_id = %s
+        UNION ALL
+        SELECT %s, %s, 0
+    """, (category_id, parent_id, category_id, category_id))
+
+def add_category(user_id, name, parent_id=None):
+    """Add a new category for a user, optionally as a subcategory of parent_id."""
+    conn = get_db_connection()
+    if not conn:
+        return False, "Database connection failed"
+    try:
+        cursor = conn.cursor()
+        if parent_id is not None:
+            cursor.execute(
+                "SELECT id FROM categories WHERE id = %s AND user_id = %s AND deleted_at IS NULL FOR UPDATE",
+                (parent_id, user_id)
+            )
+            if not cursor.fetchone():
+                conn.rollback()
+                return False, "Parent category does not exist"
+        cursor.execute(
+            "INSERT INTO categories (user_id, name, parent_id) VALUES (%s, %s, %s)",
+            (user_id, name, parent_id)
+        )
+        category_id = cursor.lastrowid
+        _link_category(cursor, category_id, parent_id)
+        _log_change(cursor, user_id, 'category', 'insert', category_id, {'name': name, 'parent_id': parent_id})
+        conn.commit()
+        _refresh_local_replica(user_id, conn)
+        return True, f"Category '{name}' added"
     except mysql.connector.Error as e:
+        conn.rollback()
         if e.errno == 1062:  # Duplicate entry
             return False, f"Category '{name}' already exists"
         return False, f"Error adding category: {e}"
     finally:
         conn.close()
 
-def remove_category(name):
-    """Remove a category and its expenses."""
+def move_category(user_id, category_id, parent_id=None):
+    """Move a category, with all its subcategories, under another parent (None for top level).
+    
+    The subtree's closure rows to its old ancestors are replaced by rows to the new
+    ones in two set-based statements, however deep or large the subtree is.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return False, "Database connection failed"
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT name FROM categories WHERE id = %s AND user_id = %s AND deleted_at IS NULL FOR UPDATE",
+            (category_id, user_id)
+        )
+        result = cursor.fetchone()
+        if not result:
+            conn.rollback()
+            return False, "Category does not exist"
+        name = result[0]
+        if parent_id is not None:
+            cursor.execute(
+                "SELECT id FROM categories WHERE id = %s AND user_id = %s AND deleted_at IS NULL FOR UPDATE",
+                (parent_id, user_id)
+            )
+            if not cursor.fetchone():
+                conn.rollback()
+                return False, "Parent category does not exist"
+            cursor.execute(
+                "SELECT 1 FROM category_closure WHERE ancestor_id = %s AND descendant_id = %s",
+                (category_id, parent_id)
+            )
+            if cursor.fetchone():
+                conn.rollback()
+                return False, "A category can't be moved under itself or one of its subcategories"
+        
+        # Detach the subtree from every ancestor outside it
+        cursor.execute("""
+            DELETE link FROM category_closure link
+            JOIN category_closure subtree
+                ON subtree.ancestor_id = %s AND subtree.descendant_id = link.descendant_id
+            LEFT JOIN category_closure inside
+                ON inside.ancestor_id = %s AND inside.descendant_id = link.ancestor_id
+            WHERE inside.ancestor_id IS NULL
+        """, (category_id, category_id))
+        # Attach it below the new parent's ancestors (the parent included)
+        if parent_id is not None:
+            cursor.execute("""
+                INSERT INTO category_closure (ancestor_id, descendant_id, depth)
+                SELECT above.ancestor_id, subtree.descendant_id, above.depth + subtree.depth + 1
+                FROM category_closure above
+                JOIN category_closure subtree ON subtree.ancestor_id = %s
+                WHERE above.descendant_id = %s
+            """, (category_id, parent_id))
+        cursor.execute("UPDATE categories SET parent_id = %s WHERE id = %s", (parent_id, category_id))
+        _log_change(cursor, user_id, 'category', 'update', category_id, {'name': name, 'parent_id': parent_id})
+        conn.commit()
+        _refresh_local_replica(user_id, conn)
+        return True, f"Moved '{name}'"
+    except mysql.connector.Error as e:
+        conn.rollback()
+        return False, f"Error moving category: {e}"
+    finally:
+        conn.close()
+
+def remove_category(user_id, name):
+    """Remove a user's category together with its subcategories.
+    
+    The categories are hidden at once; their expenses and limits are purged in
+    batches by CATEGORY_PURGE_WORKER so a large category never holds locks for
+    long or blocks the UI. The purge resumes on the next start if interrupted.
+    """
     conn = get_db_connection()
     if not conn:
         return False
     try:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM categories WHERE name = %s", (name,))
+        cursor.execute("""
+            SELECT c.id, c.name
+            FROM categories a
+            JOIN category_closure cc ON cc.ancestor_id = a.id
+            JOIN categories c ON c.id = cc.descendant_id AND c.deleted_at IS NULL
+            WHERE a.user_id = %s AND a.name = %s AND a.deleted_at IS NULL
+            FOR UPDATE
+        """, (user_id, name))
+        removed = cursor.fetchall()
+        if not removed:
+            conn.rollback()
+            return False
+        placeholders, ids = _id_list(category_id for category_id, _ in removed)
+        cursor.execute(f"UPDATE categories SET deleted_at = NOW() WHERE id IN ({placeholders})", ids)
+        _log_changes(cursor, user_id, [
+            ('category', 'delete', category_id, {'name': category_name})
+            for category_id, category_name in removed
+        ])
         conn.commit()
-        return cursor.rowcount > 0
+        _refresh_local_replica(user_id, conn)
+        CATEGORY_PURGE_WORKER.wake()
+        return True
     except mysql.connector.Error as e:
         print(f"Error removing category: {e}")
         return False
     finally:
         conn.close()
 
-def get_category_id(name):
-    """Get the ID of a category by name."""
-    conn = get_db_connection()
+def _tree_from_paths(rows):
+    """Turn (category_id, ancestor name, parent_id) rows, ordered by category and
+    then from the root down, into get_category_tree's result."""
+    paths, parents = {}, {}
+    for category_id, ancestor_name, parent_id in rows:
+        paths.setdefault(category_id, []).append(ancestor_name)
+        parents[category_id] = parent_id
+    tree = [(category_id, path[-1], parents[category_id], tuple(path)) for category_id, path in paths.items()]
+    tree.sort(key=lambda node: [name.lower() for name in node[3]])
+    return tree
+
+def get_category_tree(user_id):
+    """Get a user's categories in tree order.
+    
+    Returns:
+        list: (id, name, parent_id, path) tuples, where path is the tuple of names
+        from the top-level category down to this one, sorted so every category
+        follows its parent and siblings are in name order.
+    """
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_category_tree(user_id)
+    conn = get_read_connection(user_id)
+    if not conn:
+        return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT cc.descendant_id, a.name, d.parent_id
+            FROM categories d
+            JOIN category_closure cc ON cc.descendant_id = d.id
+            JOIN categories a ON a.id = cc.ancestor_id
+            WHERE d.user_id = %s AND d.deleted_at IS NULL
+            ORDER BY cc.descendant_id, cc.depth DESC
+        """, (user_id,))
+        return _tree_from_paths(cursor.fetchall())
+    except mysql.connector.Error as e:
+        print(f"Error getting category tree: {e}")
+        return []
+    finally:
+        conn.close()
+
+# Categories picked in this session, most recent first, per user
+_recent_category_picks = {}
+
+def remember_category_pick(user_id, category_id):
+    picks = _recent_category_picks.setdefault(user_id, [])
+    if category_id in picks:
+        picks.remove(category_id)
+    picks.insert(0, category_id)
+    del picks[CATEGORY_PICKER_CONFIG["recent_count"]:]
+
+def get_recent_category_ids(user_id, count=None):
+    """Get the IDs of a user's most recently used categories, most recent first.
+    
+    Categories picked in this session come first, then the categories of the
+    latest expenses (a backward scan of the user/date index).
+    """
+    count = count or CATEGORY_PICKER_CONFIG["recent_count"]
+    recent = list(_recent_category_picks.get(user_id, []))
+    replica = _local_replica(user_id)
+    if replica:
+        rows = replica.get_latest_expense_categories(user_id, count * 20)
+    else:
+        conn = get_read_connection(user_id, quiet=True)
+        if not conn:
+            return recent[:count]
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT category_id FROM expenses WHERE user_id = %s ORDER BY date DESC LIMIT %s",
+                (user_id, count * 20)
+            )
+            rows = cursor.fetchall()
+        except mysql.connector.Error as e:
+            print(f"Error getting recent categories: {e}")
+            rows = []
+        finally:
+            conn.close()
+    for (category_id,) in rows:
+        if category_id not in recent:
+            recent.append(category_id)
+    return recent[:count]
+
+def _fetch_subtrees(cursor, user_id, ancestor_ids=None):
+    query = """
+        SELECT cc.ancestor_id, cc.descendant_id
+        FROM category_closure cc
+        JOIN categories d ON d.id = cc.descendant_id AND d.deleted_at IS NULL
+        WHERE d.user_id = %s
+    """
+    params = [user_id]
+    if ancestor_ids is not None:
+        placeholders, ids = _id_list(ancestor_ids)
+        query += f" AND cc.ancestor_id IN ({placeholders})"
+        params += ids
+    cursor.execute(query, params)
+    subtrees = {}
+    for ancestor_id, descendant_id in cursor.fetchall():
+        subtrees.setdefault(ancestor_id, []).append(descendant_id)
+    return subtrees
+
+def get_category_subtrees(user_id):
+    """Map each of a user's categories to the IDs in its subtree (itself included)."""
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_category_subtrees(user_id)
+    conn = get_read_connection(user_id)
+    if not conn:
+        return {}
+    try:
+        return _fetch_subtrees(conn.cursor(), user_id)
+    except mysql.connector.Error as e:
+        print(f"Error getting category subtrees: {e}")
+        return {}
+    finally:
+        conn.close()
+
+def purge_deleted_categories(progress=None, should_stop=None):
+    """Delete the expenses, limits and rows of removed categories in bounded batches.
+    
+    Each batch is its own short transaction, so the work can stop at any point
+    and pick up where it left off; the deleted_at marker is the only state.
+    
+    Args:
+        progress: Optional callable(category_name, deleted, total) after each batch.
+        should_stop: Optional callable returning True to stop early.
+    
+    Returns:
+        int: Number of categories fully purged.
+    """
+    conn = get_db_connection(quiet=True)
+    if not conn:
+        return 0
+    batch_size = PURGE_CONFIG.get("batch_size", 5000)
+    purged = 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name FROM categories WHERE deleted_at IS NOT NULL ORDER BY deleted_at")
+        pending = cursor.fetchall()
+        conn.commit()
+        for category_id, name in pending:
+            print(f"\n--- PURGING REMOVED CATEGORY '{name}' (ID: {category_id}) ---")
+            cursor.execute(
+                "SELECT (SELECT COUNT(*) FROM expenses WHERE category_id = %s) + "
+                "(SELECT COUNT(*) FROM expenses_archive WHERE category_id = %s)",
+                (category_id, category_id)
+            )
+            total = int(cursor.fetchone()[0])
+            conn.commit()
+            deleted = 0
+            for table in ("expenses", "expenses_archive"):
+                while True:
+                    if should_stop and should_stop():
+                        print(f"Purge of '{name}' paused after {deleted} of {total} expenses")
+                        return purged
+                    cursor.execute(
+                        f"SELECT id FROM {table} WHERE category_id = %s LIMIT %s FOR UPDATE",
+                        (category_id, batch_size)
+                    )
+                    ids = [row[0] for row in cursor.fetchall()]
+                    if ids:
+                        placeholders = ", ".join(["%s"] * len(ids))
+                        cursor.execute(f"DELETE FROM expense_tags WHERE expense_id IN ({placeholders})", ids)
+                        cursor.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", ids)
+                    count = len(ids)
+                    conn.commit()
+                    deleted += count
+                    if progress:
+                        progress(name, deleted, total)
+                    if count < batch_size:
+                        break
+            cursor.execute("DELETE FROM category_limits WHERE category_id = %s", (category_id,))
+            cursor.execute("DELETE FROM categories WHERE id = %s", (category_id,))
+            conn.commit()
+            purged += 1
+            print(f"Purged category '{name}' and {deleted} expenses")
+        return purged
+    except mysql.connector.Error as e:
+        print(f"Error purging removed categories: {e}")
+        conn.rollback()
+        return purged
+    finally:
+        conn.close()
+
+def get_category_id(user_id, name):
+    """Get the ID of a user's category by name."""
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_category_id(user_id, name)
+    conn = get_read_connection(user_id)
     if not conn:
         return None
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT id FROM categories WHERE name = %s", (name,))
+        cursor.execute(
+            "SELECT id FROM categories WHERE user_id = %s AND name = %s AND deleted_at IS NULL",
+            (user_id, name)
+        )
         result = cursor.fetchone()
         return result[0] if result else None
     except mysql.connector.Error as e:
@@ -284,175 +1755,471 @@ def get_category_id(name):
     finally:
         conn.close()
 
-def get_expenses(category_name, start_date=None, end_date=None):
-    """Retrieve expenses for a category with optional date filtering."""
+def get_expenses(user_id, category_name, start_date=None, end_date=None, tag_query=None):
+    """Retrieve expenses for a user's category with optional date and tag filtering.
+    
+    Args:
+        tag_query: Optional tag query (see parse_tag_query) the expenses must match.
+    
+    Returns:
+        tuple: (expenses, total) where expenses is a list of Expense, newest first,
+        and total their Money sum.
+    
+    Raises:
+        ValueError: If tag_query doesn't parse.
+    """
+    tag_filter = parse_tag_query(tag_query) if tag_query else None
+    if tag_filter:
+        index = _tag_index(user_id)
+        if index:
+            category_id = get_category_id(user_id, category_name)
+            if not category_id:
+                return [], Money()
+            return index.expenses(tag_filter, category_id, start_date, end_date)
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_expenses(user_id, category_name, start_date, end_date, tag_filter)
     print(f"\n--- FETCHING EXPENSES ---")
     print(f"Category: {category_name}")
     print(f"Date range: {start_date} to {end_date}")
     
-    conn = get_db_connection()
+    conn = get_read_connection(user_id)
     if not conn:
         print("ERROR: Database connection failed in get_expenses")
-        return [], 0
+        return [], Money()
         
     try:
         cursor = conn.cursor()
         
         # First check if the category exists
-        cursor.execute("SELECT id FROM categories WHERE name = %s", (category_name,))
+        cursor.execute(
+            "SELECT id FROM categories WHERE user_id = %s AND name = %s AND deleted_at IS NULL",
+            (user_id, category_name)
+        )
         category_result = cursor.fetchone()
         
         if not category_result:
             print(f"ERROR: Category '{category_name}' not found in database")
-            return [], 0
+            return [], Money()
             
         category_id = category_result[0]
         print(f"Found category ID: {category_id}")
         
         # Build and execute query to get expenses
-        query = """
+        query = f"""
             SELECT e.id, e.amount, e.date
-            FROM expenses e
-            JOIN categories c ON e.category_id = c.id
-            WHERE c.name = %s
+            FROM {_expense_source(cursor, start_date)} e
+            WHERE e.category_id = %s
         """
-        params = [category_name]
+        params = [category_id]
         if start_date:
             query += " AND e.date >= %s"
             params.append(start_date)
         if end_date:
             query += " AND e.date <= %s"
             params.append(end_date)
+        if tag_filter:
+            tag_sql, tag_params = _tag_query_sql(tag_filter, user_id)
+            query += f" AND {tag_sql}"
+            params += tag_params
         query += " ORDER BY e.date DESC"
         
         print(f"Executing query: {query}")
         print(f"With parameters: {params}")
         
         cursor.execute(query, params)
-        expenses = cursor.fetchall()
+        expenses = [Expense(expense_id, category_id, Money.of(amount), date)
+                    for expense_id, amount, date in cursor.fetchall()]
         print(f"Fetched {len(expenses)} expense records")
         
         # Calculate total
-        total_query = query.replace("e.id, e.amount, e.date", "SUM(e.amount)")
-        cursor.execute(total_query, params)
-        total_result = cursor.fetchone()
-        total = total_result[0] or 0
+        total = sum((expense.amount for expense in expenses), Money())
         print(f"Total expenses: {total}")
         
         return expenses, total
     except mysql.connector.Error as e:
         print(f"Database error in get_expenses: {e}")
-        return [], 0
+        return [], Money()
     except Exception as e:
         print(f"Unexpected error in get_expenses: {e}")
         import traceback
         traceback.print_exc()
-        return [], 0
+        return [], Money()
     finally:
         conn.close()
         print("--- EXPENSE FETCHING COMPLETE ---\n")
 
-def add_expense(category_name, amount, date):
-    """Add a new expense.
+# The same fingerprint computed by MySQL from a row of expenses or
+# expenses_archive, for backfills and updates. Assignments in a single-table
+# UPDATE see the values set before them, so it goes last in a SET list.
+_FINGERPRINT_SQL = """CONV(LEFT(SHA1(CONCAT_WS('|', category_id, CAST(ROUND(amount * 100) AS SIGNED),
+    COALESCE((SELECT p.normalized_name FROM payees p WHERE p.id = payee_id), ''),
+    COALESCE(reference, ''))), 15), 16, 10)"""
+
+def _normalize_reference(reference):
+    """Collapse whitespace and case in a statement description, or None if empty."""
+    reference = " ".join(str(reference or "").casefold().split())[:255]
+    return reference or None
+
+def _expense_fingerprint(category_id, amount, payee=None, reference=None):
+    """Return the content fingerprint of an expense, leaving out its date.
     
-    Args:
-        category_name (str): Category name.
-        amount (float): Expense amount.
-        date (str): Date in YYYY-MM-DD format.
+    A 60-bit prefix of the SHA-1 of the category, amount in cents, normalized
+    payee name and normalized reference, so it fits a signed BIGINT and matches
+    _FINGERPRINT_SQL.
+    """
+    payee_key = _normalize_payee(payee)[1] if payee else ""
+    text = "|".join((str(category_id), str(_to_cents(amount)), payee_key, _normalize_reference(reference) or ""))
+    return int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:15], 16)
 
+def _insert_expense(cursor, user_id, category_id, amount, date, idempotency_key=None, payee=None,
+                    reference=None):
+    """Insert an expense and record it in the change log.
+    
+    The payee is created if it's new.
+    
     Returns:
-        tuple: (success, message)
+        int: The new expense ID, or None if an expense with the same idempotency
+        key was already inserted.
     """
-    category_id = get_category_id(category_name)
-    if not category_id:
-        return False, f"Category '{category_name}' does not exist"
+    if idempotency_key:
+        cursor.execute(
+            "SELECT id FROM expenses WHERE user_id = %s AND idempotency_key = %s AND date = %s",
+            (user_id, idempotency_key, date)
+        )
+        if cursor.fetchone():
+            return None
+    payee_id = _payee_id(cursor, user_id, payee) if payee else None
+    cursor.execute(
+        "INSERT INTO expenses (user_id, category_id, amount, date, idempotency_key, payee_id, reference, fingerprint) "
+        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+        (user_id, category_id, Money.of(amount).to_decimal(), date, idempotency_key, payee_id,
+         _normalize_reference(reference), _expense_fingerprint(category_id, amount, payee, reference))
+    )
+    expense_id = cursor.lastrowid
+    _log_change(cursor, user_id, 'expense', 'insert', expense_id, {
+        'category_id': category_id, 'amount': str(Money.of(amount)), 'date': str(date), 'payee_id': payee_id
+    })
+    return expense_id
+
+def _update_expense(cursor, user_id, expense_id, amount, date_str):
+    """Update an expense (live or archived) and record it in the change log.
     
-    try:
-        amount = float(amount)
-        if amount <= 0:
-            return False, "Amount must be positive"
-    except (ValueError, TypeError):
-        return False, "Invalid amount format"
+    An archived expense whose new date is on or after the archive boundary is
+    moved back to the live table, which is the only place current reads look.
     
-    conn = get_db_connection()
-    if not conn:
-        return False, "Failed to connect to database"
+    Returns:
+        int: Number of rows updated.
+    """
+    query = f"UPDATE expenses SET amount = %s, date = %s, fingerprint = {_FINGERPRINT_SQL} WHERE id = %s AND user_id = %s"
+    amount = Money.of(amount)
+    values = (amount.to_decimal(), date_str, int(expense_id), user_id)
     
-    try:
-        cursor = conn.cursor()
+    print(f"Executing: {query} with values {values}")
+    cursor.execute(query, values)
+    updated = cursor.rowcount
+    if updated == 0:
+        # The expense may have been moved to the archive
+        cursor.execute(query.replace("UPDATE expenses", "UPDATE expenses_archive"), values)
+        updated = cursor.rowcount
+        boundary = _get_archive_boundary(cursor)
+        if boundary and date_str >= str(boundary):
+            archived = "FROM expenses_archive WHERE id = %s AND user_id = %s"
+            cursor.execute(
+                f"INSERT INTO expenses ({ARCHIVED_COLUMNS}) SELECT {ARCHIVED_COLUMNS} {archived}",
+                (int(expense_id), user_id)
+            )
+            cursor.execute(f"DELETE {archived}", (int(expense_id), user_id))
+    
+    if updated > 0:
         cursor.execute(
-            "INSERT INTO expenses (category_id, amount, date) VALUES (%s, %s, %s)",
-            (category_id, amount, date)
+            "SELECT category_id FROM expenses WHERE id = %s "
+            "UNION ALL SELECT category_id FROM expenses_archive WHERE id = %s",
+            (int(expense_id), int(expense_id))
         )
-        conn.commit()
-        return True, "Expense added successfully"
-    except mysql.connector.Error as e:
-        return False, f"Database error: {e}"
+        category_id = cursor.fetchone()[0]
+        _log_change(cursor, user_id, 'expense', 'update', int(expense_id), {
+            'category_id': category_id, 'amount': str(amount), 'date': date_str
+        })
+    return updated
+
+def _delete_expense(cursor, user_id, expense_id):
+    """Delete an expense (live or archived) and record it in the change log.
+    
+    Returns:
+        bool: Whether an expense was deleted.
+    """
+    cursor.execute("DELETE FROM expenses WHERE id = %s AND user_id = %s", (expense_id, user_id))
+    deleted = cursor.rowcount > 0
+    if not deleted:
+        # The expense may have been moved to the archive
+        cursor.execute(
+            "DELETE FROM expenses_archive WHERE id = %s AND user_id = %s",
+            (expense_id, user_id)
+        )
+        deleted = cursor.rowcount > 0
+    if deleted:
+        cursor.execute("DELETE FROM expense_tags WHERE expense_id = %s", (expense_id,))
+        _log_change(cursor, user_id, 'expense', 'delete', int(expense_id))
+    return deleted
+
+def add_expense(user_id, category_name, amount, date, tags=(), payee=None):
+    """Add a new expense.
+    
+    If the database is unreachable the expense is written to the offline queue
+    and saved once the connection returns.
+    
+    Args:
+        user_id (int): Acting user.
+        category_name (str): Category name.
+        amount (Money): Expense amount (or anything Money.of parses).
+        date (str): Date in YYYY-MM-DD format.
+        tags: Optional tag names for the expense.
+        payee (str): Optional payee name (created if it's new).
+    
+    Returns:
+        tuple: (success, message)
+    """
+    success, message, _ = add_expense_with_status(user_id, category_name, amount, date, tags, payee)
+    return success, message
+
+def add_expense_with_status(user_id, category_name, amount, date, tags=(), payee=None):
+    """Add an expense and report the category's budget status in the same transaction.
+    
+    The category row and its ancestors' rows are locked while the expense is
+    inserted and the current budget period's spending is summed, so concurrent
+    adds to the same subtree are serialized and each sees the others' effect on
+    the totals.
+    
+    Args:
+        user_id (int): Acting user.
+        category_name (str): Category name.
+        amount (Money): Expense amount (or anything Money.of parses).
+        date (str): Date in YYYY-MM-DD format.
+        tags: Optional tag names for the expense.
+        payee (str): Optional payee name (created if it's new).
+    
+    Returns:
+        tuple: (success, message, status) where status is the category's
+        CategoryBudgetStatus with ancestors (the statuses of parent categories
+        with a limit, which the expense also counts towards) and anomalies
+        (reasons the expense looks unusual, see AnomalyDetector) filled in, or
+        None if the expense was not saved or was queued offline.
+    """
+    try:
+        amount = Money.of(amount)
+        if amount <= 0:
+            return False, "Amount must be positive", None
+    except ValueError:
+        return False, "Invalid amount format", None
+    try:
+        tags = _normalize_tags(tags)
+        payee = _normalize_payee(payee)[0] if payee and payee.strip() else None
+    except ValueError as e:
+        return False, str(e), None
+    
+    conn = get_db_connection(quiet=True)
+    if not conn:
+        OFFLINE_QUEUE.enqueue('add', user_id, category=category_name, amount=str(amount), date=str(date),
+                              tags=tags, payee=payee)
+        return True, "Database unavailable - expense saved offline and will be synced automatically", None
+    # Seeded before the insert so the new expense is judged against the others
+    detector = _anomaly_detector(user_id)
+    
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id FROM categories WHERE user_id = %s AND name = %s AND deleted_at IS NULL FOR UPDATE",
+            (user_id, category_name)
+        )
+        result = cursor.fetchone()
+        if not result:
+            conn.rollback()
+            return False, f"Category '{category_name}' does not exist", None
+        category_id = result[0]
+        affected = _lock_category_ancestors(cursor, [category_id])
+        expense_id = _insert_expense(cursor, user_id, category_id, amount, date, payee=payee)
+        _write_expense_tags(cursor, user_id, [expense_id], tags)
+        statuses = _budget_statuses_in_transaction(cursor, user_id, affected)
+        conn.commit()
+        _refresh_local_replica(user_id, conn)
+        
+        status = next(status for status in statuses if status.id == category_id)
+        status.ancestors = [other for other in statuses if other.id != category_id and other.limit]
+        status.anomalies = detector.record(category_id, amount, date)
+        return True, "Expense added successfully", status
+    except mysql.connector.Error as e:
+        conn.rollback()
+        return False, f"Database error: {e}", None
     finally:
         conn.close()
 
-def delete_expense(expense_id):
-    """Delete an expense by ID."""
-    conn = get_db_connection()
+def add_expenses_batch(user_id, entries):
+    """Add many expenses, possibly across categories, in one transaction.
+    
+    The rows go in with a single multi-row INSERT, each tagged with its own
+    idempotency key so the new IDs can be read back for the change log. Budget
+    status is then computed for all affected categories in one pass.
+    
+    Args:
+        user_id (int): Acting user.
+        entries: List of (category_name, amount, date[, payee[, reference]])
+            tuples, date as YYYY-MM-DD. The payee and reference (e.g. the
+            statement description of an imported row) are optional.
+    
+    Returns:
+        tuple: (success, message, statuses) where statuses is a list of
+        CategoryBudgetStatus for the affected categories and their ancestors, with
+        anomalies a list of (amount, date, reasons) for unusual expenses, or None
+        if nothing was saved or the batch was queued offline.
+    """
+    if not entries:
+        return False, "No expenses to add", None
+    rows = []
+    for category_name, amount, date, *extra in entries:
+        try:
+            amount = Money.of(amount)
+        except ValueError:
+            return False, "Invalid amount format", None
+        if amount <= 0:
+            return False, "Amounts must be positive", None
+        payee = extra[0] if extra and extra[0] and extra[0].strip() else None
+        try:
+            payee = _normalize_payee(payee)[0] if payee else None
+        except ValueError as e:
+            return False, str(e), None
+        rows.append((category_name, amount, str(date), payee, extra[1] if len(extra) > 1 else None))
+    
+    conn = get_db_connection(quiet=True)
     if not conn:
-        return False
+        for category_name, amount, date, payee, reference in rows:
+            OFFLINE_QUEUE.enqueue('add', user_id, category=category_name, amount=str(amount), date=date,
+                                  payee=payee, reference=reference)
+        return True, f"Database unavailable - {len(rows)} expenses saved offline and will be synced automatically", None
+    detector = _anomaly_detector(user_id)
+    
+    try:
+        cursor = conn.cursor()
+        names = sorted({row[0] for row in rows})
+        placeholders = ", ".join(["%s"] * len(names))
+        cursor.execute(
+            f"SELECT id, name FROM categories "
+            f"WHERE user_id = %s AND name IN ({placeholders}) AND deleted_at IS NULL FOR UPDATE",
+            [user_id] + names
+        )
+        categories = {name: cat_id for cat_id, name in cursor.fetchall()}
+        missing = [name for name in names if name not in categories]
+        if missing:
+            conn.rollback()
+            return False, f"Category '{missing[0]}' does not exist", None
+        
+        payee_ids = {payee: _payee_id(cursor, user_id, payee) for payee in {row[3] for row in rows} if payee}
+        keyed_rows = [
+            (user_id, categories[name], amount, date, str(uuid.uuid4()), payee_ids.get(payee),
+             _normalize_reference(reference), _expense_fingerprint(categories[name], amount, payee, reference))
+            for name, amount, date, payee, reference in rows
+        ]
+        cursor.execute(
+            "INSERT INTO expenses (user_id, category_id, amount, date, idempotency_key, payee_id, reference, "
+            "fingerprint) VALUES " + ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * len(keyed_rows)),
+            [value.to_decimal() if isinstance(value, Money) else value for row in keyed_rows for value in row]
+        )
+        cursor.execute(
+            f"SELECT idempotency_key, id FROM expenses WHERE user_id = %s "
+            f"AND idempotency_key IN ({', '.join(['%s'] * len(keyed_rows))})",
+            [user_id] + [row[4] for row in keyed_rows]
+        )
+        ids = dict(cursor.fetchall())
+        _log_changes(cursor, user_id, [
+            ('expense', 'insert', ids[key], {
+                'category_id': category_id, 'amount': str(amount), 'date': date, 'payee_id': payee_id
+            })
+            for _, category_id, amount, date, key, payee_id, _, _ in keyed_rows
+        ])
+        
+        affected = _lock_category_ancestors(cursor, [categories[name] for name in names])
+        statuses = _budget_statuses_in_transaction(cursor, user_id, affected)
+        conn.commit()
+        _refresh_local_replica(user_id, conn)
+        
+        by_category = {status.id: status for status in statuses}
+        for _, category_id, amount, date, *_ in keyed_rows:
+            reasons = detector.record(category_id, amount, date)
+            if reasons:
+                by_category[category_id].anomalies.append((amount, date, reasons))
+        return True, f"Added {len(rows)} expenses", statuses
+    except mysql.connector.Error as e:
+        conn.rollback()
+        return False, f"Database error: {e}", None
+    finally:
+        conn.close()
+
+def delete_expense(user_id, expense_id):
+    """Delete a user's expense by ID (queued offline if the database is unreachable)."""
+    conn = get_db_connection(quiet=True)
+    if not conn:
+        OFFLINE_QUEUE.enqueue('delete', user_id, expense_id=int(expense_id))
+        return True
     try:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM expenses WHERE id = %s", (expense_id,))
+        deleted = _delete_expense(cursor, user_id, expense_id)
         conn.commit()
-        return cursor.rowcount > 0
+        _refresh_local_replica(user_id, conn)
+        return deleted
     except mysql.connector.Error as e:
         print(f"Error deleting expense: {e}")
         return False
     finally:
         conn.close()
 
-def update_expense(expense_id, amount, date):
-    """Update an existing expense with reliable transaction handling."""
+def update_expense(user_id, expense_id, amount, date):
+    """Update a user's existing expense with reliable transaction handling."""
     print("--- EXPENSE UPDATE START ---")
     print(f"Updating expense ID: {expense_id}")
     print(f"New amount: {amount}")
     print(f"New date: {date} (type: {type(date)})")
     
+    # Format the date properly
+    if isinstance(date, str):
+        date_str = date
+    else:
+        date_str = date.strftime("%Y-%m-%d")
+    print(f"Formatted date: {date_str}")
+    
     # Ensure we have a valid connection
     try:
         conn = mysql.connector.connect(**DB_CONFIG)
         print("Database connection established")
     except mysql.connector.Error as e:
-        print(f"Connection error: {e}")
-        return False
+        print(f"Connection error: {e} - queueing update offline")
+        OFFLINE_QUEUE.enqueue('update', user_id, expense_id=int(expense_id),
+                              amount=str(Money.of(amount)), date=date_str)
+        print("--- EXPENSE UPDATE END ---")
+        return True
         
     try:
-        # Format the date properly
-        if isinstance(date, str):
-            date_str = date
-        else:
-            date_str = date.strftime("%Y-%m-%d")
-            
-        print(f"Formatted date: {date_str}")
-            
         # Create cursor
         cursor = conn.cursor()
         
         # Execute update query
-        query = "UPDATE expenses SET amount = %s, date = %s WHERE id = %s"
-        values = (float(amount), date_str, int(expense_id))
-        
-        print(f"Executing: {query} with values {values}")
-        cursor.execute(query, values)
+        updated = _update_expense(cursor, user_id, expense_id, amount, date_str)
         
         # Explicitly commit the transaction
         conn.commit()
         print("Transaction committed")
+        _refresh_local_replica(user_id, conn)
         
         # Check if the update was successful
-        if cursor.rowcount > 0:
-            print(f"Successfully updated {cursor.rowcount} row(s)")
+        if updated > 0:
+            print(f"Successfully updated {updated} row(s)")
             return True
         else:
             print("Update failed: No rows affected")
             # Check if the expense exists
-            cursor.execute("SELECT COUNT(*) FROM expenses WHERE id = %s", (expense_id,))
+            cursor.execute(
+                "SELECT COUNT(*) FROM expenses WHERE id = %s AND user_id = %s",
+                (expense_id, user_id)
+            )
             count = cursor.fetchone()[0]
             if count == 0:
                 print(f"Expense ID {expense_id} doesn't exist")
@@ -470,215 +2237,4179 @@ def update_expense(expense_id, amount, date):
             print("Connection closed")
         print("--- EXPENSE UPDATE END ---")
 
-def get_category_totals():
-    """Get total expenses per category for the pie chart."""
+def _id_list(expense_ids):
+    """Return (placeholders, ids) for an IN clause over expense (or other row) IDs."""
+    ids = sorted({int(expense_id) for expense_id in expense_ids})
+    return ", ".join(["%s"] * len(ids)), ids
+
+def bulk_delete_expenses(user_id, expense_ids):
+    """Delete many of a user's expenses with one statement per table in one transaction.
+    
+    Returns:
+        tuple: (success, message, deleted_ids)
+    """
+    if not expense_ids:
+        return False, "No expenses selected", []
+    conn = get_db_connection()
+    if not conn:
+        return False, "Database connection failed", []
+    placeholders, ids = _id_list(expense_ids)
+    try:
+        cursor = conn.cursor()
+        deleted_ids = []
+        for table in ("expenses", "expenses_archive"):
+            cursor.execute(
+                f"SELECT id FROM {table} WHERE user_id = %s AND id IN ({placeholders}) FOR UPDATE",
+                [user_id] + ids
+            )
+            table_ids = [row[0] for row in cursor.fetchall()]
+            if table_ids:
+                cursor.execute(
+                    f"DELETE FROM {table} WHERE user_id = %s AND id IN ({', '.join(['%s'] * len(table_ids))})",
+                    [user_id] + table_ids
+                )
+                deleted_ids.extend(table_ids)
+        if deleted_ids:
+            cursor.execute(
+                f"DELETE FROM expense_tags WHERE expense_id IN ({', '.join(['%s'] * len(deleted_ids))})",
+                deleted_ids
+            )
+        _log_changes(cursor, user_id, [('expense', 'delete', expense_id, None) for expense_id in deleted_ids])
+        conn.commit()
+        _refresh_local_replica(user_id, conn)
+        return True, f"Deleted {len(deleted_ids)} expenses", deleted_ids
+    except mysql.connector.Error as e:
+        conn.rollback()
+        print(f"Error bulk deleting expenses: {e}")
+        return False, f"Database error: {e}", []
+    finally:
+        conn.close()
+
+def bulk_update_expenses(user_id, expense_ids, date=None, category_id=None,
+                         amount=None, amount_factor=None, amount_delta=None):
+    """Re-date, re-categorize or adjust the amount of many expenses at once.
+    
+    Each change is a single UPDATE per table (live and archive) inside one
+    transaction. Archived expenses re-dated past the archive boundary are moved
+    back into the live table.
+    
+    Args:
+        user_id (int): Acting user.
+        expense_ids: IDs of the expenses to change.
+        date (str): New date (YYYY-MM-DD) for all of them.
+        category_id (int): New category for all of them.
+        amount (Money): New amount for all of them.
+        amount_factor (float): Multiply amounts by this (e.g. 1.1 for +10%).
+        amount_delta (Money): Add this to amounts (negative to subtract).
+        
+    The results are rounded half up to whole cents.
+    
+    Returns:
+        tuple: (success, message, rows) where rows is the list of updated Expenses.
+    """
+    if not expense_ids:
+        return False, "No expenses selected", []
+    assignments, params = [], []
+    if date is not None:
+        assignments.append("date = %s")
+        params.append(str(date))
+    if category_id is not None:
+        assignments.append("category_id = %s")
+        params.append(int(category_id))
+    if amount is not None:
+        assignments.append("amount = %s")
+        params.append(Money.of(amount).to_decimal())
+    elif amount_factor is not None or amount_delta is not None:
+        assignments.append("amount = ROUND(amount * %s + %s, 2)")
+        params.extend([Money._decimal(amount_factor or 1), Money.of(amount_delta or 0).to_decimal()])
+    if not assignments:
+        return False, "Nothing to change", []
+    assignments.append(f"fingerprint = {_FINGERPRINT_SQL}")
+    
+    conn = get_db_connection()
+    if not conn:
+        return False, "Database connection failed", []
+    placeholders, ids = _id_list(expense_ids)
+    try:
+        cursor = conn.cursor()
+        if category_id is not None:
+            cursor.execute(
+                "SELECT id FROM categories WHERE id = %s AND user_id = %s AND deleted_at IS NULL FOR SHARE",
+                (int(category_id), user_id)
+            )
+            if not cursor.fetchone():
+                return False, "Category does not exist", []
+        for table in ("expenses", "expenses_archive"):
+            cursor.execute(
+                f"UPDATE {table} SET {', '.join(assignments)} WHERE user_id = %s AND id IN ({placeholders})",
+                params + [user_id] + ids
+            )
+        if date is not None:
+            boundary = _get_archive_boundary(cursor)
+            if boundary and str(date) >= str(boundary):
+                archived = f"FROM expenses_archive WHERE user_id = %s AND id IN ({placeholders})"
+                cursor.execute(
+                    f"INSERT INTO expenses ({ARCHIVED_COLUMNS}) SELECT {ARCHIVED_COLUMNS} {archived}",
+                    [user_id] + ids
+                )
+                cursor.execute(f"DELETE {archived}", [user_id] + ids)
+        
+        cursor.execute(f"""
+            SELECT id, category_id, amount, date FROM expenses WHERE user_id = %s AND id IN ({placeholders})
+            UNION ALL
+            SELECT id, category_id, amount, date FROM expenses_archive WHERE user_id = %s AND id IN ({placeholders})
+        """, [user_id] + ids + [user_id] + ids)
+        rows = [Expense(expense_id, row_category_id, Money.of(row_amount), row_date)
+                for expense_id, row_category_id, row_amount, row_date in cursor.fetchall()]
+        if any(row.amount <= 0 for row in rows):
+            conn.rollback()
+            return False, "The adjustment would make some amounts zero or negative", []
+        _log_changes(cursor, user_id, [
+            ('expense', 'update', row.id, {
+                'category_id': row.category_id, 'amount': str(row.amount), 'date': str(row.date)
+            })
+            for row in rows
+        ])
+        conn.commit()
+        _refresh_local_replica(user_id, conn)
+        return True, f"Updated {len(rows)} expenses", rows
+    except mysql.connector.Error as e:
+        conn.rollback()
+        print(f"Error bulk updating expenses: {e}")
+        return False, f"Database error: {e}", []
+    finally:
+        conn.close()
+
+# --- Tags ---
+
+_TAG_KEYWORDS = ("and", "or", "not")
+
+def _normalize_tags(names):
+    """Lower-case and de-duplicate tag names, raising ValueError for unusable ones."""
+    tags = []
+    for name in names:
+        name = name.strip().lower()
+        if not name:
+            continue
+        if any(c.isspace() or c in "()," for c in name) or name in _TAG_KEYWORDS or len(name) > 64:
+            raise ValueError(
+                f"Invalid tag '{name}': tags can't contain spaces, commas or parentheses, "
+                f"be longer than 64 characters, or be AND/OR/NOT"
+            )
+        if name not in tags:
+            tags.append(name)
+    return tags
+
+def parse_tags(text):
+    """Split comma- or space-separated tag names, e.g. "trip-2026, reimbursable"."""
+    return _normalize_tags(text.replace(",", " ").split())
+
+def parse_tag_query(text):
+    """Parse a tag query such as "trip-2026 AND (food OR taxi) AND NOT reimbursable".
+    
+    AND binds tighter than OR, and tags written next to each other are ANDed.
+    Keywords are case-insensitive.
+    
+    Returns:
+        tuple: ('tag', name), ('not', query), ('and', left, right) or
+        ('or', left, right), or None for an empty query.
+    
+    Raises:
+        ValueError: If the query doesn't parse.
+    """
+    tokens = text.replace("(", " ( ").replace(")", " ) ").split()
+    if not tokens:
+        return None
+    position = 0
+    
+    def peek():
+        return tokens[position].lower() if position < len(tokens) else None
+    
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+    
+    def parse_or():
+        query = parse_and()
+        while peek() == "or":
+            take()
+            query = ('or', query, parse_and())
+        return query
+    
+    def parse_and():
+        query = parse_not()
+        while peek() not in (None, "or", ")"):
+            if peek() == "and":
+                take()
+            query = ('and', query, parse_not())
+        return query
+    
+    def parse_not():
+        token = peek()
+        if token == "not":
+            take()
+            return ('not', parse_not())
+        if token == "(":
+            take()
+            query = parse_or()
+            if peek() != ")":
+                raise ValueError("Missing ')' in tag query")
+            take()
+            return query
+        if token in (None, ")", "and", "or"):
+            raise ValueError(f"Expected a tag {'at the end' if token is None else f'before {token.upper()}'}")
+        return ('tag', _normalize_tags([take()])[0])
+    
+    query = parse_or()
+    if position < len(tokens):
+        raise ValueError(f"Unexpected '{tokens[position]}' in tag query")
+    return query
+
+def _tag_query_sql(query, user_id, placeholder="%s"):
+    """Compile a parsed tag query into a condition on expenses aliased as e.
+    
+    Returns:
+        tuple: (sql, params)
+    """
+    kind = query[0]
+    if kind == 'tag':
+        return (
+            f"e.id IN (SELECT et.expense_id FROM expense_tags et JOIN tags t ON t.id = et.tag_id "
+            f"WHERE t.user_id = {placeholder} AND t.name = {placeholder})",
+            [user_id, query[1]]
+        )
+    if kind == 'not':
+        sql, params = _tag_query_sql(query[1], user_id, placeholder)
+        return f"NOT {sql}", params
+    left, left_params = _tag_query_sql(query[1], user_id, placeholder)
+    right, right_params = _tag_query_sql(query[2], user_id, placeholder)
+    return f"({left} {kind.upper()} {right})", left_params + right_params
+
+def _fetch_expense_tags(cursor, expense_ids):
+    """Return {expense_id: [(tag_id, name), ...]} for expenses that have tags."""
+    placeholders, ids = _id_list(expense_ids)
+    if not ids:
+        return {}
+    cursor.execute(f"""
+        SELECT et.expense_id, t.id, t.name
+        FROM expense_tags et JOIN tags t ON t.id = et.tag_id
+        WHERE et.expense_id IN ({placeholders})
+        ORDER BY t.name
+    """, ids)
+    tags = {}
+    for expense_id, tag_id, name in cursor.fetchall():
+        tags.setdefault(expense_id, []).append((tag_id, name))
+    return tags
+
+def _write_expense_tags(cursor, user_id, expense_ids, add=(), remove=()):
+    """Add and remove tags on expenses and record each expense's new tags in the
+    change log. Missing tags are created."""
+    placeholders, ids = _id_list(expense_ids)
+    add, remove = list(add), [name for name in remove if name not in add]
+    if not ids or not (add or remove):
+        return
+    if add:
+        cursor.executemany("INSERT IGNORE INTO tags (user_id, name) VALUES (%s, %s)", [(user_id, name) for name in add])
+    names = add + remove
+    cursor.execute(
+        f"SELECT name, id FROM tags WHERE user_id = %s AND name IN ({', '.join(['%s'] * len(names))})",
+        [user_id] + names
+    )
+    tag_ids = dict(cursor.fetchall())
+    if add:
+        cursor.executemany(
+            "INSERT IGNORE INTO expense_tags (tag_id, expense_id) VALUES (%s, %s)",
+            [(tag_ids[name], expense_id) for name in add for expense_id in ids]
+        )
+    remove_ids = [tag_ids[name] for name in remove if name in tag_ids]
+    if remove_ids:
+        cursor.execute(
+            f"DELETE FROM expense_tags WHERE expense_id IN ({placeholders}) "
+            f"AND tag_id IN ({', '.join(['%s'] * len(remove_ids))})",
+            ids + remove_ids
+        )
+    # The replica replaces the expense's tags with 'tags'; the tag index applies
+    # 'added' and 'removed' to its bitmaps
+    current = _fetch_expense_tags(cursor, ids)
+    _log_changes(cursor, user_id, [
+        ('expense_tags', 'update', expense_id, {
+            'tags': current.get(expense_id, []), 'added': add, 'removed': remove
+        })
+        for expense_id in ids
+    ])
+
+def tag_expenses(user_id, expense_ids, add=(), remove=()):
+    """Add and/or remove tags on many of a user's expenses in one transaction.
+    
+    Args:
+        add: Tag names to add (created if they don't exist yet).
+        remove: Tag names to remove.
+    
+    Returns:
+        tuple: (success, message)
+    """
+    try:
+        add, remove = _normalize_tags(add), _normalize_tags(remove)
+    except ValueError as e:
+        return False, str(e)
+    if not expense_ids:
+        return False, "No expenses selected"
     conn = get_db_connection()
+    if not conn:
+        return False, "Database connection failed"
+    placeholders, ids = _id_list(expense_ids)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT id FROM expenses WHERE user_id = %s AND id IN ({placeholders}) "
+            f"UNION ALL SELECT id FROM expenses_archive WHERE user_id = %s AND id IN ({placeholders})",
+            [user_id] + ids + [user_id] + ids
+        )
+        owned = [row[0] for row in cursor.fetchall()]
+        if not owned:
+            return False, "Expenses not found"
+        _write_expense_tags(cursor, user_id, owned, add, remove)
+        conn.commit()
+        _refresh_local_replica(user_id, conn)
+        return True, f"Updated tags on {len(owned)} expenses"
+    except mysql.connector.Error as e:
+        conn.rollback()
+        print(f"Error tagging expenses: {e}")
+        return False, f"Database error: {e}"
+    finally:
+        conn.close()
+
+def get_tags(user_id):
+    """Get the names of a user's tags."""
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_tags(user_id)
+    conn = get_read_connection(user_id)
+    if not conn:
+        return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM tags WHERE user_id = %s ORDER BY name", (user_id,))
+        return [name for (name,) in cursor.fetchall()]
+    except mysql.connector.Error as e:
+        print(f"Error getting tags: {e}")
+        return []
+    finally:
+        conn.close()
+
+def get_expense_tags(user_id, expense_ids):
+    """Get the tag names of a user's expenses.
+    
+    Returns:
+        dict: expense_id -> sorted list of tag names (expenses without tags are left out).
+    """
+    if not expense_ids:
+        return {}
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_expense_tags(user_id, expense_ids)
+    conn = get_read_connection(user_id)
     if not conn:
         return {}
     try:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT c.name, SUM(e.amount)
-            FROM expenses e
-            JOIN categories c ON e.category_id = c.id
-            GROUP BY c.name
-        """)
-        return dict(cursor.fetchall())
+        return {
+            expense_id: [name for _, name in tags]
+            for expense_id, tags in _fetch_expense_tags(cursor, expense_ids).items()
+        }
     except mysql.connector.Error as e:
-        print(f"Error fetching totals: {e}")
+        print(f"Error getting expense tags: {e}")
         return {}
     finally:
         conn.close()
 
-# Add these functions for handling category limits after the get_category_totals function
-def set_category_limit(category_id, limit_amount):
-    """Set or update a spending limit for a category."""
-    print(f"Setting limit for category ID {category_id} to Rs{limit_amount}")
-    conn = get_db_connection()
-    if not conn:
-        print("Database connection failed in set_category_limit")
-        return False, "Database connection failed"
+# --- Payees ---
+
+def _normalize_payee(name):
+    """Return (display name, normalized name) for a payee name.
+    
+    The display name is the name with runs of whitespace collapsed; the normalized
+    name, which identifies the payee, is also case-folded with punctuation
+    dropped, so "Starbucks", "STARBUCKS " and "Starbucks." are one payee.
+    
+    Raises:
+        ValueError: If the name is empty or too long.
+    """
+    display = " ".join(str(name or "").split())
+    normalized = " ".join("".join(ch if ch.isalnum() else " " for ch in display.casefold()).split())
+    if not normalized:
+        raise ValueError("Payee name must contain a letter or digit")
+    if len(display) > 128:
+        raise ValueError("Payee names are limited to 128 characters")
+    return display, normalized
+
+def _payee_id(cursor, user_id, name):
+    """Return the ID of the user's payee with this name, creating it if needed."""
+    display, normalized = _normalize_payee(name)
+    cursor.execute(
+        "INSERT IGNORE INTO payees (user_id, name, normalized_name) VALUES (%s, %s, %s)",
+        (user_id, display, normalized)
+    )
+    if cursor.rowcount:
+        payee_id = cursor.lastrowid
+        _log_change(cursor, user_id, 'payee', 'insert', payee_id, {'name': display, 'normalized_name': normalized})
+        return payee_id
+    cursor.execute(
+        "SELECT id FROM payees WHERE user_id = %s AND normalized_name = %s", (user_id, normalized)
+    )
+    return cursor.fetchone()[0]
+
+def _expense_tables(cursor, start_date=None):
+    """Return the tables holding expenses from start_date onwards.
+    
+    Like _expense_source, but for queries that aggregate each table separately so
+    they can use its indexes (a UNION ALL derived table has none).
+    """
+    boundary = _get_archive_boundary(cursor)
+    if boundary and (not start_date or str(start_date) < boundary):
+        return ("expenses", "expenses_archive")
+    return ("expenses",)
+
+def get_payees(user_id):
+    """Get a user's payees with how many expenses each has.
+    
+    Returns:
+        list: (payee_id, name, expense_count) tuples sorted by name.
+    """
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_payees(user_id)
+    conn = get_read_connection(user_id)
+    if not conn:
+        return []
+    try:
+        cursor = conn.cursor()
+        counts = {}
+        for table in _expense_tables(cursor):
+            cursor.execute(
+                f"SELECT payee_id, COUNT(*) FROM {table} "
+                f"WHERE user_id = %s AND payee_id IS NOT NULL GROUP BY payee_id",
+                (user_id,)
+            )
+            for payee_id, count in cursor.fetchall():
+                counts[payee_id] = counts.get(payee_id, 0) + count
+        cursor.execute("SELECT id, name FROM payees WHERE user_id = %s ORDER BY name", (user_id,))
+        return [(payee_id, name, counts.get(payee_id, 0)) for payee_id, name in cursor.fetchall()]
+    except mysql.connector.Error as e:
+        print(f"Error getting payees: {e}")
+        return []
+    finally:
+        conn.close()
+
+def get_payee_totals(user_id, start_date=None, end_date=None):
+    """Get how much a user spent at each payee in a date range.
+    
+    Returns:
+        list: (payee_id, name, total, expense_count) tuples, largest total first.
+    """
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_payee_totals(user_id, start_date, end_date)
+    conn = get_read_connection(user_id)
+    if not conn:
+        return []
+    try:
+        cursor = conn.cursor()
+        totals = {}
+        for table in _expense_tables(cursor, start_date):
+            query = (
+                f"SELECT payee_id, SUM(amount), COUNT(*) FROM {table} "
+                f"WHERE user_id = %s AND payee_id IS NOT NULL"
+            )
+            params = [user_id]
+            if start_date:
+                query += " AND date >= %s"
+                params.append(str(start_date))
+            if end_date:
+                query += " AND date <= %s"
+                params.append(str(end_date))
+            cursor.execute(query + " GROUP BY payee_id", params)
+            for payee_id, total, count in cursor.fetchall():
+                old_total, old_count = totals.get(payee_id, (Money(), 0))
+                totals[payee_id] = (old_total + Money.of(total), old_count + count)
+        cursor.execute("SELECT id, name FROM payees WHERE user_id = %s", (user_id,))
+        names = dict(cursor.fetchall())
+        return sorted(
+            ((payee_id, names[payee_id], total, count)
+             for payee_id, (total, count) in totals.items() if payee_id in names),
+            key=lambda row: (-row[2], row[1])
+        )
+    except mysql.connector.Error as e:
+        print(f"Error getting payee totals: {e}")
+        return []
+    finally:
+        conn.close()
+
+def get_payee_month_totals(user_id, payee_id, start_date=None):
+    """Get a payee's spending per month.
+    
+    Returns:
+        list: (month_index, total) tuples in month order, for months with spending
+        (see _month_index).
+    """
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_payee_month_totals(user_id, payee_id, start_date)
+    conn = get_read_connection(user_id)
+    if not conn:
+        return []
+    try:
+        cursor = conn.cursor()
+        totals = {}
+        for table in _expense_tables(cursor, start_date):
+            query = (
+                f"SELECT YEAR(date) * 12 + MONTH(date) - 1, SUM(amount) FROM {table} "
+                f"WHERE user_id = %s AND payee_id = %s"
+            )
+            params = [user_id, payee_id]
+            if start_date:
+                query += " AND date >= %s"
+                params.append(str(start_date))
+            cursor.execute(query + " GROUP BY 1", params)
+            for month, total in cursor.fetchall():
+                totals[month] = totals.get(month, Money()) + Money.of(total)
+        return sorted(totals.items())
+    except mysql.connector.Error as e:
+        print(f"Error getting payee trend: {e}")
+        return []
+    finally:
+        conn.close()
+
+# --- Duplicate Detection ---
+
+def find_duplicate_expenses(user_id, candidates, near_days=None):
+    """Find stored expenses that would-be expenses duplicate.
+    
+    Each candidate's fingerprint is looked up on the (user_id, fingerprint, date)
+    index, all candidates together in batches of 1000, limited to the dates
+    near_days around them. A stored expense is the exact duplicate of at most one
+    candidate (in order), so importing a statement with two identical rows only
+    reports both when two such expenses are already stored.
+    
+    Args:
+        candidates: (category_id, amount, date, payee, reference) tuples; payee
+            and reference may be None.
+        near_days: How many days apart near-duplicates can be (default
+            DUPLICATE_CONFIG['near_days']).
+    
+    Returns:
+        list: For each candidate, a list of (expense_id, date, exact) for the
+        stored expenses it duplicates, exact ones first. Empty lists if the
+        database can't be reached.
+    """
+    near_days = DUPLICATE_CONFIG.get("near_days", 3) if near_days is None else near_days
+    results = [[] for _ in candidates]
+    if not candidates:
+        return results
+    keyed = []
+    for category_id, amount, date, payee, reference in candidates:
+        try:
+            fingerprint = _expense_fingerprint(category_id, amount, payee, reference)
+        except ValueError:
+            fingerprint = None
+        keyed.append((fingerprint, datetime.strptime(str(date)[:10], "%Y-%m-%d").date()))
+    dates = [date for _, date in keyed]
+    first, last = min(dates) - timedelta(days=near_days), max(dates) + timedelta(days=near_days)
+    fingerprints = sorted({fingerprint for fingerprint, _ in keyed if fingerprint is not None})
+    
+    conn = get_read_connection(user_id, quiet=True)
+    if not conn:
+        return results
+    try:
+        cursor = conn.cursor()
+        stored = {}
+        for table in _expense_tables(cursor, first):
+            for start in range(0, len(fingerprints), 1000):
+                chunk = fingerprints[start:start + 1000]
+                cursor.execute(
+                    f"SELECT fingerprint, id, date FROM {table} WHERE user_id = %s "
+                    f"AND fingerprint IN ({', '.join(['%s'] * len(chunk))}) AND date BETWEEN %s AND %s",
+                    [user_id] + chunk + [first, last]
+                )
+                for fingerprint, expense_id, date in cursor.fetchall():
+                    stored.setdefault(fingerprint, []).append((expense_id, date))
+    except mysql.connector.Error as e:
+        print(f"Error checking for duplicate expenses: {e}")
+        return results
+    finally:
+        conn.close()
+    
+    claimed = set()
+    for result, (fingerprint, date) in zip(results, keyed):
+        for expense_id, stored_date in stored.get(fingerprint, ()):
+            if stored_date == date:
+                if expense_id not in claimed:
+                    claimed.add(expense_id)
+                    result.insert(0, (expense_id, stored_date, True))
+            elif abs((stored_date - date).days) <= near_days:
+                result.append((expense_id, stored_date, False))
+    return results
+
+def _describe_duplicates(matches):
+    """Short text for find_duplicate_expenses matches, e.g. "Same as #12"."""
+    exact = [f"#{expense_id}" for expense_id, _, is_exact in matches if is_exact]
+    if exact:
+        return f"Same as {', '.join(exact)}"
+    return "Like " + ", ".join(f"#{expense_id} on {date}" for expense_id, date, _ in matches)
+
+# --- Category Rules ---
+
+RULE_KINDS = ("substring", "regex", "payee", "amount")
+
+def _validate_rule(kind, pattern, min_amount, max_amount):
+    """Return the rule's stored pattern and amount bounds.
+    
+    Raises:
+        ValueError: If the rule can't match anything or its regex doesn't compile.
+    """
+    if kind not in RULE_KINDS:
+        raise ValueError(f"Unknown rule type '{kind}'")
+    pattern = " ".join(str(pattern or "").split())
+    try:
+        min_amount = Money.of(min_amount) if min_amount not in (None, "") else None
+        max_amount = Money.of(max_amount) if max_amount not in (None, "") else None
+    except ValueError:
+        raise ValueError("Amounts must be numbers")
+    if min_amount is not None and max_amount is not None and min_amount > max_amount:
+        raise ValueError("The minimum amount is larger than the maximum")
+    if kind == "amount":
+        if min_amount is None and max_amount is None:
+            raise ValueError("Amount rules need a minimum or a maximum amount")
+        return "", min_amount, max_amount
+    if not pattern:
+        raise ValueError("Enter the text to match")
+    if len(pattern) > 255:
+        raise ValueError("Patterns are limited to 255 characters")
+    if kind == "regex":
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f"Invalid regular expression: {e}")
+    elif kind == "payee":
+        pattern = _normalize_payee(pattern)[1]
+    else:
+        pattern = pattern.casefold()
+    return pattern, min_amount, max_amount
+
+def _describe_rule(rule):
+    """Short human-readable form of a rule, e.g. "contains 'uber', Rs5.00-30.00"."""
+    text = {
+        "substring": f"contains '{rule['pattern']}'",
+        "regex": f"matches /{rule['pattern']}/",
+        "payee": f"payee is '{rule['pattern']}'",
+        "amount": "amount",
+    }[rule['kind']]
+    low, high = rule['min_amount'], rule['max_amount']
+    if low is not None and high is not None:
+        text += f", Rs{low:.2f}-{high:.2f}"
+    elif low is not None:
+        text += f", Rs{low:.2f} or more"
+    elif high is not None:
+        text += f", up to Rs{high:.2f}"
+    return text
+
+def get_category_rules(user_id):
+    """Get a user's categorization rules in priority order (first match wins).
+    
+    Returns:
+        list: dicts with id, kind, pattern, category_id, category, min_amount,
+        max_amount and priority.
+    """
+    conn = get_read_connection(user_id)
+    if not conn:
+        return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT r.id, r.kind, r.pattern, r.category_id, c.name, r.min_amount, r.max_amount, r.priority
+            FROM category_rules r JOIN categories c ON c.id = r.category_id AND c.deleted_at IS NULL
+            WHERE r.user_id = %s
+            ORDER BY r.priority, r.id
+        """, (user_id,))
+        return [
+            {
+                'id': rule_id, 'kind': kind, 'pattern': pattern, 'category_id': category_id,
+                'category': category, 'priority': priority,
+                'min_amount': Money.of(low) if low is not None else None,
+                'max_amount': Money.of(high) if high is not None else None,
+            }
+            for rule_id, kind, pattern, category_id, category, low, high, priority in cursor.fetchall()
+        ]
+    except mysql.connector.Error as e:
+        print(f"Error getting category rules: {e}")
+        return []
+    finally:
+        conn.close()
+
+def add_category_rule(user_id, category_id, kind, pattern="", min_amount=None, max_amount=None):
+    """Add a rule assigning matching imported rows to a category, after the
+    user's existing rules.
+    
+    Args:
+        kind: 'substring' (description contains pattern, ignoring case), 'regex'
+            (description matches the regular expression), 'payee' (the row's
+            payee is pattern) or 'amount' (only the amount bounds apply).
+        min_amount, max_amount: Optional inclusive bounds the amount must be
+            within for the rule to match (for any kind).
+    
+    Returns:
+        tuple: (success, message)
+    """
+    try:
+        pattern, min_amount, max_amount = _validate_rule(kind, pattern, min_amount, max_amount)
+    except ValueError as e:
+        return False, str(e)
+    conn = get_db_connection()
+    if not conn:
+        return False, "Database connection failed"
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id FROM categories WHERE id = %s AND user_id = %s AND deleted_at IS NULL",
+            (category_id, user_id)
+        )
+        if not cursor.fetchone():
+            return False, "Category does not exist"
+        cursor.execute("SELECT COALESCE(MAX(priority), 0) + 1 FROM category_rules WHERE user_id = %s", (user_id,))
+        priority = cursor.fetchone()[0]
+        cursor.execute(
+            "INSERT INTO category_rules (user_id, category_id, kind, pattern, min_amount, max_amount, priority) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+            (user_id, category_id, kind, pattern, min_amount and min_amount.to_decimal(),
+             max_amount and max_amount.to_decimal(), priority)
+        )
+        conn.commit()
+        _note_primary_write(user_id)
+        return True, "Rule added"
+    except mysql.connector.Error as e:
+        conn.rollback()
+        return False, f"Database error: {e}"
+    finally:
+        conn.close()
+
+def remove_category_rule(user_id, rule_id):
+    """Remove one of a user's rules. Returns (success, message)."""
+    conn = get_db_connection()
+    if not conn:
+        return False, "Database connection failed"
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM category_rules WHERE id = %s AND user_id = %s", (rule_id, user_id))
+        conn.commit()
+        _note_primary_write(user_id)
+        return (True, "Rule removed") if cursor.rowcount else (False, "Rule not found")
+    except mysql.connector.Error as e:
+        conn.rollback()
+        return False, f"Database error: {e}"
+    finally:
+        conn.close()
+
+def move_category_rule(user_id, rule_id, offset):
+    """Swap a rule's priority with the rule `offset` (-1 or 1) places away.
+    Returns (success, message)."""
+    conn = get_db_connection()
+    if not conn:
+        return False, "Database connection failed"
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, priority FROM category_rules WHERE user_id = %s ORDER BY priority, id FOR UPDATE",
+            (user_id,)
+        )
+        rules = cursor.fetchall()
+        position = next((i for i, (other_id, _) in enumerate(rules) if other_id == rule_id), None)
+        if position is None:
+            return False, "Rule not found"
+        other = position + offset
+        if not 0 <= other < len(rules):
+            return False, "Rule is already at the end"
+        # Renumber so ties from concurrent adds can't make the swap a no-op
+        order = [other_id for other_id, _ in rules]
+        order[position], order[other] = order[other], order[position]
+        cursor.executemany(
+            "UPDATE category_rules SET priority = %s WHERE id = %s",
+            [(priority, other_id) for priority, other_id in enumerate(order, 1)]
+        )
+        conn.commit()
+        _note_primary_write(user_id)
+        return True, "Rule moved"
+    except mysql.connector.Error as e:
+        conn.rollback()
+        return False, f"Database error: {e}"
+    finally:
+        conn.close()
+
+class CategoryRuleMatcher:
+    """A user's rules compiled into one matcher for categorizing imported rows.
+    
+    Rules keep their priority order and the first matching rule wins. All
+    substring rules are compiled into one Aho-Corasick automaton (as a DFA, so
+    each character of a description is a single dict lookup whatever the number
+    of rules). All regex rules are joined into one alternation that rules out
+    most descriptions in a single search, and only descriptions it matches are
+    tried against each regex. Payee rules are a dict lookup on the normalized
+    payee. Statements repeat the same descriptions, so the rules a description
+    and payee could match are remembered (up to IMPORT_CONFIG['match_cache_size'])
+    and only the amount bounds, held as cents, are checked again for each row.
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._low = [_to_cents(rule['min_amount']) if rule['min_amount'] is not None else -math.inf
+                     for rule in self.rules]
+        self._high = [_to_cents(rule['max_amount']) if rule['max_amount'] is not None else math.inf
+                      for rule in self.rules]
+        self._payees = {}
+        self._amount_only = []
+        substrings, regexes = [], []
+        for index, rule in enumerate(self.rules):
+            if rule['kind'] == 'substring':
+                substrings.append((rule['pattern'].casefold(), index))
+            elif rule['kind'] == 'regex':
+                regexes.append((re.compile(rule['pattern'], re.IGNORECASE), index))
+            elif rule['kind'] == 'payee':
+                self._payees.setdefault(rule['pattern'], []).append(index)
+            else:
+                self._amount_only.append(index)
+        self._delta, self._out = self._build_automaton(substrings)
+        self._regexes = regexes
+        self._any_regex = None
+        if regexes:
+            try:
+                self._any_regex = re.compile(
+                    "|".join(f"(?:{regex.pattern})" for regex, _ in regexes), re.IGNORECASE
+                )
+            except re.error:
+                # Patterns with numbered backreferences can't be joined; try each
+                pass
+        self._cache = {}
+        self._cache_size = IMPORT_CONFIG.get("match_cache_size", 100000)
+    
+    @staticmethod
+    def _build_automaton(patterns):
+        """Return (transitions, outputs) of the Aho-Corasick DFA for (text, rule_index) pairs.
+        
+        transitions[state] maps a character to the next state (missing means the
+        root); outputs[state] is the sorted rule indexes of every pattern ending there.
+        """
+        goto, out = [{}], [set()]
+        for text, index in patterns:
+            state = 0
+            for ch in text:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    out.append(set())
+                state = nxt
+            out[state].add(index)
+        
+        # Breadth-first, so each state's failure state is complete before it is used
+        fail = [0] * len(goto)
+        delta = [dict(goto[0])] + [None] * (len(goto) - 1)
+        queue = list(goto[0].values())
+        for state in queue:
+            delta[state] = dict(delta[fail[state]])
+            delta[state].update(goto[state])
+            out[state] |= out[fail[state]]
+            for ch, child in goto[state].items():
+                fail[child] = delta[fail[state]].get(ch, 0) if state else 0
+                queue.append(child)
+        return delta, [tuple(sorted(indexes)) for indexes in out]
+    
+    def _candidates(self, description, payee):
+        """Sorted indexes of the rules a row could match, leaving out amounts."""
+        delta, out = self._delta, self._out
+        found = set(self._amount_only)
+        state = 0
+        for ch in description.casefold():
+            state = delta[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        if self._regexes and (self._any_regex is None or self._any_regex.search(description)):
+            found.update(index for regex, index in self._regexes if regex.search(description))
+        if payee and self._payees:
+            try:
+                found.update(self._payees.get(_normalize_payee(payee)[1], ()))
+            except ValueError:
+                pass
+        return tuple(sorted(found))
+    
+    def match(self, description, amount, payee=None):
+        """Return the first rule matching a row, or None."""
+        key = (description, payee)
+        candidates = self._cache.get(key)
+        if candidates is None:
+            candidates = self._candidates(description or "", payee)
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            self._cache[key] = candidates
+        low, high = self._low, self._high
+        cents = _to_cents(amount)
+        for index in candidates:
+            if low[index] <= cents <= high[index]:
+                return self.rules[index]
+        return None
+    
+    def categorize(self, rows):
+        """Return the matching rule (or None) for each row dict with description,
+        amount and payee."""
+        match = self.match
+        return [match(row['description'], row['amount'], row.get('payee')) for row in rows]
+
+def _find_column(header, names):
+    for position, title in enumerate(header):
+        if title.strip().casefold() in names:
+            return position
+    return None
+
+# Currency symbols and codes allowed in front of a statement amount
+_CURRENCY_PREFIX = re.compile(r"^(?:rs\.?|inr|usd|eur|gbp|[₹$€£])\s*", re.IGNORECASE)
+
+def _parse_statement_amount(text):
+    """Parse "1,234.50", "-12.00", "(12.00)" or "Rs. 99" into Money.
+    
+    An empty cell (a deposit row in a separate debit column) is zero.
+    
+    Raises:
+        ValueError: If the text isn't an amount.
+    """
+    text = text.strip()
+    if not text:
+        return Money()
+    negative = text.startswith("(") and text.endswith(")") or text.startswith("-")
+    text = _CURRENCY_PREFIX.sub("", text.strip("()").lstrip("-").strip())
+    negative = negative or text.startswith("-")
+    if text.count(".") > 1:
+        raise ValueError(f"Ambiguous amount: {text}")
+    digits = "".join(ch for ch in text if ch.isdigit() or ch == ".")
+    value = Money.of(digits)
+    return -value if negative else value
+
+def read_statement_csv(path):
+    """Read a bank statement CSV into rows ready to categorize.
+    
+    Columns are found by their header (see IMPORT_CONFIG['columns']); date and
+    amount are required. The date format is the first of
+    IMPORT_CONFIG['date_formats'] that fits every row. If the amounts have both
+    signs, the negative ones are the spending and the rest (deposits, refunds)
+    are skipped.
+    
+    Returns:
+        tuple: (rows, message) where rows is a list of dicts with date
+        (YYYY-MM-DD), amount (positive), description, payee and category (the
+        last two may be empty).
+    
+    Raises:
+        ValueError: If the file doesn't look like a statement.
+    """
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header:
+            raise ValueError("The file is empty")
+        columns = {
+            field: _find_column(header, names) for field, names in IMPORT_CONFIG["columns"].items()
+        }
+        if columns["date"] is None or columns["amount"] is None:
+            raise ValueError("The file needs a date column and an amount column")
+        raw = []
+        for line, record in enumerate(reader, 2):
+            if not any(cell.strip() for cell in record):
+                continue
+            values = {
+                field: record[position].strip() if position is not None and position < len(record) else ""
+                for field, position in columns.items()
+            }
+            try:
+                values["amount"] = _parse_statement_amount(values["amount"])
+            except ValueError:
+                raise ValueError(f"Line {line}: invalid amount '{values['amount']}'")
+            raw.append(values)
+    
+    date_format = next((
+        candidate for candidate in IMPORT_CONFIG["date_formats"]
+        if all(_parses_as_date(row["date"], candidate) for row in raw)
+    ), None)
+    if raw and date_format is None:
+        raise ValueError("The dates aren't in a recognized format (e.g. YYYY-MM-DD or DD/MM/YYYY)")
+    mixed_signs = any(row["amount"] < 0 for row in raw) and any(row["amount"] > 0 for row in raw)
+    rows, skipped = [], 0
+    for row in raw:
+        if row["amount"] == 0 or mixed_signs and row["amount"] > 0:
+            skipped += 1
+            continue
+        row["amount"] = abs(row["amount"])
+        row["date"] = datetime.strptime(row["date"], date_format).strftime("%Y-%m-%d")
+        rows.append(row)
+    message = f"{len(rows)} expenses read"
+    if skipped:
+        message += f", {skipped} deposits or zero rows skipped"
+    return rows, message
+
+def _parses_as_date(text, date_format):
+    try:
+        datetime.strptime(text, date_format)
+        return True
+    except ValueError:
+        return False
+
+class RangeTotalsCache:
+    """Per-user cache of category totals for date ranges.
+    
+    Entries are dropped when an expense delta falls inside their range (or on any
+    change that has no deltas). Change notifications only cover other clients'
+    writes while the local replica is loaded, so without it entries also expire
+    after `ttl` seconds.
+    """
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._entries = {}
+        self._generations = {}
+        # Bumped by invalidations for every user, which also cover users not seen yet
+        self._global_generation = 0
+        self._lock = threading.Lock()
+    
+    def generation(self, user_id):
+        with self._lock:
+            return self._global_generation, self._generations.get(user_id, 0)
+    
+    def get(self, user_id, start_date, end_date, scope=None):
+        with self._lock:
+            entry = self._entries.get((user_id, start_date, end_date, scope))
+        if not entry:
+            return None
+        totals, cached_at = entry
+        if _local_replica(user_id) is None and (datetime.now() - cached_at).total_seconds() > self.ttl:
+            return None
+        return dict(totals)
+    
+    def put(self, user_id, start_date, end_date, totals, generation, scope=None):
+        """Store totals computed while the user's cache was at `generation`.
+        
+        `scope` tells apart different totals over the same range, such as the
+        rollups below each parent category.
+        """
+        with self._lock:
+            if (self._global_generation, self._generations.get(user_id, 0)) == generation:
+                self._entries[(user_id, start_date, end_date, scope)] = (dict(totals), datetime.now())
+    
+    def invalidate(self, user_id, deltas=None):
+        with self._lock:
+            for key in list(self._entries):
+                key_user_id, start_date, end_date, _ = key
+                if user_id is not None and key_user_id != user_id:
+                    continue
+                if deltas is None or any(
+                    (start_date is None or date >= start_date) and (end_date is None or date <= end_date)
+                    for _, date, _ in deltas
+                ):
+                    del self._entries[key]
+            if user_id is None:
+                self._global_generation += 1
+            else:
+                self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+_range_totals_cache = RangeTotalsCache()
+register_expense_listener(_range_totals_cache.invalidate)
+
+def get_category_totals(user_id, start_date=None, end_date=None):
+    """Get a user's total expenses per category, optionally within a date range.
+    
+    The date filter is applied by the database on the (user_id, date) index.
+    Results are cached per range until an expense in that range changes.
+    """
+    start_date = str(start_date) if start_date else None
+    end_date = str(end_date) if end_date else None
+    cached = _range_totals_cache.get(user_id, start_date, end_date)
+    if cached is not None:
+        return cached
+    generation = _range_totals_cache.generation(user_id)
+    
+    replica = _local_replica(user_id)
+    if replica:
+        totals = replica.get_category_totals(user_id, start_date, end_date)
+        _range_totals_cache.put(user_id, start_date, end_date, totals, generation)
+        return totals
+    conn = get_read_connection(user_id)
+    if not conn:
+        return {}
+    try:
+        cursor = conn.cursor()
+        query = f"""
+            SELECT c.name, SUM(e.amount)
+            FROM {_expense_source(cursor, start_date or "1000-01-01")} e
+            JOIN categories c ON e.category_id = c.id AND c.deleted_at IS NULL
+            WHERE e.user_id = %s
+        """
+        params = [user_id]
+        if start_date:
+            query += " AND e.date >= %s"
+            params.append(start_date)
+        if end_date:
+            query += " AND e.date <= %s"
+            params.append(end_date)
+        cursor.execute(query + " GROUP BY c.name", params)
+        totals = {name: Money.of(total) for name, total in cursor.fetchall()}
+        _range_totals_cache.put(user_id, start_date, end_date, totals, generation)
+        return totals
+    except mysql.connector.Error as e:
+        print(f"Error fetching totals: {e}")
+        return {}
+    finally:
+        conn.close()
+
+def get_subtree_totals(user_id, parent_id=None, start_date=None, end_date=None):
+    """Get the spending of each child of a category, rolled up over its subtree.
+    
+    One aggregate over the closure table: every expense is joined to the child of
+    parent_id it falls under, so the cost doesn't depend on how deep the tree is.
+    With parent_id None the children are the top-level categories.
+    
+    Returns:
+        dict: category_id -> (name, total). parent_id itself is included with only
+        its own (direct) expenses, if it has any.
+    """
+    start_date = str(start_date) if start_date else None
+    end_date = str(end_date) if end_date else None
+    scope = ('subtree', parent_id)
+    cached = _range_totals_cache.get(user_id, start_date, end_date, scope)
+    if cached is not None:
+        return cached
+    generation = _range_totals_cache.generation(user_id)
+    
+    replica = _local_replica(user_id)
+    if replica:
+        totals = replica.get_subtree_totals(user_id, parent_id, start_date, end_date)
+        _range_totals_cache.put(user_id, start_date, end_date, totals, generation, scope)
+        return totals
+    conn = get_read_connection(user_id)
+    if not conn:
+        return {}
+    try:
+        cursor = conn.cursor()
+        query = f"""
+            SELECT a.id, a.name, SUM(e.amount)
+            FROM categories a
+            JOIN category_closure cc ON cc.ancestor_id = a.id
+            JOIN categories d ON d.id = cc.descendant_id AND d.deleted_at IS NULL
+            JOIN {_expense_source(cursor, start_date or "1000-01-01")} e ON e.category_id = cc.descendant_id
+            WHERE a.user_id = %s AND a.deleted_at IS NULL
+              AND (a.parent_id <=> %s OR (a.id = %s AND cc.depth = 0))
+        """
+        params = [user_id, parent_id, parent_id]
+        if start_date:
+            query += " AND e.date >= %s"
+            params.append(start_date)
+        if end_date:
+            query += " AND e.date <= %s"
+            params.append(end_date)
+        cursor.execute(query + " GROUP BY a.id, a.name", params)
+        totals = {category_id: (name, Money.of(total)) for category_id, name, total in cursor.fetchall() if total}
+        _range_totals_cache.put(user_id, start_date, end_date, totals, generation, scope)
+        return totals
+    except mysql.connector.Error as e:
+        print(f"Error fetching subtree totals: {e}")
+        return {}
+    finally:
+        conn.close()
+
+# Add these functions for handling category limits after the get_category_totals function
+def set_category_limit(user_id, category_id, limit_amount, period=None, rolling_days=None, carry_over=None):
+    """Set or update a spending limit for a user's category.
+    
+    Args:
+        period: One of BUDGET_PERIODS; None keeps the current period settings
+            (monthly without carry-over for a new limit).
+        rolling_days: Window length for the 'rolling' period.
+        carry_over: Whether unspent budget from the previous period is added to
+            the current one (not used by rolling windows).
+    """
+    print(f"Setting limit for category ID {category_id} to Rs{limit_amount}")
+    try:
+        limit_amount = Money.of(limit_amount or 0)
+    except ValueError:
+        return False, "Invalid limit amount"
+    if period is not None:
+        if period not in BUDGET_PERIODS:
+            return False, f"Unknown budget period '{period}'"
+        if period == 'rolling':
+            try:
+                rolling_days = int(rolling_days)
+            except (ValueError, TypeError):
+                return False, "Rolling budgets need a number of days"
+            if rolling_days < 1:
+                return False, "Rolling budgets need a number of days"
+        else:
+            rolling_days = None
+    conn = get_db_connection()
+    if not conn:
+        print("Database connection failed in set_category_limit")
+        return False, "Database connection failed"
+    
+    try:
+        cursor = conn.cursor()
+        
+        # Check if limit already exists
+        cursor.execute(
+            "SELECT id, period, rolling_days, carry_over FROM category_limits "
+            "WHERE user_id = %s AND category_id = %s",
+            (user_id, category_id)
+        )
+        existing_limit = cursor.fetchone()
+        if period is None:
+            period, rolling_days = existing_limit[1:3] if existing_limit else ('monthly', None)
+        if carry_over is None:
+            carry_over = bool(existing_limit[3]) if existing_limit else False
+        
+        if existing_limit:
+            # Update existing limit
+            print(f"Updating existing limit record {existing_limit[0]}")
+            cursor.execute(
+                "UPDATE category_limits SET limit_amount = %s, period = %s, rolling_days = %s, carry_over = %s "
+                "WHERE user_id = %s AND category_id = %s",
+                (limit_amount.to_decimal(), period, rolling_days, carry_over, user_id, category_id)
+            )
+            message = f"Spending limit updated to Rs{limit_amount:.2f}"
+        else:
+            # Insert new limit
+            print(f"Inserting new limit record")
+            cursor.execute(
+                "SELECT id FROM categories WHERE id = %s AND user_id = %s AND deleted_at IS NULL",
+                (category_id, user_id)
+            )
+            if not cursor.fetchone():
+                return False, "Category does not exist"
+            cursor.execute(
+                "INSERT INTO category_limits (user_id, category_id, limit_amount, period, rolling_days, carry_over) "
+                "VALUES (%s, %s, %s, %s, %s, %s)",
+                (user_id, category_id, limit_amount.to_decimal(), period, rolling_days, carry_over)
+            )
+            message = f"Spending limit set to Rs{limit_amount:.2f}"
+        if limit_amount:
+            message += f" per {_describe_period(period, rolling_days, noun=True)}"
+        _log_change(cursor, user_id, 'category_limit', 'update', category_id, {
+            'limit_amount': str(limit_amount),
+            'period': period,
+            'rolling_days': rolling_days,
+            'carry_over': bool(carry_over)
+        })
+            
+        conn.commit()
+        print(f"Database committed successfully: {message}")
+        _refresh_local_replica(user_id, conn)
+        return True, message
+    except mysql.connector.Error as e:
+        print(f"Database error in set_category_limit: {e}")
+        return False, f"Database error: {e}"
+    finally:
+        conn.close()
+        print("Database connection closed")
+
+def get_category_limit(user_id, category_id):
+    """Get the spending limit for a user's category."""
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_category_limit(user_id, category_id)
+    conn = get_read_connection(user_id)
+    if not conn:
+        return None
+    
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT limit_amount FROM category_limits WHERE user_id = %s AND category_id = %s",
+            (user_id, category_id)
+        )
+        result = cursor.fetchone()
+        return Money.of(result[0]) if result else None
+    except mysql.connector.Error as e:
+        print(f"Error getting category limit: {e}")
+        return None
+    finally:
+        conn.close()
+
+def get_category_spending(user_id, category_id, start_date=None, end_date=None):
+    """Get the total spending (Money) for a user's category with optional date range."""
+    index = _spending_index(user_id)
+    if index:
+        return _from_cents(index.range_total(category_id, start_date, end_date))
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_category_spending(user_id, category_id, start_date, end_date)
+    conn = get_read_connection(user_id)
+    if not conn:
+        return Money()
+    
+    try:
+        cursor = conn.cursor()
+        query = (
+            f"SELECT SUM(amount) FROM {_expense_source(cursor, start_date)} e "
+            f"WHERE user_id = %s AND category_id = %s"
+        )
+        params = [user_id, category_id]
+        
+        if start_date:
+            query += " AND date >= %s"
+            params.append(start_date)
+        if end_date:
+            query += " AND date <= %s"
+            params.append(end_date)
+            
+        cursor.execute(query, params)
+        result = cursor.fetchone()
+        return Money.of(result[0] or 0)
+    except mysql.connector.Error as e:
+        print(f"Error getting category spending: {e}")
+        return Money()
+    finally:
+        conn.close()
+
+# --- Budget Periods ---
+
+BUDGET_PERIODS = ("weekly", "monthly", "quarterly", "yearly", "rolling")
+_PERIOD_MONTHS = {"monthly": 1, "quarterly": 3, "yearly": 12}
+
+def _describe_period(period, rolling_days=None, noun=False):
+    """Human-readable period name: 'Weekly' / 'week', 'Rolling 30-day' / '30 days'."""
+    if period == "rolling":
+        return f"{rolling_days} days" if noun else f"Rolling {rolling_days}-day"
+    if noun:
+        return {"weekly": "week", "monthly": "month", "quarterly": "quarter", "yearly": "year"}[period]
+    return period.capitalize()
+
+def _spent_label(budget):
+    """'Spent this week' / 'Spent in the last 30 days' for a budget's current period."""
+    if budget.period == "rolling":
+        return f"Spent in the last {budget.rolling_days} days"
+    return f"Spent this {_describe_period(budget.period, noun=True)}"
+
+def _budget_window(period, rolling_days=None, today=None, offset=0):
+    """Return the (start, end) dates of a budget period.
+    
+    The period is the one containing `today`, or `offset` periods away from it
+    (-1 for the previous one). Weeks start on Monday, quarters in January, April,
+    July and October; a rolling window is the `rolling_days` days ending today.
+    """
+    today = today or datetime.now().date()
+    if period == "weekly":
+        start = today - timedelta(days=today.weekday(), weeks=-offset)
+        return start, start + timedelta(days=6)
+    if period == "rolling":
+        days = max(int(rolling_days or 30), 1)
+        end = today + timedelta(days=days * offset)
+        return end - timedelta(days=days - 1), end
+    months = _PERIOD_MONTHS[period]
+    first = (today.year * 12 + today.month - 1) // months * months + offset * months
+    after = first + months
+    return (date_type(first // 12, first % 12 + 1, 1),
+            date_type(after // 12, after % 12 + 1, 1) - timedelta(days=1))
+
+def _carries_over(budget):
+    return bool(budget.limit and budget.carry_over and budget.period != 'rolling')
+
+def _budgets_start(budgets, today=None):
+    """Earliest day any of the budgets' current (or carried-over previous) periods starts."""
+    starts = [
+        _budget_window(b.period, b.rolling_days, today, -1 if _carries_over(b) else 0)[0]
+        for b in budgets
+    ]
+    return min(starts) if starts else None
+
+def _evaluate_budgets(budgets, range_total, today=None):
+    """Evaluate each Category's current period, spending and status.
+    
+    `range_total(category_id, start, end)` returns the cents spent in a date range.
+    Backed by a SpendingIndex that is two binary searches per window, so checking
+    every category is one pass whose cost does not depend on the period lengths.
+    
+    Returns:
+        list: A CategoryBudgetStatus for each budget, in the same order.
+    """
+    today = today or datetime.now().date()
+    statuses = []
+    for budget in budgets:
+        start, end = _budget_window(budget.period, budget.rolling_days, today)
+        spent = _from_cents(range_total(budget.id, start, end))
+        carried = Money()
+        if _carries_over(budget):
+            previous = _budget_window(budget.period, None, today, -1)
+            carried = max(budget.limit - _from_cents(range_total(budget.id, *previous)), Money())
+        available = budget.limit + carried if budget.limit else None
+        statuses.append(CategoryBudgetStatus(budget, start, end, spent, carried, available))
+    return statuses
+
+def _budget_rows_to_categories(rows):
+    """Turn (id, name, limit, period, rolling_days, carry_over) rows into Categories.
+    
+    A limit of zero is how a cleared limit is stored, so it reads back as unset.
+    """
+    return [
+        Category(cat_id, name, Money.of(limit) if limit else None, period or 'monthly', rolling_days,
+                 bool(carry_over))
+        for cat_id, name, limit, period, rolling_days, carry_over in rows
+    ]
+
+def _fetch_category_budgets(cursor, user_id, category_ids=None):
+    query = """
+        SELECT c.id, c.name, l.limit_amount, l.period, l.rolling_days, l.carry_over
+        FROM categories c
+        LEFT JOIN category_limits l ON l.category_id = c.id
+        WHERE c.user_id = %s AND c.deleted_at IS NULL
+    """
+    params = [user_id]
+    if category_ids is not None:
+        placeholders, ids = _id_list(category_ids)
+        query += f" AND c.id IN ({placeholders})"
+        params += ids
+    cursor.execute(query + " ORDER BY c.name", params)
+    return _budget_rows_to_categories(cursor.fetchall())
+
+def _fetch_daily_totals(cursor, user_id, start_date=None, category_ids=None):
+    query = f"""
+        SELECT e.category_id, e.date, CAST(ROUND(SUM(e.amount) * 100) AS SIGNED)
+        FROM {_expense_source(cursor, str(start_date) if start_date else "1000-01-01")} e
+        JOIN categories c ON c.id = e.category_id AND c.deleted_at IS NULL
+        WHERE e.user_id = %s
+    """
+    params = [user_id]
+    if start_date:
+        query += " AND e.date >= %s"
+        params.append(str(start_date))
+    if category_ids is not None:
+        placeholders, ids = _id_list(category_ids)
+        query += f" AND e.category_id IN ({placeholders})"
+        params += ids
+    cursor.execute(query + " GROUP BY e.category_id, e.date", params)
+    return [(cat_id, str(day), cents) for cat_id, day, cents in cursor.fetchall()]
+
+def _subtree_range_total(range_total, subtrees):
+    """Wrap a per-category range_total so a category's total covers its subtree.
+    
+    A limit on a parent category applies to everything filed under it.
+    """
+    def total(category_id, start_date, end_date):
+        return sum(range_total(descendant_id, start_date, end_date)
+                   for descendant_id in subtrees.get(category_id, (category_id,)))
+    return total
+
+def _budget_statuses_in_transaction(cursor, user_id, category_ids):
+    """Evaluate budgets inside an open transaction (sees its uncommitted writes)."""
+    budgets = _fetch_category_budgets(cursor, user_id, category_ids)
+    if not budgets:
+        return []
+    subtrees = _fetch_subtrees(cursor, user_id, category_ids)
+    descendant_ids = {d for descendants in subtrees.values() for d in descendants}
+    rows = _fetch_daily_totals(cursor, user_id, _budgets_start(budgets), descendant_ids or category_ids)
+    index = SpendingIndex.from_rows(user_id, rows)
+    return _evaluate_budgets(budgets, _subtree_range_total(index.range_total, subtrees))
+
+def _lock_category_ancestors(cursor, category_ids):
+    """Lock the ancestors of categories whose rows are already locked, and return
+    all of their IDs. A child's expense counts towards every ancestor's limit, so
+    adds anywhere in a subtree are serialized on the ancestors' rows."""
+    placeholders, ids = _id_list(category_ids)
+    cursor.execute(
+        f"SELECT DISTINCT ancestor_id FROM category_closure WHERE descendant_id IN ({placeholders}) "
+        f"ORDER BY ancestor_id",
+        ids
+    )
+    ancestor_ids = [row[0] for row in cursor.fetchall()]
+    placeholders, ids = _id_list(ancestor_ids or ids)
+    cursor.execute(f"SELECT id FROM categories WHERE id IN ({placeholders}) ORDER BY id FOR UPDATE", ids)
+    return [row[0] for row in cursor.fetchall()]
+
+def get_category_budgets(user_id, category_ids=None):
+    """Get a user's categories with their limit settings, sorted by name.
+    
+    Returns:
+        list: Category records. category_ids restricts the result to those
+        categories.
+    """
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_category_budgets(user_id, category_ids)
+    conn = get_read_connection(user_id)
+    if not conn:
+        return []
+    try:
+        return _fetch_category_budgets(conn.cursor(), user_id, category_ids)
+    except mysql.connector.Error as e:
+        print(f"Error getting category budgets: {e}")
+        return []
+    finally:
+        conn.close()
+
+def _evaluate_user_budgets(user_id, budgets):
+    """Evaluate budgets against the user's spending index, or failing that against
+    a transient one built from a single grouped query over the needed days."""
+    subtrees = get_category_subtrees(user_id)
+    index = _spending_index(user_id)
+    if index is None:
+        category_ids = None if len(budgets) > 1 else subtrees.get(budgets[0].id, [budgets[0].id])
+        rows = get_daily_category_totals(user_id, _budgets_start(budgets), category_ids)
+        index = SpendingIndex.from_rows(user_id, rows)
+    return _evaluate_budgets(budgets, _subtree_range_total(index.range_total, subtrees))
+
+def get_budget_status(user_id, category_id):
+    """Get a category's budget for the current period.
+    
+    Returns:
+        CategoryBudgetStatus: The status, or None if the category doesn't exist.
+    """
+    budgets = get_category_budgets(user_id, [category_id])
+    return _evaluate_user_budgets(user_id, budgets)[0] if budgets else None
+
+def check_limit_exceeded(user_id, category_id, current_month=True):
+    """Check if a category's spending exceeds its limit.
+    
+    Args:
+        user_id: The acting user
+        category_id: The category ID to check
+        current_month: If True, only check the current budget period's expenses
+            (against the limit plus any carried-over budget)
+        
+    Returns:
+        tuple: (exceeded, spent, limit) where exceeded is a boolean
+    """
+    if current_month:
+        status = get_budget_status(user_id, category_id)
+        if not status or not status.limit:
+            return False, Money(), Money()  # No limit set
+        return status.exceeded, status.spent, status.available
+    
+    limit = get_category_limit(user_id, category_id)
+    if not limit:
+        return False, Money(), Money()  # No limit set
+    spent = get_category_spending(user_id, category_id)
+    return spent > limit, spent, limit
+
+def get_all_category_limits_with_spending(user_id):
+    """Get all of a user's categories with their budgets and current period spending.
+    
+    Returns:
+        list: CategoryBudgetStatus records, sorted by name.
+    """
+    print("Fetching all categories with limits and spending data")
+    budgets = get_category_budgets(user_id)
+    print(f"Found {len(budgets)} categories")
+    if not budgets:
+        return []
+    return _evaluate_user_budgets(user_id, budgets)
+
+def get_category_month_totals(user_id):
+    """Get a user's spending per category per month with one grouped query.
+    
+    Returns:
+        tuple: (categories, totals) where categories is a list of (id, name) sorted by
+        name and totals a list of (category_id, month_index, cents) with
+        month_index = year * 12 + month - 1.
+    """
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_category_month_totals(user_id)
+    conn = get_read_connection(user_id)
+    if not conn:
+        return [], []
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, name FROM categories WHERE user_id = %s AND deleted_at IS NULL ORDER BY name",
+            (user_id,)
+        )
+        categories = cursor.fetchall()
+        cursor.execute(f"""
+            SELECT e.category_id, YEAR(e.date) * 12 + MONTH(e.date) - 1,
+                   CAST(ROUND(SUM(e.amount) * 100) AS SIGNED)
+            FROM {_expense_source(cursor, "1000-01-01")} e
+            JOIN categories c ON c.id = e.category_id AND c.deleted_at IS NULL
+            WHERE e.user_id = %s
+            GROUP BY 1, 2
+        """, (user_id,))
+        return categories, cursor.fetchall()
+    except mysql.connector.Error as e:
+        print(f"Error getting category month totals: {e}")
+        return [], []
+    finally:
+        conn.close()
+
+def get_daily_category_totals(user_id, start_date=None, category_ids=None):
+    """Get a user's spending per category per day, optionally from start_date on
+    and for the given categories only.
+    
+    Returns:
+        list: (category_id, date 'YYYY-MM-DD', cents) tuples.
+    """
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_daily_category_totals(user_id, start_date, category_ids)
+    conn = get_read_connection(user_id)
+    if not conn:
+        return []
+    try:
+        return _fetch_daily_totals(conn.cursor(), user_id, start_date, category_ids)
+    except mysql.connector.Error as e:
+        print(f"Error getting daily category totals: {e}")
+        return []
+    finally:
+        conn.close()
+
+def get_expense_amounts(user_id):
+    """Get every expense of a user's live categories as (id, category_id, cents, 'YYYY-MM-DD')."""
+    replica = _local_replica(user_id)
+    if replica:
+        return replica.get_expense_amounts(user_id)
+    conn = get_read_connection(user_id)
+    if not conn:
+        return []
+    try:
+        cursor = conn.cursor()
+        result = []
+        for table in ("expenses", "expenses_archive"):
+            cursor.execute(
+                f"SELECT e.id, e.category_id, CAST(ROUND(e.amount * 100) AS SIGNED), e.date FROM {table} e "
+                f"JOIN categories c ON c.id = e.category_id AND c.deleted_at IS NULL "
+                f"WHERE e.user_id = %s",
+                (user_id,)
+            )
+            result.extend((exp_id, cat_id, cents, str(day)) for exp_id, cat_id, cents, day in cursor.fetchall())
+        return result
+    except mysql.connector.Error as e:
+        print(f"Error getting expense amounts: {e}")
+        return []
+    finally:
+        conn.close()
+
+# --- Offline Write Queue ---
+
+class OfflineWriteQueue:
+    """Append-only journal of expense writes made while the database is unreachable.
+    
+    Each operation is written as one JSON line and fsync'd before enqueue returns,
+    so a queued expense survives a crash. Every entry carries an idempotency key;
+    replaying an 'add' that was already applied is skipped instead of inserted twice.
+    """
+    def __init__(self, path, rejected_path=None):
+        self.path = path
+        self.rejected_path = rejected_path
+        self._lock = threading.Lock()
+        self._entries = []
+        if os.path.exists(self.path):
+            self._load()
+    
+    def _load(self):
+        torn = False
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self._entries.append(json.loads(line))
+                except ValueError:
+                    # A torn final line from a crash mid-write; the write never completed
+                    print(f"Skipping unreadable offline queue entry: {line[:80]}")
+                    torn = True
+        if torn:
+            # Rewrite the journal so new entries are not appended to the torn line
+            self._rewrite()
+    
+    def _rewrite(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in self._entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+    
+    @staticmethod
+    def _append_lines(path, entries):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def enqueue(self, op, user_id, **fields):
+        """Durably append an operation ('add', 'update' or 'delete') and return its key."""
+        entry = {
+            'key': str(uuid.uuid4()),
+            'op': op,
+            'user_id': user_id,
+            'queued_at': datetime.now().isoformat(timespec="seconds"),
+            **fields
+        }
+        with self._lock:
+            self._append_lines(self.path, [entry])
+            self._entries.append(entry)
+        print(f"Queued offline {op} operation {entry['key']}")
+        return entry['key']
+    
+    def pending(self):
+        """Return a snapshot of the queued operations, oldest first."""
+        with self._lock:
+            return list(self._entries)
+    
+    def pending_count(self):
+        with self._lock:
+            return len(self._entries)
+    
+    def acknowledge(self, count, rejected=()):
+        """Drop the oldest `count` entries after they were committed to the database.
+        
+        The remaining entries are written to a temporary file which atomically
+        replaces the journal. Rejected entries are appended to the rejected file.
+        """
+        with self._lock:
+            if rejected and self.rejected_path:
+                self._append_lines(self.rejected_path, rejected)
+            self._entries = self._entries[count:]
+            self._rewrite()
+
+OFFLINE_QUEUE = OfflineWriteQueue(OFFLINE_QUEUE_CONFIG["path"], OFFLINE_QUEUE_CONFIG["rejected_path"])
+
+def _apply_queued_write(cursor, entry):
+    """Apply one offline queue entry inside the caller's transaction.
+    
+    Returns:
+        bool: False if the database rejected the operation and it should not be retried.
+    """
+    user_id = entry['user_id']
+    if entry['op'] == 'add':
+        cursor.execute(
+            "SELECT id FROM categories WHERE user_id = %s AND name = %s AND deleted_at IS NULL",
+            (user_id, entry['category'])
+        )
+        result = cursor.fetchone()
+        if not result:
+            print(f"Rejecting queued expense {entry['key']}: category '{entry['category']}' no longer exists")
+            return False
+        expense_id = _insert_expense(cursor, user_id, result[0], entry['amount'], entry['date'], entry['key'],
+                                     entry.get('payee'), entry.get('reference'))
+        if expense_id:
+            _write_expense_tags(cursor, user_id, [expense_id], entry.get('tags', []))
+        return True
+    if entry['op'] == 'update':
+        # An update that changes nothing affects no rows, so check the expense exists instead
+        cursor.execute(
+            "SELECT id FROM expenses WHERE id = %s AND user_id = %s "
+            "UNION ALL SELECT id FROM expenses_archive WHERE id = %s AND user_id = %s",
+            (int(entry['expense_id']), user_id, int(entry['expense_id']), user_id)
+        )
+        if not cursor.fetchall():
+            print(f"Rejecting queued update {entry['key']}: expense {entry['expense_id']} no longer exists")
+            return False
+        _update_expense(cursor, user_id, entry['expense_id'], entry['amount'], entry['date'])
+        return True
+    if entry['op'] == 'delete':
+        # Deleting an expense that is already gone is a successful replay
+        _delete_expense(cursor, user_id, entry['expense_id'])
+        return True
+    print(f"Rejecting queued entry {entry['key']}: unknown operation {entry['op']}")
+    return False
+
+def _is_connection_error(e):
+    """Whether a MySQL error is about the connection or transaction, not the statement.
+    
+    Client errors (2000-2999) mean the connection is gone; a deadlock or lock wait
+    timeout is worth retrying later. Anything else will fail the same way again.
+    """
+    return isinstance(e, mysql.connector.InterfaceError) or 2000 <= (e.errno or 0) < 3000 or e.errno in (1205, 1213)
+
+def drain_offline_queue(queue=None):
+    """Replay queued offline writes in batched transactions.
+    
+    Each entry runs inside a savepoint, so an entry the database refuses (or a
+    malformed one) is rolled back on its own and moved to the rejected file. Stops at the first connection
+    error and leaves the rest queued.
+    
+    Returns:
+        int: Number of operations applied.
+    """
+    queue = queue or OFFLINE_QUEUE
+    entries = queue.pending()
+    if not entries:
+        return 0
+    conn = get_db_connection(quiet=True)
+    if not conn:
+        return 0
+    
+    print(f"\n--- DRAINING OFFLINE QUEUE ({len(entries)} operations) ---")
+    batch_size = OFFLINE_QUEUE_CONFIG.get("batch_size", 200)
+    applied = 0
+    user_ids = set()
+    try:
+        cursor = conn.cursor()
+        for start in range(0, len(entries), batch_size):
+            batch = entries[start:start + batch_size]
+            rejected = []
+            for entry in batch:
+                cursor.execute("SAVEPOINT queued_write")
+                try:
+                    accepted = _apply_queued_write(cursor, entry)
+                except mysql.connector.Error as e:
+                    if _is_connection_error(e):
+                        raise
+                    print(f"Rejecting queued entry {entry.get('key')}: {e}")
+                    accepted = False
+                except (KeyError, TypeError, ValueError) as e:
+                    # A malformed or hand-edited journal entry
+                    print(f"Rejecting malformed queued entry {str(entry)[:80]}: {e!r}")
+                    accepted = False
+                if accepted:
+                    user_ids.add(entry['user_id'])
+                else:
+                    cursor.execute("ROLLBACK TO SAVEPOINT queued_write")
+                    rejected.append(entry)
+            conn.commit()
+            queue.acknowledge(len(batch), rejected)
+            applied += len(batch) - len(rejected)
+        for user_id in user_ids:
+            _refresh_local_replica(user_id, conn)
+        return applied
+    except mysql.connector.Error as e:
+        print(f"Error draining offline queue: {e}")
+        conn.rollback()
+        return applied
+    finally:
+        conn.close()
+        print(f"--- OFFLINE QUEUE DRAINED ({applied} applied) ---\n")
+
+class BackgroundSyncWorker(threading.Thread):
+    """Daemon thread that drains the offline write queue and refreshes the local replica."""
+    def __init__(self, interval=None):
+        super().__init__(name="expensevault-sync", daemon=True)
+        self.interval = interval or OFFLINE_QUEUE_CONFIG.get("drain_interval", 15)
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+    
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.sync_once()
+            except Exception as e:
+                print(f"Error in background sync: {e}")
+            self._wake_event.wait(self.interval)
+            self._wake_event.clear()
+    
+    def sync_once(self):
+        if OFFLINE_QUEUE.pending_count():
+            drain_offline_queue()
+        if LOCAL_REPLICA is not None and LOCAL_REPLICA.active_user_id:
+            LOCAL_REPLICA.sync(LOCAL_REPLICA.active_user_id)
+        if LOCAL_REPLICA is not None:
+            LOCAL_REPLICA.purge_orphans()
+    
+    def wake(self):
+        """Run a sync pass now instead of waiting for the next interval."""
+        self._wake_event.set()
+    
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+SYNC_WORKER = BackgroundSyncWorker()
+
+class CategoryPurgeWorker(threading.Thread):
+    """Daemon thread that purges removed categories in batches.
+    
+    Progress is published in `progress` (category name -> (deleted, total)) for
+    the UI to poll. Anything left unfinished at exit is picked up on the next start.
+    """
+    def __init__(self, interval=None):
+        super().__init__(name="expensevault-purge", daemon=True)
+        self.interval = interval or PURGE_CONFIG.get("interval", 60)
+        self.progress = {}
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+    
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                purge_deleted_categories(self._report, self._stop_event.is_set)
+            except Exception as e:
+                print(f"Error in category purge: {e}")
+            self.progress = {}
+            self._wake_event.wait(self.interval)
+            self._wake_event.clear()
+    
+    def _report(self, name, deleted, total):
+        self.progress = {name: (deleted, total)}
+    
+    def wake(self):
+        self._wake_event.set()
+    
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+CATEGORY_PURGE_WORKER = CategoryPurgeWorker()
+
+# --- Local Read Replica ---
+
+class LocalReplica:
+    """Local SQLite copy of users' categories, expenses and limits.
+    
+    A user is loaded in full from a consistent MySQL snapshot the first time, then
+    kept current by applying their change log entries since the last applied
+    sequence number. The read methods mirror the module-level data functions
+    (same arguments and return shapes), which delegate here once a user is loaded.
+    A restore on the server changes its data epoch, which forces a full reload.
+    """
+    SCHEMA_VERSION = 7
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            parent_id INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_categories_user_name ON categories (user_id, name);
+        CREATE INDEX IF NOT EXISTS idx_categories_user_parent ON categories (user_id, parent_id);
+        CREATE TABLE IF NOT EXISTS category_closure (
+            ancestor_id INTEGER NOT NULL,
+            descendant_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_closure_descendant ON category_closure (descendant_id, depth);
+        CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            payee_id INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_expenses_category_date ON expenses (category_id, date);
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses (user_id, date, category_id);
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_payee ON expenses (user_id, payee_id, date, amount_cents);
+        CREATE TABLE IF NOT EXISTS category_limits (
+            category_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            limit_cents INTEGER NOT NULL,
+            period TEXT NOT NULL DEFAULT 'monthly',
+            rolling_days INTEGER,
+            carry_over INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS tags (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_tags_user_name ON tags (user_id, name);
+        CREATE TABLE IF NOT EXISTS expense_tags (
+            tag_id INTEGER NOT NULL,
+            expense_id INTEGER NOT NULL,
+            PRIMARY KEY (tag_id, expense_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_expense_tags_expense ON expense_tags (expense_id);
+        CREATE TABLE IF NOT EXISTS payees (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            normalized_name TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_payees_user_normalized ON payees (user_id, normalized_name);
+        CREATE TABLE IF NOT EXISTS sync_state (
+            user_id INTEGER PRIMARY KEY,
+            last_seq INTEGER NOT NULL,
+            synced_at TEXT NOT NULL,
+            epoch TEXT
+        );
+        CREATE TABLE IF NOT EXISTS pending_purges (
+            category_id INTEGER PRIMARY KEY
+        );
+    """
+    TABLES = (
+        "categories", "category_closure", "expenses", "category_limits", "tags", "expense_tags", "payees",
+        "sync_state", "pending_purges"
+    )
+    
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # The replica is only a cache, so an older layout is simply rebuilt
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            for table in self.TABLES:
+                self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.conn.executescript(self.SCHEMA)
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self.active_user_id = None
+        self.last_error = None
+        self._state = {}
+        self._epochs = {}
+        for user_id, last_seq, synced_at, epoch in self.conn.execute(
+            "SELECT user_id, last_seq, synced_at, epoch FROM sync_state"
+        ):
+            self._state[user_id] = (last_seq, datetime.fromisoformat(synced_at))
+            self._epochs[user_id] = epoch
+    
+    def is_ready(self, user_id):
+        """Whether the user has been loaded and reads can be served locally."""
+        return user_id in self._state
+    
+    def synced_at(self, user_id):
+        """When the user's data was last confirmed current (None if never loaded)."""
+        state = self._state.get(user_id)
+        return state[1] if state else None
+    
+    def position(self, user_id):
+        """Return (last_seq, epoch) of the user's local copy, or None if not loaded."""
+        state = self._state.get(user_id)
+        return (state[0], self._epochs.get(user_id)) if state else None
+    
+    def paused(self):
+        """Context manager that holds off syncs, e.g. while deriving data from the copy.
+        
+        Changes applied during a derivation would otherwise be counted twice: once in
+        what was read and again when their deltas are delivered.
+        """
+        return self._sync_lock
+    
+    def reset(self):
+        """Discard every user's local copy; they are reloaded on their next sync."""
+        with self._lock, self.conn:
+            for table in self.TABLES:
+                self.conn.execute(f"DELETE FROM {table}")
+            self._state.clear()
+            self._epochs.clear()
+    
+    # -- Synchronisation --
+    
+    def sync(self, user_id, conn=None):
+        """Bring the user's local copy up to date with MySQL.
+        
+        Args:
+            user_id: User to refresh.
+            conn: Optional open MySQL connection to reuse.
+        
+        Returns:
+            bool: Whether the sync succeeded.
+        """
+        own_conn = conn is None
+        with self._sync_lock:
+            if own_conn:
+                conn = get_db_connection(quiet=True)
+            if not conn:
+                self.last_error = _db_state["last_error"] or "Database unavailable"
+                return False
+            try:
+                if self.is_ready(user_id):
+                    self._apply_changes(conn, user_id)
+                else:
+                    self._full_load(conn, user_id)
+                self.last_error = None
+                return True
+            except (mysql.connector.Error, sqlite3.Error) as e:
+                print(f"Error syncing local replica: {e}")
+                self.last_error = str(e)
+                return False
+            finally:
+                if own_conn:
+                    conn.close()
+    
+    def _set_state(self, user_id, last_seq, epoch):
+        synced_at = datetime.now()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sync_state (user_id, last_seq, synced_at, epoch) VALUES (?, ?, ?, ?)",
+            (user_id, last_seq, synced_at.isoformat(timespec="seconds"), epoch)
+        )
+        self._state[user_id] = (last_seq, synced_at)
+        self._epochs[user_id] = epoch
+    
+    @staticmethod
+    def _server_position(cursor, user_id):
+        """Return (change_seq, data_epoch) for the user on the server, or None."""
+        cursor.execute("""
+            SELECT u.change_seq, (SELECT value FROM app_settings WHERE name = 'data_epoch')
+            FROM users u WHERE u.id = %s
+        """, (user_id,))
+        return cursor.fetchone()
+    
+    def _full_load(self, conn, user_id):
+        print(f"\n--- LOADING LOCAL REPLICA FOR USER {user_id} ---")
+        fetch_size = REPLICA_CONFIG.get("fetch_size", 10000)
+        conn.start_transaction(consistent_snapshot=True, readonly=True)
+        try:
+            cursor = conn.cursor()
+            result = self._server_position(cursor, user_id)
+            if not result:
+                raise sqlite3.DataError(f"User {user_id} does not exist")
+            last_seq, epoch = result
+            with self._lock, self.conn:
+                self.conn.execute(
+                    "DELETE FROM category_closure WHERE descendant_id IN (SELECT id FROM categories WHERE user_id = ?)",
+                    (user_id,)
+                )
+                self.conn.execute(
+                    "DELETE FROM expense_tags WHERE tag_id IN (SELECT id FROM tags WHERE user_id = ?)", (user_id,)
+                )
+                for table in ("categories", "expenses", "category_limits", "tags", "payees"):
+                    self.conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+                cursor.execute(
+                    "SELECT id, name, parent_id FROM categories WHERE user_id = %s AND deleted_at IS NULL",
+                    (user_id,)
+                )
+                self.conn.executemany(
+                    "INSERT INTO categories (id, user_id, name, parent_id) VALUES (?, ?, ?, ?)",
+                    [(cat_id, user_id, name, parent_id) for cat_id, name, parent_id in cursor.fetchall()]
+                )
+                self._rebuild_closure(user_id)
+                cursor.execute(
+                    "SELECT category_id, limit_amount, period, rolling_days, carry_over "
+                    "FROM category_limits WHERE user_id = %s",
+                    (user_id,)
+                )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO category_limits "
+                    "(category_id, user_id, limit_cents, period, rolling_days, carry_over) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(cat_id, user_id, _to_cents(amount), period, rolling_days, int(carry_over))
+                     for cat_id, amount, period, rolling_days, carry_over in cursor.fetchall()]
+                )
+                loaded = 0
+                for table in ("expenses", "expenses_archive"):
+                    # Skip expenses of removed categories still waiting to be purged
+                    cursor.execute(
+                        f"SELECT e.id, e.category_id, e.amount, e.date, e.payee_id FROM {table} e "
+                        f"JOIN categories c ON c.id = e.category_id AND c.deleted_at IS NULL "
+                        f"WHERE e.user_id = %s",
+                        (user_id,)
+                    )
+                    while True:
+                        rows = cursor.fetchmany(fetch_size)
+                        if not rows:
+                            break
+                        self.conn.executemany(
+                            "INSERT OR REPLACE INTO expenses (id, user_id, category_id, amount_cents, date, payee_id) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            [(exp_id, user_id, cat_id, _to_cents(amount), str(exp_date), payee_id)
+                             for exp_id, cat_id, amount, exp_date, payee_id in rows]
+                        )
+                        loaded += len(rows)
+                cursor.execute("SELECT id, name FROM tags WHERE user_id = %s", (user_id,))
+                self.conn.executemany(
+                    "INSERT INTO tags (id, user_id, name) VALUES (?, ?, ?)",
+                    [(tag_id, user_id, name) for tag_id, name in cursor.fetchall()]
+                )
+                cursor.execute(
+                    "SELECT et.tag_id, et.expense_id FROM expense_tags et "
+                    "JOIN tags t ON t.id = et.tag_id WHERE t.user_id = %s",
+                    (user_id,)
+                )
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    self.conn.executemany("INSERT INTO expense_tags (tag_id, expense_id) VALUES (?, ?)", rows)
+                cursor.execute("SELECT id, name, normalized_name FROM payees WHERE user_id = %s", (user_id,))
+                self.conn.executemany(
+                    "INSERT INTO payees (id, user_id, name, normalized_name) VALUES (?, ?, ?, ?)",
+                    [(payee_id, user_id, name, normalized) for payee_id, name, normalized in cursor.fetchall()]
+                )
+                self._set_state(user_id, last_seq, epoch)
+            _notify_expense_listeners(user_id, None)
+            print(f"Loaded {loaded} expenses into local replica (seq {last_seq})")
+        finally:
+            conn.rollback()
+    
+    def _apply_changes(self, conn, user_id):
+        cursor = conn.cursor()
+        last_seq = self._state[user_id][0]
+        epoch = self._epochs.get(user_id)
+        position = self._server_position(cursor, user_id)
+        if not position or position[1] != epoch or position[0] < last_seq:
+            # The server data was restored or replaced underneath us
+            conn.rollback()
+            self._full_load(conn, user_id)
+            return
+        while True:
+            changes = _fetch_changes(cursor, user_id, last_seq, REPLICA_CONFIG.get("fetch_size", 10000))
+            deltas = []
+            with self._lock, self.conn:
+                for change in changes:
+                    change_deltas = self._apply_change(user_id, change)
+                    if deltas is not None:
+                        deltas = None if change_deltas is None else deltas + change_deltas
+                    last_seq = change['seq']
+                self._set_state(user_id, last_seq, epoch)
+            if changes:
+                _notify_change_listeners(user_id, changes)
+                _notify_expense_listeners(user_id, deltas)
+            if len(changes) < REPLICA_CONFIG.get("fetch_size", 10000):
+                break
+        conn.rollback()
+    
+    def _apply_change(self, user_id, change):
+        """Apply one change log entry.
+        
+        Returns:
+            list: (category_id, date, cents) deltas to expense totals, or None if
+            the change affects totals in a way deltas can't describe.
+        """
+        entity, operation = change['entity'], change['operation']
+        entity_id, payload = change['entity_id'], change['payload'] or {}
+        deltas = []
+        if entity == 'expense':
+            old = self.conn.execute(
+                "SELECT category_id, date, amount_cents, payee_id FROM expenses WHERE id = ?", (entity_id,)
+            ).fetchone()
+            if old:
+                deltas.append((old[0], old[1], -old[2]))
+            if operation == 'delete':
+                self.conn.execute("DELETE FROM expenses WHERE id = ?", (entity_id,))
+                self.conn.execute("DELETE FROM expense_tags WHERE expense_id = ?", (entity_id,))
+            else:
+                cents = _to_cents(payload['amount'])
+                # Updates don't change the payee, so their entries don't carry it
+                payee_id = payload.get('payee_id', old[3] if old else None)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO expenses (id, user_id, category_id, amount_cents, date, payee_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (entity_id, user_id, payload['category_id'], cents, payload['date'], payee_id)
+                )
+                deltas.append((payload['category_id'], payload['date'], cents))
+        elif entity == 'category':
+            deltas = None
+            if operation == 'delete':
+                # The category's expenses are unreachable once the category row is
+                # gone; purge_orphans deletes them later in batches
+                self.conn.execute("DELETE FROM category_limits WHERE category_id = ?", (entity_id,))
+                self.conn.execute("DELETE FROM categories WHERE id = ?", (entity_id,))
+                self.conn.execute(
+                    "DELETE FROM category_closure WHERE ancestor_id = ? OR descendant_id = ?", (entity_id, entity_id)
+                )
+                self.conn.execute("INSERT OR IGNORE INTO pending_purges (category_id) VALUES (?)", (entity_id,))
+            else:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO categories (id, user_id, name, parent_id) VALUES (?, ?, ?, ?)",
+                    (entity_id, user_id, payload['name'], payload.get('parent_id'))
+                )
+                self._link_closure(entity_id, payload.get('parent_id'))
+        elif entity == 'expense_tags':
+            # The payload carries the expense's full set of tags
+            self.conn.execute("DELETE FROM expense_tags WHERE expense_id = ?", (entity_id,))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tags (id, user_id, name) VALUES (?, ?, ?)",
+                [(tag_id, user_id, name) for tag_id, name in payload['tags']]
+            )
+            self.conn.executemany(
+                "INSERT INTO expense_tags (tag_id, expense_id) VALUES (?, ?)",
+                [(tag_id, entity_id) for tag_id, _ in payload['tags']]
+            )
+        elif entity == 'payee':
+            self.conn.execute(
+                "INSERT OR REPLACE INTO payees (id, user_id, name, normalized_name) VALUES (?, ?, ?, ?)",
+                (entity_id, user_id, payload['name'], payload['normalized_name'])
+            )
+        elif entity == 'category_limit':
+            # Entries logged before budget periods existed carry only the amount
+            self.conn.execute(
+                "INSERT OR REPLACE INTO category_limits "
+                "(category_id, user_id, limit_cents, period, rolling_days, carry_over) VALUES (?, ?, ?, ?, ?, ?)",
+                (entity_id, user_id, _to_cents(payload['limit_amount']), payload.get('period', 'monthly'),
+                 payload.get('rolling_days'), int(payload.get('carry_over', False)))
+            )
+        return deltas
+    
+    def _link_closure(self, category_id, parent_id):
+        """Attach a category's subtree below parent_id, as move_category does on the
+        server: drop the subtree's rows to its old ancestors, then pair every new
+        ancestor with every subtree row."""
+        self.conn.execute(
+            "INSERT OR IGNORE INTO category_closure (ancestor_id, descendant_id, depth) VALUES (?, ?, 0)",
+            (category_id, category_id)
+        )
+        self.conn.execute("""
+            DELETE FROM category_closure
+            WHERE descendant_id IN (SELECT descendant_id FROM category_closure WHERE ancestor_id = ?)
+              AND ancestor_id NOT IN (SELECT descendant_id FROM category_closure WHERE ancestor_id = ?)
+        """, (category_id, category_id))
+        if parent_id is not None:
+            self.conn.execute("""
+                INSERT INTO category_closure (ancestor_id, descendant_id, depth)
+                SELECT up.ancestor_id, down.descendant_id, up.depth + down.depth + 1
+                FROM category_closure up, category_closure down
+                WHERE up.descendant_id = ? AND down.ancestor_id = ?
+            """, (parent_id, category_id))
+    
+    def _rebuild_closure(self, user_id):
+        """Recompute a user's closure rows from the parent links (the tree is small
+        next to the expenses, and category changes are rare)."""
+        self.conn.execute(
+            "DELETE FROM category_closure WHERE descendant_id IN (SELECT id FROM categories WHERE user_id = ?)",
+            (user_id,)
+        )
+        self.conn.execute("""
+            INSERT INTO category_closure (ancestor_id, descendant_id, depth)
+            WITH RECURSIVE tree(ancestor_id, descendant_id, depth) AS (
+                SELECT id, id, 0 FROM categories WHERE user_id = ?
+                UNION ALL
+                SELECT parent.id, tree.descendant_id, tree.depth + 1
+                FROM tree
+                JOIN categories child ON child.id = tree.ancestor_id
+                JOIN categories parent ON parent.id = child.parent_id
+            )
+            SELECT ancestor_id, descendant_id, depth FROM tree
+        """, (user_id,))
+    
+    def purge_orphans(self, batch_size=None):
+        """Delete local expenses of removed categories in short batches."""
+        batch_size = batch_size or PURGE_CONFIG.get("batch_size", 5000)
+        for (category_id,) in self._query("SELECT category_id FROM pending_purges"):
+            while True:
+                with self._lock, self.conn:
+                    ids = [row[0] for row in self.conn.execute(
+                        "SELECT id FROM expenses WHERE category_id = ? LIMIT ?", (category_id, batch_size)
+                    )]
+                    self.conn.executemany("DELETE FROM expense_tags WHERE expense_id = ?", [(i,) for i in ids])
+                    self.conn.executemany("DELETE FROM expenses WHERE id = ?", [(i,) for i in ids])
+                    count = len(ids)
+                    if count < batch_size:
+                        self.conn.execute("DELETE FROM pending_purges WHERE category_id = ?", (category_id,))
+                if count < batch_size:
+                    break
+    
+    # -- Reads (mirror the module-level data functions) --
+    
+    def _query(self, query, params=()):
+        with self._lock:
+            return self.conn.execute(query, params).fetchall()
+    
+    def get_categories(self, user_id):
+        return [name for (name,) in self._query(
+            "SELECT name FROM categories WHERE user_id = ? ORDER BY name", (user_id,)
+        )]
+    
+    def get_category_id(self, user_id, name):
+        rows = self._query("SELECT id FROM categories WHERE user_id = ? AND name = ?", (user_id, name))
+        return rows[0][0] if rows else None
+    
+    def get_expenses(self, user_id, category_name, start_date=None, end_date=None, tag_filter=None):
+        category_id = self.get_category_id(user_id, category_name)
+        if not category_id:
+            return [], Money()
+        query = "SELECT e.id, e.amount_cents, e.date FROM expenses e WHERE e.category_id = ?"
+        params = [category_id]
+        if start_date:
+            query += " AND e.date >= ?"
+            params.append(str(start_date))
+        if end_date:
+            query += " AND e.date <= ?"
+            params.append(str(end_date))
+        if tag_filter:
+            tag_sql, tag_params = _tag_query_sql(tag_filter, user_id, "?")
+            query += f" AND {tag_sql}"
+            params += tag_params
+        rows = self._query(query + " ORDER BY e.date DESC", params)
+        expenses = [Expense(exp_id, category_id, _from_cents(cents), date_type.fromisoformat(exp_date))
+                    for exp_id, cents, exp_date in rows]
+        total = _from_cents(sum(cents for _, cents, _ in rows))
+        return expenses, total
+    
+    def get_category_totals(self, user_id, start_date=None, end_date=None):
+        query = """
+            SELECT c.name, SUM(e.amount_cents)
+            FROM expenses e JOIN categories c ON e.category_id = c.id
+            WHERE e.user_id = ?
+        """
+        params = [user_id]
+        if start_date:
+            query += " AND e.date >= ?"
+            params.append(str(start_date))
+        if end_date:
+            query += " AND e.date <= ?"
+            params.append(str(end_date))
+        return {
+            name: _from_cents(cents)
+            for name, cents in self._query(query + " GROUP BY c.name", params)
+        }
+    
+    def get_category_limit(self, user_id, category_id):
+        rows = self._query(
+            "SELECT limit_cents FROM category_limits WHERE user_id = ? AND category_id = ?",
+            (user_id, category_id)
+        )
+        return _from_cents(rows[0][0]) if rows else None
+    
+    def get_category_spending(self, user_id, category_id, start_date=None, end_date=None):
+        query = "SELECT SUM(amount_cents) FROM expenses WHERE user_id = ? AND category_id = ?"
+        params = [user_id, category_id]
+        if start_date:
+            query += " AND date >= ?"
+            params.append(str(start_date))
+        if end_date:
+            query += " AND date <= ?"
+            params.append(str(end_date))
+        cents = self._query(query, params)[0][0]
+        return _from_cents(cents or 0)
+    
+    def get_category_tree(self, user_id):
+        return _tree_from_paths(self._query("""
+            SELECT cc.descendant_id, a.name, d.parent_id
+            FROM categories d
+            JOIN category_closure cc ON cc.descendant_id = d.id
+            JOIN categories a ON a.id = cc.ancestor_id
+            WHERE d.user_id = ?
+            ORDER BY cc.descendant_id, cc.depth DESC
+        """, (user_id,)))
+    
+    def get_tags(self, user_id):
+        return [name for (name,) in self._query("SELECT name FROM tags WHERE user_id = ? ORDER BY name", (user_id,))]
+    
+    def get_expense_tags(self, user_id, expense_ids):
+        ids = sorted({int(expense_id) for expense_id in expense_ids})
+        tags = {}
+        # In chunks to stay under SQLite's limit on bound parameters
+        for start in range(0, len(ids), 5000):
+            chunk = ids[start:start + 5000]
+            for expense_id, name in self._query(f"""
+                SELECT et.expense_id, t.name FROM expense_tags et JOIN tags t ON t.id = et.tag_id
+                WHERE t.user_id = ? AND et.expense_id IN ({", ".join("?" * len(chunk))})
+                ORDER BY t.name
+            """, [user_id] + chunk):
+                tags.setdefault(expense_id, []).append(name)
+        return tags
+    
+    def get_expense_columns(self, user_id):
+        """All of a user's expenses as (id, category_id, date, cents) rows in ID order."""
+        return self._query(
+            "SELECT id, category_id, date, amount_cents FROM expenses WHERE user_id = ? ORDER BY id", (user_id,)
+        )
+    
+    def get_tag_memberships(self, user_id):
+        """(tag name, expense_id) pairs of a user's tags, grouped by tag in ID order."""
+        return self._query("""
+            SELECT t.name, et.expense_id FROM expense_tags et JOIN tags t ON t.id = et.tag_id
+            WHERE t.user_id = ? ORDER BY t.name, et.expense_id
+        """, (user_id,))
+    
+    def get_payees(self, user_id):
+        return self._query("""
+            SELECT p.id, p.name, COALESCE(c.count, 0)
+            FROM payees p
+            LEFT JOIN (
+                SELECT payee_id, COUNT(*) AS count FROM expenses
+                WHERE user_id = ? AND payee_id IS NOT NULL GROUP BY payee_id
+            ) c ON c.payee_id = p.id
+            WHERE p.user_id = ?
+            ORDER BY p.name
+        """, (user_id, user_id))
+    
+    def get_payee_totals(self, user_id, start_date=None, end_date=None):
+        query = (
+            "SELECT payee_id, SUM(amount_cents) AS cents, COUNT(*) AS count FROM expenses "
+            "WHERE user_id = ? AND payee_id IS NOT NULL"
+        )
+        params = [user_id]
+        if start_date:
+            query += " AND date >= ?"
+            params.append(str(start_date))
+        if end_date:
+            query += " AND date <= ?"
+            params.append(str(end_date))
+        rows = self._query(f"""
+            SELECT p.id, p.name, t.cents, t.count
+            FROM ({query} GROUP BY payee_id) t
+            JOIN payees p ON p.id = t.payee_id
+            ORDER BY t.cents DESC, p.name
+        """, params)
+        return [(payee_id, name, _from_cents(cents), count) for payee_id, name, cents, count in rows]
+    
+    def get_payee_month_totals(self, user_id, payee_id, start_date=None):
+        query = """
+            SELECT CAST(substr(date, 1, 4) AS INTEGER) * 12 + CAST(substr(date, 6, 2) AS INTEGER) - 1,
+                   SUM(amount_cents)
+            FROM expenses
+            WHERE user_id = ? AND payee_id = ?
+        """
+        params = [user_id, payee_id]
+        if start_date:
+            query += " AND date >= ?"
+            params.append(str(start_date))
+        return [(month, _from_cents(cents)) for month, cents in self._query(query + " GROUP BY 1 ORDER BY 1", params)]
+    
+    def get_latest_expense_categories(self, user_id, limit):
+        return self._query(
+            "SELECT category_id FROM expenses WHERE user_id = ? ORDER BY date DESC LIMIT ?",
+            (user_id, limit)
+        )
+    
+    def get_category_subtrees(self, user_id):
+        subtrees = {}
+        for ancestor_id, descendant_id in self._query("""
+            SELECT cc.ancestor_id, cc.descendant_id
+            FROM category_closure cc JOIN categories d ON d.id = cc.descendant_id
+            WHERE d.user_id = ?
+        """, (user_id,)):
+            subtrees.setdefault(ancestor_id, []).append(descendant_id)
+        return subtrees
+    
+    def get_subtree_totals(self, user_id, parent_id=None, start_date=None, end_date=None):
+        query = """
+            SELECT a.id, a.name, SUM(e.amount_cents)
+            FROM categories a
+            JOIN category_closure cc ON cc.ancestor_id = a.id
+            JOIN expenses e ON e.category_id = cc.descendant_id
+            WHERE a.user_id = ? AND (a.parent_id IS ? OR (a.id IS ? AND cc.depth = 0))
+        """
+        params = [user_id, parent_id, parent_id]
+        if start_date:
+            query += " AND e.date >= ?"
+            params.append(str(start_date))
+        if end_date:
+            query += " AND e.date <= ?"
+            params.append(str(end_date))
+        return {
+            category_id: (name, _from_cents(cents))
+            for category_id, name, cents in self._query(query + " GROUP BY a.id, a.name", params)
+            if cents
+        }
+    
+    def get_category_budgets(self, user_id, category_ids=None):
+        query = """
+            SELECT c.id, c.name, l.limit_cents, l.period, l.rolling_days, l.carry_over
+            FROM categories c
+            LEFT JOIN category_limits l ON l.category_id = c.id
+            WHERE c.user_id = ?
+        """
+        params = [user_id]
+        if category_ids is not None:
+            query += f" AND c.id IN ({', '.join(['?'] * len(category_ids))})"
+            params += list(category_ids)
+        rows = self._query(query + " ORDER BY c.name", params)
+        return _budget_rows_to_categories([
+            (cat_id, name, _from_cents(cents) if cents is not None else None, period, rolling_days, carry_over)
+            for cat_id, name, cents, period, rolling_days, carry_over in rows
+        ])
+
+    def get_category_month_totals(self, user_id):
+        categories = self._query(
+            "SELECT id, name FROM categories WHERE user_id = ? ORDER BY name", (user_id,)
+        )
+        totals = self._query("""
+            SELECT category_id,
+                   CAST(substr(date, 1, 4) AS INTEGER) * 12 + CAST(substr(date, 6, 2) AS INTEGER) - 1,
+                   SUM(amount_cents)
+            FROM expenses
+            WHERE user_id = ?
+            GROUP BY 1, 2
+        """, (user_id,))
+        return categories, totals
+    
+    def get_expense_amounts(self, user_id):
+        return self._query("""
+            SELECT e.id, e.category_id, e.amount_cents, e.date
+            FROM expenses e JOIN categories c ON c.id = e.category_id
+            WHERE e.user_id = ?
+        """, (user_id,))
+    
+    def get_daily_category_totals(self, user_id, start_date=None, category_ids=None):
+        query = """
+            SELECT e.category_id, e.date, SUM(e.amount_cents)
+            FROM expenses e JOIN categories c ON c.id = e.category_id
+            WHERE e.user_id = ?
+        """
+        params = [user_id]
+        if start_date:
+            query += " AND e.date >= ?"
+            params.append(str(start_date))
+        if category_ids is not None:
+            query += f" AND e.category_id IN ({', '.join(['?'] * len(category_ids))})"
+            params += list(category_ids)
+        return self._query(query + " GROUP BY e.category_id, e.date", params)
+
+LOCAL_REPLICA = LocalReplica(REPLICA_CONFIG["path"]) if REPLICA_CONFIG.get("enabled") else None
+
+def _local_replica(user_id):
+    """Return the local replica if it can serve reads for user_id, else None."""
+    if LOCAL_REPLICA is not None and LOCAL_REPLICA.is_ready(user_id):
+        return LOCAL_REPLICA
+    return None
+
+def _replica_paused(user_id):
+    """Hold off replica syncs while deriving a user's data (no-op without a replica)."""
+    replica = _local_replica(user_id)
+    return replica.paused() if replica else nullcontext()
+
+def _refresh_local_replica(user_id, conn=None):
+    """Pull a user's latest changes into the local replica right after a write.
+    
+    Without a loaded replica there are no deltas to report, so expense listeners
+    are told to recompute instead. The user's reads stay on the primary for the
+    read-your-writes window (see READ_ROUTING_CONFIG).
+    """
+    _note_primary_write(user_id)
+    if LOCAL_REPLICA is not None and LOCAL_REPLICA.is_ready(user_id):
+        LOCAL_REPLICA.sync(user_id, conn)
+    else:
+        _notify_expense_listeners(user_id, None)
+
+# --- Category x Month Cube ---
+
+MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+def _month_index(date):
+    """Month number (year * 12 + month - 1) of a date or 'YYYY-MM-DD' string."""
+    text = str(date)
+    return int(text[:4]) * 12 + int(text[5:7]) - 1
+
+def _month_label(month_index):
+    return f"{MONTH_NAMES[month_index % 12]} {month_index // 12}"
+
+class CategoryMonthCube:
+    """A user's spending as an int64 matrix of cents: one row per category, one column per month.
+    
+    Built from one grouped query and then kept current from expense deltas, so
+    pivots, totals and slices are NumPy operations on data already in memory.
+    """
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.category_ids = []
+        self.names = []
+        self.first_month = 0
+        self.cents = np.zeros((0, 0), dtype=np.int64)
+        self.version = 0
+        self.stale = True
+        self._row_of = {}
+        self._lock = threading.Lock()
+    
+    def build(self):
+        with _replica_paused(self.user_id):
+            categories, totals = get_category_month_totals(self.user_id)
+            self._load(categories, totals)
+    
+    def _load(self, categories, totals):
+        with self._lock:
+            self.category_ids = [cat_id for cat_id, _ in categories]
+            self.names = [name for _, name in categories]
+            self._row_of = {cat_id: row for row, cat_id in enumerate(self.category_ids)}
+            totals = [(self._row_of[cat_id], month, cents) for cat_id, month, cents in totals
+                      if cat_id in self._row_of]
+            if totals:
+                rows, months, cents = (np.array(column, dtype=np.int64) for column in zip(*totals))
+                self.first_month = int(months.min())
+                self.cents = np.zeros((len(self.names), int(months.max()) - self.first_month + 1), dtype=np.int64)
+                np.add.at(self.cents, (rows, months - self.first_month), cents)
+            else:
+                self.first_month = _month_index(date_type.today())
+                self.cents = np.zeros((len(self.names), 1), dtype=np.int64)
+            self.stale = False
+            self.version += 1
+    
+    def ensure_built(self):
+        if self.stale:
+            self.build()
+    
+    def apply(self, deltas):
+        """Add (category_id, date, cents) deltas, or mark the cube stale if deltas is None."""
+        with self._lock:
+            if deltas is None or any(cat_id not in self._row_of for cat_id, _, _ in deltas):
+                self.stale = True
+                self.version += 1
+                return
+            for cat_id, date, cents in deltas:
+                column = _month_index(date) - self.first_month
+                if column < 0:
+                    self.cents = np.pad(self.cents, ((0, 0), (-column, 0)))
+                    self.first_month += column
+                    column = 0
+                elif column >= self.cents.shape[1]:
+                    self.cents = np.pad(self.cents, ((0, 0), (0, column - self.cents.shape[1] + 1)))
+                self.cents[self._row_of[cat_id], column] += cents
+            self.version += 1
+    
+    def pivot(self, first_month=None, last_month=None, sort_by="name"):
+        """Slice the cube to a month range and compute totals.
+        
+        Args:
+            first_month, last_month: Inclusive month indexes (None for the data's range).
+            sort_by: "name" or "total" (largest first).
+        
+        Returns:
+            dict: names, months (labels), values (rows x months), row_totals and
+            column_totals as int64 cents, and total as Money.
+        """
+        self.ensure_built()
+        with self._lock:
+            last_data_month = self.first_month + self.cents.shape[1] - 1
+            first = self.first_month if first_month is None else first_month
+            last = last_data_month if last_month is None else last_month
+            window = np.zeros((len(self.names), max(last - first + 1, 0)), dtype=np.int64)
+            lo, hi = max(first, self.first_month), min(last, last_data_month)
+            if lo <= hi:
+                window[:, lo - first:hi - first + 1] = self.cents[:, lo - self.first_month:hi - self.first_month + 1]
+            names = list(self.names)
+        row_totals = window.sum(axis=1)
+        order = np.argsort(-row_totals, kind="stable") if sort_by == "total" else np.arange(len(names))
+        return {
+            'names': [names[i] for i in order],
+            'months': [_month_label(month) for month in range(first, last + 1)],
+            'values': window[order],
+            'row_totals': row_totals[order],
+            'column_totals': window.sum(axis=0),
+            'total': _from_cents(row_totals.sum())
+        }
+
+_CUBES = {}
+
+def get_category_month_cube(user_id):
+    """Return the user's cube, created on first use and kept current afterwards."""
+    if user_id not in _CUBES:
+        _CUBES[user_id] = CategoryMonthCube(user_id)
+    return _CUBES[user_id]
+
+def _update_cubes(user_id, deltas):
+    for cube_user_id, cube in list(_CUBES.items()):
+        if user_id is None or cube_user_id == user_id:
+            cube.apply(deltas)
+
+register_expense_listener(_update_cubes)
+
+# --- Spending Index ---
+
+def _epoch_day(date):
+    """Days since 1970-01-01 for a date or 'YYYY-MM-DD' string."""
+    return int(np.datetime64(str(date)[:10], 'D').astype(np.int64))
+
+class SpendingIndex:
+    """Cumulative daily spending per category, for constant-time range totals.
+    
+    For each category it keeps the sorted days that have expenses and the running
+    total in cents up to and including each day, so the total between two dates is
+    two binary searches and a subtraction. Expense deltas update it in place.
+    """
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.stale = True
+        self._days = {}
+        self._cumulative = {}
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_rows(cls, user_id, rows):
+        """Build a standalone index from (category_id, date, cents) daily totals."""
+        index = cls(user_id)
+        index._load_rows(rows)
+        return index
+    
+    def build(self):
+        with _replica_paused(self.user_id):
+            self._load_rows(get_daily_category_totals(self.user_id))
+    
+    def _load_rows(self, rows):
+        days, cumulative = {}, {}
+        if rows:
+            categories, dates, cents = zip(*rows)
+            categories = np.array(categories, dtype=np.int64)
+            dates = np.array(dates, dtype='datetime64[D]').astype(np.int64)
+            cents = np.array(cents, dtype=np.int64)
+            order = np.lexsort((dates, categories))
+            categories, dates, cents = categories[order], dates[order], cents[order]
+            starts = np.flatnonzero(np.r_[True, categories[1:] != categories[:-1]])
+            for start, end in zip(starts, np.r_[starts[1:], len(categories)]):
+                days[int(categories[start])] = dates[start:end]
+                cumulative[int(categories[start])] = np.cumsum(cents[start:end])
+        with self._lock:
+            self._days, self._cumulative = days, cumulative
+            self.stale = False
+    
+    def apply(self, deltas):
+        """Add (category_id, date, cents) deltas, or mark the index stale if deltas is None."""
+        with self._lock:
+            if deltas is None:
+                self.stale = True
+                return
+            for category_id, date, cents in deltas:
+                day = _epoch_day(date)
+                days = self._days.get(category_id, np.zeros(0, dtype=np.int64))
+                cumulative = self._cumulative.get(category_id, np.zeros(0, dtype=np.int64))
+                pos = int(np.searchsorted(days, day))
+                if pos == len(days) or days[pos] != day:
+                    days = np.insert(days, pos, day)
+                    cumulative = np.insert(cumulative, pos, cumulative[pos - 1] if pos else 0)
+                cumulative[pos:] += cents
+                self._days[category_id], self._cumulative[category_id] = days, cumulative
+    
+    def range_total(self, category_id, start_date=None, end_date=None):
+        """Total cents spent in a category between two dates (inclusive, None for open)."""
+        with self._lock:
+            days = self._days.get(category_id)
+            if days is None or not len(days):
+                return 0
+            cumulative = self._cumulative[category_id]
+            hi = len(days) if end_date is None else int(np.searchsorted(days, _epoch_day(end_date), 'right'))
+            lo = 0 if start_date is None else int(np.searchsorted(days, _epoch_day(start_date), 'left'))
+            if hi <= lo:
+                return 0
+            return int(cumulative[hi - 1] - (cumulative[lo - 1] if lo else 0))
+    
+    def daily_matrix(self, category_ids, start_date, end_date):
+        """Spending in cents per category (rows) per day (columns) between two dates."""
+        start, end = _epoch_day(start_date), _epoch_day(end_date)
+        matrix = np.zeros((len(category_ids), end - start + 1), dtype=np.int64)
+        with self._lock:
+            for row, category_id in enumerate(category_ids):
+                days = self._days.get(category_id)
+                if days is None or not len(days):
+                    continue
+                cumulative = self._cumulative[category_id]
+                lo, hi = np.searchsorted(days, start, 'left'), np.searchsorted(days, end, 'right')
+                if hi <= lo:
+                    continue
+                amounts = np.diff(cumulative[lo:hi], prepend=cumulative[lo - 1] if lo else 0)
+                matrix[row, days[lo:hi] - start] = amounts
+        return matrix
+    
+    def save(self, path, position):
+        """Write the index to disk, tagged with the replica position it reflects."""
+        with self._lock:
+            categories = sorted(self._days)
+            np.savez(
+                path,
+                position=np.array([position[0]], dtype=np.int64),
+                epoch=np.array([position[1] or ""]),
+                categories=np.array(categories, dtype=np.int64),
+                lengths=np.array([len(self._days[c]) for c in categories], dtype=np.int64),
+                days=np.concatenate([self._days[c] for c in categories]) if categories else np.zeros(0, np.int64),
+                cumulative=np.concatenate([self._cumulative[c] for c in categories]) if categories else np.zeros(0, np.int64)
+            )
+    
+    def load(self, path, position):
+        """Load a saved index if it reflects exactly `position`; returns whether it did."""
+        try:
+            with np.load(path) as data:
+                if int(data['position'][0]) != position[0] or str(data['epoch'][0]) != (position[1] or ""):
+                    return False
+                offsets = np.r_[0, np.cumsum(data['lengths'])]
+                with self._lock:
+                    self._days = {int(c): data['days'][offsets[i]:offsets[i + 1]]
+                                  for i, c in enumerate(data['categories'])}
+                    self._cumulative = {int(c): data['cumulative'][offsets[i]:offsets[i + 1]]
+                                        for i, c in enumerate(data['categories'])}
+                    self.stale = False
+            return True
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Could not load spending index: {e}")
+            return False
+
+_SPENDING_INDEXES = {}
+
+def _spending_index_path(user_id):
+    return os.path.join(SPENDING_INDEX_CONFIG["directory"], f"spending_index_{user_id}.npz")
+
+def _spending_index(user_id):
+    """Return the user's up-to-date spending index, or None if it can't be used.
+    
+    The index is only kept for users served by the local replica, whose change
+    feed delivers the deltas (including other clients' writes) that keep it exact.
+    """
+    replica = _local_replica(user_id)
+    if not SPENDING_INDEX_CONFIG.get("enabled") or replica is None:
+        return None
+    index = _SPENDING_INDEXES.get(user_id)
+    if index is None:
+        index = _SPENDING_INDEXES[user_id] = SpendingIndex(user_id)
+        if SPENDING_INDEX_CONFIG.get("persist"):
+            with replica.paused():
+                position = replica.position(user_id)
+                if index.load(_spending_index_path(user_id), position):
+                    print(f"Loaded spending index for user {user_id} (seq {position[0]})")
+    if index.stale:
+        index.build()
+    return index
+
+def save_spending_indexes():
+    """Persist the spending indexes of users served by the local replica."""
+    if not SPENDING_INDEX_CONFIG.get("persist"):
+        return
+    os.makedirs(SPENDING_INDEX_CONFIG["directory"], exist_ok=True)
+    for user_id, index in list(_SPENDING_INDEXES.items()):
+        replica = _local_replica(user_id)
+        if not replica or index.stale:
+            continue
+        with replica.paused():
+            index.save(_spending_index_path(user_id), replica.position(user_id))
+
+def _update_spending_indexes(user_id, deltas):
+    for index_user_id, index in list(_SPENDING_INDEXES.items()):
+        if user_id is None or index_user_id == user_id:
+            index.apply(deltas)
+
+register_expense_listener(_update_spending_indexes)
+
+# --- Tag Index ---
+
+class CompressedBitmap:
+    """A set of non-negative 32-bit integers (expense IDs) in the roaring layout.
+    
+    Values are split into chunks by their high 16 bits. A chunk with at most
+    ARRAY_LIMIT members is a sorted uint16 array of the low bits; a denser chunk is
+    a 65536-bit bitset (1024 uint64 words). No chunk takes more than 8 KB, sparse
+    sets cost two bytes per member, and set operations run a chunk at a time.
+    """
+    ARRAY_LIMIT = 4096
+    
+    def __init__(self, chunks=None):
+        self.chunks = chunks or {}
+    
+    @classmethod
+    def from_sorted(cls, values):
+        """Build a bitmap from a sorted array of distinct values."""
+        values = np.asarray(values, dtype=np.int64)
+        chunks = {}
+        if len(values):
+            keys = values >> 16
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            for start, end in zip(starts, np.r_[starts[1:], len(values)]):
+                chunks[int(keys[start])] = cls._pack((values[start:end] & 0xFFFF).astype(np.uint16))
+        return cls(chunks)
+    
+    @classmethod
+    def _pack(cls, low):
+        """Container for a chunk's sorted uint16 members."""
+        return low if len(low) <= cls.ARRAY_LIMIT else cls._bits(low)
+    
+    @staticmethod
+    def _bits(container):
+        if container.dtype == np.uint64:
+            return container
+        bits = np.zeros(65536, dtype=bool)
+        bits[container] = True
+        return np.packbits(bits, bitorder='little').view(np.uint64)
+    
+    @staticmethod
+    def _members(container):
+        if container.dtype == np.uint16:
+            return container
+        return np.flatnonzero(np.unpackbits(container.view(np.uint8), bitorder='little')).astype(np.uint16)
+    
+    def _combine(self, other, keys, array_op, bits_op):
+        chunks = {}
+        for key in keys:
+            a, b = self.chunks.get(key), other.chunks.get(key)
+            if a is None or b is None:
+                result = b if a is None else a
+            elif a.dtype == np.uint16 and b.dtype == np.uint16:
+                result = self._pack(array_op(a, b))
+            else:
+                result = self._pack(self._members(bits_op(self._bits(a), self._bits(b))))
+            if len(result):
+                chunks[key] = result
+        return CompressedBitmap(chunks)
+    
+    def __and__(self, other):
+        return self._combine(
+            other, self.chunks.keys() & other.chunks.keys(),
+            lambda a, b: np.intersect1d(a, b, assume_unique=True), np.bitwise_and
+        )
+    
+    def __or__(self, other):
+        return self._combine(other, self.chunks.keys() | other.chunks.keys(), np.union1d, np.bitwise_or)
+    
+    def __sub__(self, other):
+        return self._combine(
+            other, self.chunks.keys(),
+            lambda a, b: np.setdiff1d(a, b, assume_unique=True), lambda a, b: a & ~b
+        )
+    
+    def __len__(self):
+        return sum(len(self._members(container)) for container in self.chunks.values())
+    
+    def add(self, value):
+        key, low = value >> 16, value & 0xFFFF
+        container = self.chunks.get(key)
+        if container is None:
+            self.chunks[key] = np.array([low], dtype=np.uint16)
+        elif container.dtype == np.uint64:
+            container[low >> 6] |= np.uint64(1 << (low & 63))
+        else:
+            pos = int(np.searchsorted(container, low))
+            if pos == len(container) or container[pos] != low:
+                self.chunks[key] = self._pack(np.insert(container, pos, low))
+    
+    def discard(self, value):
+        key, low = value >> 16, value & 0xFFFF
+        container = self.chunks.get(key)
+        if container is None:
+            return
+        if container.dtype == np.uint64:
+            container[low >> 6] &= ~np.uint64(1 << (low & 63))
+            if not container.any():
+                del self.chunks[key]
+        else:
+            pos = int(np.searchsorted(container, low))
+            if pos < len(container) and container[pos] == low:
+                if len(container) == 1:
+                    del self.chunks[key]
+                else:
+                    self.chunks[key] = np.delete(container, pos)
+    
+    def to_array(self):
+        """The members as a sorted int64 array."""
+        parts = [(key << 16) + self._members(self.chunks[key]).astype(np.int64) for key in sorted(self.chunks)]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+class TagIndex:
+    """Tag bitmaps plus ID-sorted columns of a user's expenses, for tag queries.
+    
+    Each tag has a CompressedBitmap of its expenses' IDs, so AND/OR/NOT queries are
+    bitmap operations. The matching IDs are then looked up in the category, day
+    and amount columns to apply the category and date filters. Replica changes are
+    applied to the bitmaps as they arrive; expense rows are buffered and merged
+    into the columns on the next query.
+    """
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.stale = True
+        self._lock = threading.Lock()
+        self._bitmaps = {}
+        self._pending = {}
+        self._everything = None
+        self._ids = self._categories = self._days = self._cents = np.zeros(0, dtype=np.int64)
+    
+    def build(self):
+        replica = _local_replica(self.user_id)
+        if replica is None:
+            return
+        # Held until the index is swapped in, so no change can slip in between
+        with replica.paused():
+            rows = replica.get_expense_columns(self.user_id)
+            memberships = replica.get_tag_memberships(self.user_id)
+            columns = [np.zeros(0, dtype=np.int64)] * 4
+            if rows:
+                ids, categories, dates, cents = zip(*rows)
+                columns = [
+                    np.array(ids, dtype=np.int64), np.array(categories, dtype=np.int64),
+                    np.array(dates, dtype='datetime64[D]').astype(np.int64), np.array(cents, dtype=np.int64)
+                ]
+            bitmaps = {}
+            if memberships:
+                names = [name for name, _ in memberships]
+                expense_ids = np.array([expense_id for _, expense_id in memberships], dtype=np.int64)
+                starts = [i for i in range(len(names)) if i == 0 or names[i] != names[i - 1]]
+                for start, end in zip(starts, starts[1:] + [len(names)]):
+                    bitmaps[names[start]] = CompressedBitmap.from_sorted(expense_ids[start:end])
+            with self._lock:
+                self._ids, self._categories, self._days, self._cents = columns
+                self._bitmaps, self._pending, self._everything = bitmaps, {}, None
+                self.stale = False
+    
+    def apply_changes(self, changes):
+        with self._lock:
+            if self.stale:
+                return
+            for change in changes:
+                entity, expense_id, payload = change['entity'], change['entity_id'], change['payload'] or {}
+                if entity == 'expense':
+                    # Tag bits of deleted expenses are harmless: results are always
+                    # checked against the live ID column
+                    self._pending[expense_id] = None if change['operation'] == 'delete' else (
+                        payload['category_id'], _epoch_day(payload['date']), _to_cents(payload['amount'])
+                    )
+                elif entity == 'expense_tags':
+                    for name in payload.get('removed', []):
+                        if name in self._bitmaps:
+                            self._bitmaps[name].discard(expense_id)
+                    for name in payload.get('added', []):
+                        self._bitmaps.setdefault(name, CompressedBitmap()).add(expense_id)
+    
+    def _merge(self):
+        if not self._pending:
+            return
+        changed = np.fromiter(self._pending, dtype=np.int64, count=len(self._pending))
+        keep = ~np.isin(self._ids, changed)
+        added = [(expense_id, *row) for expense_id, row in self._pending.items() if row is not None]
+        added = np.array(added, dtype=np.int64).reshape(-1, 4)
+        columns = [
+            np.concatenate([column[keep], added[:, i]])
+            for i, column in enumerate((self._ids, self._categories, self._days, self._cents))
+        ]
+        order = np.argsort(columns[0], kind='stable')
+        self._ids, self._categories, self._days, self._cents = (column[order] for column in columns)
+        self._pending, self._everything = {}, None
+    
+    def _evaluate(self, query):
+        kind = query[0]
+        if kind == 'tag':
+            return self._bitmaps.get(query[1], CompressedBitmap())
+        if kind == 'not':
+            # Only a NOT that isn't part of an AND needs the set of all expenses
+            if self._everything is None:
+                self._everything = CompressedBitmap.from_sorted(self._ids)
+            return self._everything - self._evaluate(query[1])
+        left, right = query[1], query[2]
+        if kind == 'or':
+            return self._evaluate(left) | self._evaluate(right)
+        if right[0] == 'not':
+            return self._evaluate(left) - self._evaluate(right[1])
+        if left[0] == 'not':
+            return self._evaluate(right) - self._evaluate(left[1])
+        return self._evaluate(left) & self._evaluate(right)
+    
+    def expenses(self, query, category_id=None, start_date=None, end_date=None):
+        """Expenses matching a parsed tag query, in the shape get_expenses returns."""
+        with self._lock:
+            self._merge()
+            matched = self._evaluate(query).to_array()
+            positions = np.searchsorted(self._ids, matched)
+            found = positions < len(self._ids)
+            positions = positions[found]
+            positions = positions[self._ids[positions] == matched[found]]
+            mask = np.ones(len(positions), dtype=bool)
+            if category_id is not None:
+                mask &= self._categories[positions] == category_id
+            if start_date:
+                mask &= self._days[positions] >= _epoch_day(start_date)
+            if end_date:
+                mask &= self._days[positions] <= _epoch_day(end_date)
+            positions = positions[mask]
+            positions = positions[np.argsort(-self._days[positions], kind='stable')]
+            ids, categories = self._ids[positions], self._categories[positions]
+            days, cents = self._days[positions], self._cents[positions]
+        expenses = [
+            Expense(expense_id, expense_category_id, _from_cents(amount), day)
+            for expense_id, expense_category_id, day, amount in zip(
+                ids.tolist(), categories.tolist(), days.astype('datetime64[D]').astype(object).tolist(),
+                cents.tolist()
+            )
+        ]
+        return expenses, _from_cents(cents.sum())
+
+_TAG_INDEXES = {}
+
+def _tag_index(user_id):
+    """Return the user's up-to-date tag index, or None if it can't be used.
+    
+    Like the spending index, it is only kept for users served by the local
+    replica, whose change feed keeps it exact.
+    """
+    if not TAG_INDEX_CONFIG.get("enabled") or _local_replica(user_id) is None:
+        return None
+    index = _TAG_INDEXES.get(user_id)
+    if index is None:
+        index = _TAG_INDEXES[user_id] = TagIndex(user_id)
+    if index.stale:
+        index.build()
+    return index
+
+def _apply_tag_changes(user_id, changes):
+    index = _TAG_INDEXES.get(user_id)
+    if index:
+        index.apply_changes(changes)
+
+def _reset_tag_indexes(user_id, deltas):
+    if deltas is None:
+        for index_user_id, index in list(_TAG_INDEXES.items()):
+            if user_id is None or index_user_id == user_id:
+                index.stale = True
+
+register_change_listener(_apply_tag_changes)
+register_expense_listener(_reset_tag_indexes)
+
+class PayeePrefixIndex:
+    """A user's payee names, searchable by prefix while a payee is typed.
+    
+    Each payee's normalized name, and each later word of it, is kept in one sorted
+    list of (key, payee_id) pairs, so the payees matching a prefix are a
+    contiguous run found with two bisections; "cof" finds both "Coffee House"
+    and "Blue Bottle Coffee". Matches are ranked by how many expenses a payee
+    has. When nothing matches (usually a typo) the closest names by edit
+    similarity are suggested instead.
+    """
+    def __init__(self, user_id=None):
+        self.user_id = user_id
+        self.names = {}
+        self.counts = {}
+        self.normalized = {}
+        self.keys = []
+        self.stale = True
+    
+    def build(self, payees=None):
+        """Load (payee_id, name, expense_count) rows (by default the user's payees)."""
+        if payees is None:
+            payees = get_payees(self.user_id)
+        self.names, self.counts, self.normalized, self.keys = {}, {}, {}, []
+        for payee_id, name, count in payees:
+            self.keys.extend(self._store(payee_id, name, count))
+        self.keys.sort()
+        self.stale = False
+    
+    def _store(self, payee_id, name, count):
+        """Record a payee and return its search keys."""
+        normalized = _normalize_payee(name)[1]
+        self.names[payee_id] = name
+        self.counts[payee_id] = count
+        self.normalized[payee_id] = normalized
+        words = normalized.split(" ")
+        return [(" ".join(words[i:]), payee_id) for i in range(len(words))]
+    
+    def add(self, payee_id, name, count=0):
+        """Add a new payee (ignored if it's already indexed)."""
+        if payee_id in self.names:
+            return
+        for key in self._store(payee_id, name, count):
+            bisect.insort(self.keys, key)
+    
+    def record_use(self, payee_id):
+        """Count another expense for a payee, moving it up the suggestions."""
+        if payee_id in self.counts:
+            self.counts[payee_id] += 1
+    
+    def suggest(self, text, limit=None):
+        """Return the names of up to `limit` payees matching what was typed."""
+        limit = limit or PAYEE_INDEX_CONFIG.get("suggestions", 8)
+        try:
+            prefix = _normalize_payee(text)[1]
+        except ValueError:
+            return []
+        start = bisect.bisect_left(self.keys, (prefix,))
+        end = bisect.bisect_left(self.keys, (prefix + "\U0010ffff",))
+        matches = {payee_id for _, payee_id in self.keys[start:end]}
+        if not matches:
+            by_name = {}
+            for payee_id, normalized in self.normalized.items():
+                by_name.setdefault(normalized, payee_id)
+            close = difflib.get_close_matches(
+                prefix, list(by_name), n=limit, cutoff=PAYEE_INDEX_CONFIG.get("fuzzy_cutoff", 0.6)
+            )
+            return [self.names[by_name[name]] for name in close]
+        ranked = sorted(matches, key=lambda payee_id: (-self.counts[payee_id], self.normalized[payee_id]))
+        return [self.names[payee_id] for payee_id in ranked[:limit]]
+    
+    def apply_changes(self, changes):
+        for change in changes:
+            if change['entity'] == 'payee':
+                self.add(change['entity_id'], change['payload']['name'])
+            elif change['entity'] == 'expense' and change['operation'] == 'insert':
+                payee_id = (change['payload'] or {}).get('payee_id')
+                if payee_id:
+                    self.record_use(payee_id)
+
+_PAYEE_INDEXES = {}
+
+def payee_prefix_index(user_id):
+    """Return a prefix index of the user's payees.
+    
+    Users served by the local replica share one index kept current by the change
+    feed; otherwise a fresh index is built from the database.
+    """
+    if _local_replica(user_id) is None:
+        index = PayeePrefixIndex(user_id)
+        index.build()
+        return index
+    index = _PAYEE_INDEXES.get(user_id)
+    if index is None:
+        index = _PAYEE_INDEXES[user_id] = PayeePrefixIndex(user_id)
+    if index.stale:
+        index.build()
+    return index
+
+def _apply_payee_changes(user_id, changes):
+    index = _PAYEE_INDEXES.get(user_id)
+    if index:
+        index.apply_changes(changes)
+
+def _reset_payee_indexes(user_id, deltas):
+    if deltas is None:
+        for index_user_id, index in list(_PAYEE_INDEXES.items()):
+            if user_id is None or index_user_id == user_id:
+                index.stale = True
+
+register_change_listener(_apply_payee_changes)
+register_expense_listener(_reset_payee_indexes)
+
+# --- Spending Forecast ---
+
+def _daily_matrix(user_id, category_ids, start_date, end_date):
+    """Category x day spending matrix in cents, from the spending index when available."""
+    index = _spending_index(user_id)
+    if index:
+        return index.daily_matrix(category_ids, start_date, end_date)
+    start = _epoch_day(start_date)
+    matrix = np.zeros((len(category_ids), _epoch_day(end_date) - start + 1), dtype=np.int64)
+    rows = [row for row in get_daily_category_totals(user_id, start_date, category_ids)
+            if str(row[1]) <= str(end_date)]
+    if rows:
+        position = {category_id: i for i, category_id in enumerate(category_ids)}
+        categories, dates, cents = zip(*rows)
+        np.add.at(
+            matrix,
+            (np.array([position[c] for c in categories]),
+             np.array(dates, dtype='datetime64[D]').astype(np.int64) - start),
+            np.array(cents, dtype=np.int64)
+        )
+    return matrix
+
+def _seasonal_factors(history, observed, groups, group_count, shrinkage):
+    """Per-category multiplier for each weekday (or day of month) over the mean day.
+    
+    Sparse groups are shrunk towards 1 so a single large expense on one day of the
+    month doesn't dominate every forecast for that day.
+    """
+    one_hot = np.zeros((len(groups), group_count))
+    one_hot[np.arange(len(groups)), groups] = 1
+    sums = history @ one_hot
+    counts = observed @ one_hot
+    mean = history.sum(axis=1) / np.maximum(observed.sum(axis=1), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factors = (sums + shrinkage * mean[:, None]) / ((counts + shrinkage) * mean[:, None])
+    return np.where(mean[:, None] > 0, factors, 1.0)
+
+def forecast_budgets(user_id, budgets, today=None):
+    """Project each budget's spending to the end of its current period.
+    
+    All categories are forecast together on a category x day matrix of the last
+    FORECAST_CONFIG["history_days"] days, where a category's row includes the
+    spending of its subcategories. The expected spend on a future day is the
+    category's exponentially smoothed daily rate (counted from its first expense),
+    times its weekday and day-of-month factors. For a rolling budget the period is
+    the window ending `rolling_days` from today.
+    
+    Args:
+        budgets: Evaluated budgets as returned by get_all_category_limits_with_spending;
+            each gets forecast (projected spend at period end) and exceed_date
+            (first day the projection goes over the limit, None if it doesn't or
+            the limit is already exceeded).
+    
+    Returns:
+        list: The same budgets.
+    """
+    if not budgets:
+        return budgets
+    today = today or datetime.now().date()
+    history_days = FORECAST_CONFIG.get("history_days", 365)
+    half_life = FORECAST_CONFIG.get("half_life_days", 14)
+    shrinkage = FORECAST_CONFIG.get("shrinkage", 4)
+    
+    history_start = today - timedelta(days=history_days - 1)
+    # A limit covers the category's whole subtree (as budget.spent does), so each
+    # budget's history is the sum of its descendants' rows
+    subtrees = get_category_subtrees(user_id)
+    budget_subtrees = [subtrees.get(budget.id, (budget.id,)) for budget in budgets]
+    descendant_ids = sorted({d for descendants in budget_subtrees for d in descendants})
+    position = {category_id: i for i, category_id in enumerate(descendant_ids)}
+    membership = np.zeros((len(budgets), len(descendant_ids)), dtype=np.int64)
+    for row, descendants in enumerate(budget_subtrees):
+        membership[row, [position[d] for d in descendants]] = 1
+    # Projected in (fractional) cents; forecasts are rounded back to Money
+    history = (membership @ _daily_matrix(user_id, descendant_ids, history_start, today)).astype(np.float64)
+    days = np.arange(_epoch_day(history_start), _epoch_day(today) + 1)
+    
+    # Days before a category's first expense don't count towards its averages
+    active = history > 0
+    first = np.where(active.any(axis=1), active.argmax(axis=1), history_days)
+    observed = (np.arange(history_days)[None, :] >= first[:, None]).astype(np.float64)
+    
+    weights = 0.5 ** ((history_days - 1 - np.arange(history_days)) / half_life) * observed
+    level = (history * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-12)
+    
+    def weekday(epoch_days):
+        return (epoch_days + 3) % 7  # 1970-01-01 was a Thursday; Monday is 0
+    
+    def day_of_month(epoch_days):
+        dates = np.asarray(epoch_days).astype('datetime64[D]')
+        return (dates - dates.astype('datetime64[M]')).astype(np.int64)
+    
+    weekday_factors = _seasonal_factors(history, observed, weekday(days), 7, shrinkage)
+    month_day_factors = _seasonal_factors(history, observed, day_of_month(days), 31, shrinkage)
+    
+    horizons = np.array([
+        budget.rolling_days if budget.period == 'rolling' else (budget.period_end - today).days
+        for budget in budgets
+    ])
+    horizon = max(int(horizons.max()), 1)
+    future = _epoch_day(today) + 1 + np.arange(horizon)
+    expected = (level[:, None]
+                * weekday_factors[:, weekday(future)]
+                * month_day_factors[:, day_of_month(future)])
+    expected[np.arange(horizon)[None, :] >= horizons[:, None]] = 0
+    cumulative = np.cumsum(expected, axis=1)
+    
+    # Fixed periods: spending so far plus the expected spend of the remaining days
+    spent = np.array([budget.spent.cents for budget in budgets], dtype=np.float64)
+    projected = spent[:, None] + cumulative
+    for row, budget in enumerate(budgets):
+        row_horizon = int(horizons[row])
+        if budget.period == 'rolling':
+            # The window slides, so compare the trailing sum of actual and expected
+            # spending on each coming day with the limit
+            window = min(row_horizon, history_days)
+            series = np.concatenate([history[row, history_days - window:], expected[row, :row_horizon]])
+            trailing = np.cumsum(series)
+            trailing = trailing[window:] - trailing[:len(trailing) - window]
+            budget.forecast = Money(int(round(trailing[-1]))) if len(trailing) else budget.spent
+        else:
+            trailing = projected[row, :row_horizon]
+            budget.forecast = Money(int(round(trailing[-1]))) if row_horizon else budget.spent
+        budget.exceed_date = None
+        if budget.available is not None and not budget.exceeded:
+            over = np.flatnonzero(trailing > budget.available.cents)
+            if len(over):
+                budget.exceed_date = today + timedelta(days=int(over[0]) + 1)
+    return budgets
+
+# --- Anomaly Detection ---
+
+class RunningStats:
+    """Welford's running mean and variance; values can also be removed again."""
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+    
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+    
+    def remove(self, value):
+        if self.count <= 1:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        delta = value - self.mean
+        self.count -= 1
+        self.mean -= delta / self.count
+        self.m2 -= delta * (value - self.mean)
+    
+    @property
+    def std(self):
+        return math.sqrt(max(self.m2, 0.0) / (self.count - 1)) if self.count > 1 else 0.0
+    
+    def zscore(self, value):
+        std = self.std
+        if std > 0:
+            return (value - self.mean) / std
+        # Every value so far was the same, so any larger one stands out
+        return math.inf if self.count > 1 and value > self.mean else 0.0
+
+class P2Quantile:
+    """Streaming estimate of one quantile in constant space (the P-square algorithm).
+    
+    Five markers track the minimum, the quantile, the maximum and two points in
+    between; each new value moves them with a piecewise-parabolic adjustment.
+    """
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+    
+    @classmethod
+    def from_sorted(cls, p, values):
+        """Seed the markers from an exact sorted sample, as if it had been streamed."""
+        estimator = cls(p)
+        n = len(values)
+        if n < 5:
+            estimator.heights = [float(v) for v in values]
+            return estimator
+        estimator.desired = [1 + (n - 1) * increment for increment in estimator.increments]
+        positions = []
+        for i, desired in enumerate(estimator.desired):
+            lowest = positions[-1] + 1 if positions else 1
+            positions.append(max(lowest, min(int(round(desired)), n - 4 + i)))
+        estimator.positions = positions
+        estimator.heights = [float(values[pos - 1]) for pos in positions]
+        return estimator
+    
+    def add(self, value):
+        heights, positions = self.heights, self.positions
+        if len(heights) < 5:
+            bisect.insort(heights, value)
+            return
+        if value < heights[0]:
+            heights[0] = value
+            k = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            k = 3
+        else:
+            k = bisect.bisect_right(heights, value) - 1
+        for i in range(k + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in (1, 2, 3):
+            offset = self.desired[i] - positions[i]
+            if ((offset >= 1 and positions[i + 1] - positions[i] > 1)
+                    or (offset <= -1 and positions[i - 1] - positions[i] < -1)):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+    
+    def _parabolic(self, i, step):
+        h, n = self.heights, self.positions
+        return h[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - step) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+        )
+    
+    def value(self):
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            return self.heights[min(int(round(self.p * (len(self.heights) - 1))), len(self.heights) - 1)]
+        return self.heights[2]
+
+class CategoryStats:
+    """Running statistics of one category: log amounts, an upper quantile of the
+    amounts, and the number of expenses on each day that has any."""
+    def __init__(self, quantile):
+        self.amounts = RunningStats()
+        self.tail = P2Quantile(quantile)
+        self.day_counts = {}
+        self.daily = RunningStats()
+
+class AnomalyDetector:
+    """Flags unusually large or frequent expenses of one user, category by category.
     
-    try:
-        cursor = conn.cursor()
+    The statistics are seeded by one vectorized pass over the user's expenses and
+    then updated in O(1) per recorded insert. Edits, deletes and other clients'
+    writes are only picked up by the next rescan.
+    """
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.stale = True
+        self._stats = {}
+        self._lock = threading.Lock()
+    
+    def check(self, category_id, amount, date):
+        """Return the reasons an expense would be unusual (empty if it isn't)."""
+        config = ANOMALY_CONFIG
+        reasons = []
+        with self._lock:
+            stats = self._stats.get(category_id)
+            if stats is None or amount <= 0:
+                return reasons
+            if stats.amounts.count >= config["min_history"]:
+                if stats.amounts.zscore(math.log(amount)) > config["z_threshold"]:
+                    reasons.append(
+                        f"Rs{amount:.2f} is far above the usual Rs{math.exp(stats.amounts.mean):.2f} for this category"
+                    )
+                tail = stats.tail.value()
+                if stats.amounts.count >= 1 / (1 - config["quantile"]) and amount > config["tail_multiple"] * tail:
+                    reasons.append(f"Rs{amount:.2f} is over {config['tail_multiple']:g}x the amount "
+                                   f"{config['quantile']:.0%} of this category's expenses stay under (Rs{tail:.2f})")
+            count = stats.day_counts.get(str(date), 0) + 1
+            if (count >= config["min_daily_count"] and stats.daily.count >= config["min_history"]
+                    and stats.daily.zscore(count) > config["frequency_z"]):
+                reasons.append(f"{count} expenses in this category on {date}; "
+                               f"usually {stats.daily.mean:.1f} on days with any")
+        return reasons
+    
+    def observe(self, category_id, amount, date):
+        """Add an inserted expense to its category's statistics."""
+        if amount <= 0:
+            return
+        with self._lock:
+            stats = self._stats.get(category_id)
+            if stats is None:
+                stats = self._stats[category_id] = CategoryStats(ANOMALY_CONFIG["quantile"])
+            stats.amounts.add(math.log(amount))
+            stats.tail.add(float(amount))
+            date = str(date)
+            count = stats.day_counts.get(date, 0)
+            if count:
+                stats.daily.remove(count)
+            stats.daily.add(count + 1)
+            stats.day_counts[date] = count + 1
+    
+    def record(self, category_id, amount, date):
+        """Check an expense that was just inserted, then add it to the statistics."""
+        reasons = self.check(category_id, amount, date)
+        self.observe(category_id, amount, date)
+        return reasons
+    
+    @staticmethod
+    def _zscores(values, means, stds, counts):
+        """Vectorized RunningStats.zscore."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(stds > 0, (values - means) / stds,
+                            np.where((counts > 1) & (values > means), np.inf, 0.0))
+    
+    def rescan(self):
+        """Recompute all statistics from the user's expenses and flag every outlier.
         
-        # Check if limit already exists
-        cursor.execute("SELECT id FROM category_limits WHERE category_id = %s", (category_id,))
-        existing_limit = cursor.fetchone()
+        Each expense is judged against its category's statistics over the full
+        history, the same tests check applies to a new expense.
         
-        if existing_limit:
-            # Update existing limit
-            print(f"Updating existing limit record {existing_limit[0]}")
-            cursor.execute(
-                "UPDATE category_limits SET limit_amount = %s WHERE category_id = %s",
-                (limit_amount, category_id)
-            )
-            message = f"Spending limit updated to Rs{limit_amount:.2f}"
-        else:
-            # Insert new limit
-            print(f"Inserting new limit record")
-            cursor.execute(
-                "INSERT INTO category_limits (category_id, limit_amount) VALUES (%s, %s)",
-                (category_id, limit_amount)
+        Returns:
+            dict: expense_id -> list of reasons for each unusual expense.
+        """
+        config = ANOMALY_CONFIG
+        rows = get_expense_amounts(self.user_id)
+        rows = [row for row in rows if row[2] > 0]
+        stats_by_category = {}
+        flagged = {}
+        if rows:
+            ids, categories, cents, dates = zip(*rows)
+            ids = np.array(ids, dtype=np.int64)
+            categories = np.array(categories, dtype=np.int64)
+            amounts = np.array(cents, dtype=np.float64) / 100
+            days = np.array(dates, dtype='datetime64[D]').astype(np.int64)
+            order = np.lexsort((amounts, categories))
+            ids, categories, amounts, days = ids[order], categories[order], amounts[order], days[order]
+            starts = np.flatnonzero(np.r_[True, categories[1:] != categories[:-1]])
+            sizes = np.diff(np.r_[starts, len(categories)])
+            group = np.repeat(np.arange(len(starts)), sizes)
+            
+            # Log-amount mean and variance per category
+            logs = np.log(amounts)
+            means = np.add.reduceat(logs, starts) / sizes
+            m2 = np.add.reduceat((logs - means[group]) ** 2, starts)
+            stds = np.sqrt(m2 / np.maximum(sizes - 1, 1))
+            zscores = self._zscores(logs, means[group], stds[group], sizes[group])
+            large = (sizes[group] >= config["min_history"]) & (zscores > config["z_threshold"])
+            
+            # Quantile per category, read straight from the sorted amounts
+            tails = amounts[starts + np.floor(config["quantile"] * (sizes - 1)).astype(np.int64)]
+            above_tail = ((sizes[group] >= 1 / (1 - config["quantile"]))
+                          & (amounts > config["tail_multiple"] * tails[group]))
+            
+            # Expenses per (category, day) and their mean and variance per category
+            first_day = int(days.min())
+            keys, key_of_row, day_counts = np.unique(
+                group * (1 << 32) + (days - first_day), return_inverse=True, return_counts=True
             )
-            message = f"Spending limit set to Rs{limit_amount:.2f}"
+            key_groups = keys >> 32
+            active_days = np.bincount(key_groups, minlength=len(starts))
+            daily_means = np.bincount(key_groups, day_counts, len(starts)) / np.maximum(active_days, 1)
+            daily_m2 = np.bincount(key_groups, (day_counts - daily_means[key_groups]) ** 2, len(starts))
+            daily_stds = np.sqrt(daily_m2 / np.maximum(active_days - 1, 1))
+            row_counts = day_counts[key_of_row]
+            daily_z = self._zscores(row_counts, daily_means[group], daily_stds[group], active_days[group])
+            frequent = ((row_counts >= config["min_daily_count"]) & (active_days[group] >= config["min_history"])
+                        & (daily_z > config["frequency_z"]))
             
-        conn.commit()
-        print(f"Database committed successfully: {message}")
-        return True, message
-    except mysql.connector.Error as e:
-        print(f"Database error in set_category_limit: {e}")
-        return False, f"Database error: {e}"
-    finally:
-        conn.close()
-        print("Database connection closed")
+            for row in np.flatnonzero(large | above_tail | frequent):
+                g = group[row]
+                reasons = []
+                if large[row]:
+                    reasons.append(f"Rs{amounts[row]:.2f} is far above the usual Rs{math.exp(means[g]):.2f} "
+                                   f"for this category")
+                if above_tail[row]:
+                    reasons.append(f"Rs{amounts[row]:.2f} is over {config['tail_multiple']:g}x the amount "
+                                   f"{config['quantile']:.0%} of this category's expenses stay under (Rs{tails[g]:.2f})")
+                if frequent[row]:
+                    reasons.append(f"{row_counts[row]} expenses in this category on "
+                                   f"{np.datetime64(int(days[row]), 'D')}; usually {daily_means[g]:.1f} on days with any")
+                flagged[int(ids[row])] = reasons
+            
+            key_days = ((keys & ((1 << 32) - 1)) + first_day).astype('datetime64[D]').astype(str)
+            key_starts = np.searchsorted(key_groups, np.arange(len(starts)))
+            key_ends = np.r_[key_starts[1:], len(keys)]
+            for g, start in enumerate(starts):
+                stats = CategoryStats(config["quantile"])
+                stats.amounts = RunningStats(int(sizes[g]), float(means[g]), float(m2[g]))
+                stats.tail = P2Quantile.from_sorted(config["quantile"], amounts[start:start + sizes[g]])
+                stats.day_counts = dict(zip(key_days[key_starts[g]:key_ends[g]].tolist(),
+                                            day_counts[key_starts[g]:key_ends[g]].tolist()))
+                stats.daily = RunningStats(int(active_days[g]), float(daily_means[g]), float(daily_m2[g]))
+                stats_by_category[int(categories[start])] = stats
+        with self._lock:
+            self._stats = stats_by_category
+            self.stale = False
+        print(f"Scanned {len(rows)} expenses of user {self.user_id}: {len(flagged)} unusual")
+        return flagged
 
-def get_category_limit(category_id):
-    """Get the spending limit for a category."""
-    conn = get_db_connection()
-    if not conn:
-        return None
+_ANOMALY_DETECTORS = {}
+
+def _anomaly_detector(user_id):
+    """Return the user's anomaly detector, seeding it from their expenses if needed."""
+    detector = _ANOMALY_DETECTORS.get(user_id)
+    if detector is None:
+        detector = _ANOMALY_DETECTORS[user_id] = AnomalyDetector(user_id)
+    if detector.stale:
+        with _replica_paused(user_id):
+            detector.rescan()
+    return detector
+
+def scan_expense_anomalies(user_id):
+    """Rescan all of a user's expenses; returns expense_id -> reasons for the unusual ones."""
+    detector = _ANOMALY_DETECTORS.setdefault(user_id, AnomalyDetector(user_id))
+    with _replica_paused(user_id):
+        return detector.rescan()
+
+def _reset_anomaly_detectors(user_id, deltas):
+    # Only a restore (all users, recompute) invalidates the statistics. Writes by
+    # this process are recorded directly, and other notifications carry no
+    # per-expense amounts to learn from.
+    if user_id is None and deltas is None:
+        for detector in _ANOMALY_DETECTORS.values():
+            detector.stale = True
+
+register_expense_listener(_reset_anomaly_detectors)
+
+# --- Backup and Restore ---
+
+"""
+Backup file format (all integers little-endian):
+
+    header:       b"EVBACKUP" | u16 version | i64 created_at (unix seconds)
+    table header: u8 1 | u16 name length | name | u16 column count |
+                  per column: u16 name length | name | u8 type | u8 nullable
+    row chunk:    u8 2 | u32 row count | per column: u32 length | zlib payload
+    end:          u8 0
+
+Column types: b'q' int64, b'c' money as int64 cents, b'd' date as int64 day number
+(MySQL TO_DAYS), b's' UTF-8 text stored as an int32 length array followed by the bytes.
+A nullable column payload starts with one null-flag byte per row. Generated columns are
+not stored; they are recomputed by MySQL on restore.
+"""
+BACKUP_MAGIC = b"EVBACKUP"
+BACKUP_VERSION = 1
+BACKUP_CHUNK_ROWS = 65536
+RESTORE_INSERT_ROWS = 5000
+
+def _backup_column_type(data_type):
+    """Map a MySQL data type to a backup column type code."""
+    data_type = data_type.lower()
+    if data_type == "decimal":
+        return b"c"
+    if data_type == "date":
+        return b"d"
+    if data_type.endswith("int"):
+        return b"q"
+    return b"s"
+
+def _stored_columns(cursor, table):
+    """Return (name, type code, nullable) for a table's non-generated columns."""
+    cursor.execute("""
+        SELECT COLUMN_NAME, DATA_TYPE, IS_NULLABLE, EXTRA FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        ORDER BY ORDINAL_POSITION
+    """, (table,))
+    return [
+        (name, _backup_column_type(data_type), nullable == "YES")
+        for name, data_type, nullable, extra in cursor.fetchall()
+        if "GENERATED" not in (extra or "").upper()
+    ]
+
+def _backup_select_expr(name, col_type):
+    if col_type == b"c":
+        return f"CAST(ROUND(`{name}` * 100) AS SIGNED)"
+    if col_type == b"d":
+        return f"TO_DAYS(`{name}`)"
+    if col_type == b"s":
+        return f"CAST(`{name}` AS CHAR)"
+    return f"`{name}`"
+
+def _restore_value_expr(col_type):
+    if col_type == b"c":
+        return "%s / 100"
+    if col_type == b"d":
+        return "FROM_DAYS(%s)"
+    return "%s"
+
+def _encode_column(values, col_type, nullable):
+    parts = []
+    if nullable:
+        parts.append(bytes(1 if v is None else 0 for v in values))
+    if col_type == b"s":
+        encoded = [b"" if v is None else v.encode("utf-8") for v in values]
+        parts.append(array("i", map(len, encoded)).tobytes())
+        parts.append(b"".join(encoded))
+    else:
+        parts.append(array("q", [0 if v is None else v for v in values]).tobytes())
+    return zlib.compress(b"".join(parts), 1)
+
+def _decode_column(payload, row_count, col_type, nullable):
+    data = zlib.decompress(payload)
+    nulls = None
+    if nullable:
+        nulls, data = data[:row_count], data[row_count:]
+    if col_type == b"s":
+        lengths = array("i")
+        lengths.frombytes(data[:4 * row_count])
+        text = data[4 * row_count:]
+        values, offset = [], 0
+        for length in lengths:
+            values.append(text[offset:offset + length].decode("utf-8"))
+            offset += length
+    else:
+        numbers = array("q")
+        numbers.frombytes(data)
+        values = numbers.tolist()
+    if nulls:
+        values = [None if is_null else v for v, is_null in zip(values, nulls)]
+    return values
+
+def _write_string(f, text):
+    encoded = text.encode("utf-8")
+    f.write(struct.pack("<H", len(encoded)))
+    f.write(encoded)
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise struct.error("Backup file is truncated")
+    return data
+
+def _read_string(f):
+    (length,) = struct.unpack("<H", _read_exact(f, 2))
+    return _read_exact(f, length).decode("utf-8")
+
+def _read_backup_records(f):
+    """Yield the records of a backup file positioned after its header.
     
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT limit_amount FROM category_limits WHERE category_id = %s", (category_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
-    except mysql.connector.Error as e:
-        print(f"Error getting category limit: {e}")
-        return None
-    finally:
-        conn.close()
+    Yields ('table', name, columns) with (name, type code, nullable) columns, and
+    ('rows', row_count, payloads) with one compressed payload per column.
+    """
+    columns = []
+    while True:
+        (kind,) = struct.unpack("<B", _read_exact(f, 1))
+        if kind == 0:
+            return
+        if kind == 1:
+            table = _read_string(f)
+            (column_count,) = struct.unpack("<H", _read_exact(f, 2))
+            columns = []
+            for _ in range(column_count):
+                name = _read_string(f)
+                col_type, nullable = _read_exact(f, 1), struct.unpack("<B", _read_exact(f, 1))[0]
+                columns.append((name, col_type, bool(nullable)))
+            yield 'table', table, columns
+            continue
+        (row_count,) = struct.unpack("<I", _read_exact(f, 4))
+        payloads = []
+        for _ in columns:
+            (length,) = struct.unpack("<I", _read_exact(f, 4))
+            payloads.append(_read_exact(f, length))
+        yield 'rows', row_count, payloads
+
+def _validate_backup(f):
+    """Decode a whole backup file after its header without loading anything.
+    
+    Raises struct.error, zlib.error or ValueError if any part of it is unreadable,
+    so a damaged file is refused before the restore deletes anything.
+    
+    Returns:
+        int: Number of rows in the file.
+    """
+    columns, total_rows = [], 0
+    for kind, first, second in _read_backup_records(f):
+        if kind == 'table':
+            columns = second
+            continue
+        for (name, col_type, nullable), payload in zip(columns, second):
+            if len(_decode_column(payload, first, col_type, nullable)) != first:
+                raise ValueError(f"Column {name} has the wrong number of rows")
+        total_rows += first
+    if f.read(1):
+        raise ValueError("Unexpected data after the end of the backup")
+    return total_rows
 
-def get_category_spending(category_id, start_date=None, end_date=None):
-    """Get the total spending for a category with optional date range."""
+def backup_database(path, progress=None):
+    """Stream every application table into a compressed columnar backup file.
+    
+    All tables are read inside one consistent-snapshot transaction, so the backup
+    reflects a single point in time even while other clients keep writing.
+    
+    Args:
+        path: Destination file.
+        progress: Optional callable(table, rows_done) called after each chunk.
+    
+    Returns:
+        tuple: (success, message)
+    """
+    print(f"\n--- BACKING UP DATABASE TO {path} ---")
     conn = get_db_connection()
     if not conn:
-        return 0
-    
+        return False, "Database connection failed"
+    tmp_path = path + ".tmp"
+    total_rows = 0
     try:
+        conn.start_transaction(consistent_snapshot=True, readonly=True)
         cursor = conn.cursor()
-        query = "SELECT SUM(amount) FROM expenses WHERE category_id = %s"
-        params = [category_id]
-        
-        if start_date:
-            query += " AND date >= %s"
-            params.append(start_date)
-        if end_date:
-            query += " AND date <= %s"
-            params.append(end_date)
-            
-        cursor.execute(query, params)
-        result = cursor.fetchone()
-        return float(result[0]) if result[0] else 0
-    except mysql.connector.Error as e:
-        print(f"Error getting category spending: {e}")
-        return 0
+        with open(tmp_path, "wb") as f:
+            f.write(BACKUP_MAGIC)
+            f.write(struct.pack("<Hq", BACKUP_VERSION, int(datetime.now().timestamp())))
+            for table in APP_TABLES:
+                columns = _stored_columns(cursor, table)
+                f.write(struct.pack("<B", 1))
+                _write_string(f, table)
+                f.write(struct.pack("<H", len(columns)))
+                for name, col_type, nullable in columns:
+                    _write_string(f, name)
+                    f.write(col_type + struct.pack("<B", nullable))
+                
+                select_list = ", ".join(_backup_select_expr(name, col_type) for name, col_type, _ in columns)
+                cursor.execute(f"SELECT {select_list} FROM `{table}`")
+                table_rows = 0
+                while True:
+                    rows = cursor.fetchmany(BACKUP_CHUNK_ROWS)
+                    if not rows:
+                        break
+                    f.write(struct.pack("<BI", 2, len(rows)))
+                    for (name, col_type, nullable), values in zip(columns, zip(*rows)):
+                        payload = _encode_column(values, col_type, nullable)
+                        f.write(struct.pack("<I", len(payload)))
+                        f.write(payload)
+                    table_rows += len(rows)
+                    if progress:
+                        progress(table, table_rows)
+                print(f"Backed up {table_rows} rows from {table}")
+                total_rows += table_rows
+            f.write(struct.pack("<B", 0))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return True, f"Backed up {total_rows} rows to {path}"
+    except (mysql.connector.Error, OSError) as e:
+        print(f"Error backing up database: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False, f"Backup failed: {e}"
     finally:
+        conn.rollback()
         conn.close()
+        print("--- BACKUP COMPLETE ---\n")
 
-def check_limit_exceeded(category_id, current_month=True):
-    """Check if a category's spending exceeds its limit.
+def _restore_secondary_indexes(cursor, dropped_indexes):
+    """Re-add the indexes removed by _drop_secondary_indexes, one ALTER per table.
     
-    Args:
-        category_id: The category ID to check
-        current_month: If True, only check the current month's expenses
-        
-    Returns:
-        tuple: (exceeded, spent, limit) where exceeded is a boolean
+    Tables are removed from dropped_indexes once rebuilt, so a retry after an
+    error only touches the rest.
     """
-    limit = get_category_limit(category_id)
-    if not limit:
-        return False, 0, 0  # No limit set
-    
-    start_date = None
-    end_date = None
+    for table in list(dropped_indexes):
+        definitions = dropped_indexes[table]
+        if definitions:
+            print(f"Rebuilding {len(definitions)} indexes on {table}")
+            cursor.execute(
+                f"ALTER TABLE `{table}` " + ", ".join(f"ADD {definition}" for _, definition in definitions)
+            )
+        del dropped_indexes[table]
+
+def _drop_secondary_indexes(cursor, table):
+    """Drop a table's secondary indexes before a bulk load and return their definitions.
     
-    if current_month:
-        today = datetime.now()
-        start_date = datetime(today.year, today.month, 1).strftime("%Y-%m-%d")
-        
-    # Calculate spending for the specified period (current month by default)
-    spent = get_category_spending(category_id, start_date, end_date)
-    return spent > limit, spent, limit
+    Indexes whose first column carries a foreign key are kept, because MySQL needs
+    them to enforce the constraint.
+    """
+    cursor.execute("""
+        SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND REFERENCED_TABLE_NAME IS NOT NULL
+    """, (table,))
+    fk_columns = {row[0] for row in cursor.fetchall()}
+    cursor.execute(f"SHOW INDEX FROM `{table}`")
+    indexes = {}
+    for row in cursor.fetchall():
+        key_name, seq, column, sub_part = row[2], row[3], row[4], row[7]
+        if key_name == "PRIMARY":
+            continue
+        index = indexes.setdefault(key_name, {"unique": row[1] == 0, "columns": {}})
+        index["columns"][seq] = f"`{column}`" + (f"({sub_part})" if sub_part else "")
+    definitions = []
+    for key_name, index in indexes.items():
+        columns = [index["columns"][seq] for seq in sorted(index["columns"])]
+        if columns[0].split("`")[1] in fk_columns:
+            continue
+        kind = "UNIQUE KEY" if index["unique"] else "INDEX"
+        definitions.append((key_name, f"{kind} `{key_name}` ({', '.join(columns)})"))
+    if definitions:
+        cursor.execute(
+            f"ALTER TABLE `{table}` " + ", ".join(f"DROP INDEX `{name}`" for name, _ in definitions)
+        )
+    return definitions
 
-def get_all_category_limits_with_spending():
-    """Get all categories with their limits and current spending."""
-    print("Fetching all categories with limits and spending data")
+def restore_database(path, progress=None):
+    """Replace all application data with the contents of a backup file.
+    
+    The whole file is decoded first and refused if any part of it is damaged,
+    since TRUNCATE can't be rolled back. Tables are then truncated, their
+    secondary indexes dropped, the rows bulk loaded with multi-row INSERTs, and
+    the indexes rebuilt in one pass per table; if loading fails the dropped
+    indexes are still rebuilt. Columns missing from the current schema are skipped.
+    
+    Args:
+        path: Backup file written by backup_database.
+        progress: Optional callable(table, rows_done) called after each chunk.
+    
+    Returns:
+        tuple: (success, message)
+    """
+    print(f"\n--- RESTORING DATABASE FROM {path} ---")
     conn = get_db_connection()
     if not conn:
-        print("Database connection failed in get_all_category_limits_with_spending")
-        return []
-    
+        return False, "Database connection failed"
+    dropped_indexes = {}
+    total_rows = 0
     try:
         cursor = conn.cursor()
-        
-        # Get all categories
-        print("Executing query to fetch all categories")
-        cursor.execute("SELECT id, name FROM categories ORDER BY name")
-        categories = cursor.fetchall()
-        print(f"Found {len(categories)} categories in database")
-        
-        if not categories:
-            print("No categories found in database")
-            return []
+        with open(path, "rb") as f:
+            if f.read(len(BACKUP_MAGIC)) != BACKUP_MAGIC:
+                return False, "Not an ExpenseVault backup file"
+            version, _ = struct.unpack("<Hq", _read_exact(f, 10))
+            if version > BACKUP_VERSION:
+                return False, f"Backup format version {version} is not supported"
             
-        result = []
-        today = datetime.now()
-        start_date = datetime(today.year, today.month, 1).strftime("%Y-%m-%d")
+            records_start = f.tell()
+            print(f"Verified {_validate_backup(f)} rows in backup")
+            f.seek(records_start)
+            
+            cursor.execute("SET foreign_key_checks = 0, unique_checks = 0")
+            for table in APP_TABLES:
+                cursor.execute(f"TRUNCATE TABLE `{table}`")
+            
+            table, columns, insert_prefix, row_sql, keep = None, [], "", "", []
+            for kind, first, second in _read_backup_records(f):
+                if kind == 'table':
+                    table, columns = first, second
+                    if table not in APP_TABLES:
+                        print(f"Skipping unknown table {table}")
+                        keep = []
+                        continue
+                    existing = {name for name, _, _ in _stored_columns(cursor, table)}
+                    keep = [i for i, (name, _, _) in enumerate(columns) if name in existing]
+                    insert_prefix = (
+                        f"INSERT INTO `{table}` ("
+                        + ", ".join(f"`{columns[i][0]}`" for i in keep) + ") VALUES "
+                    )
+                    row_sql = "(" + ", ".join(_restore_value_expr(columns[i][1]) for i in keep) + ")"
+                    dropped_indexes[table] = _drop_secondary_indexes(cursor, table)
+                    table_rows = 0
+                    continue
+                
+                if not keep:
+                    continue
+                row_count = first
+                values = [
+                    _decode_column(payload, row_count, col_type, nullable)
+                    for (name, col_type, nullable), payload in zip(columns, second)
+                ]
+                rows = list(zip(*(values[i] for i in keep)))
+                for start in range(0, len(rows), RESTORE_INSERT_ROWS):
+                    batch = rows[start:start + RESTORE_INSERT_ROWS]
+                    cursor.execute(
+                        insert_prefix + ", ".join([row_sql] * len(batch)),
+                        [value for row in batch for value in row]
+                    )
+                conn.commit()
+                table_rows += row_count
+                total_rows += row_count
+                if progress:
+                    progress(table, table_rows)
         
-        for cat_id, cat_name in categories:
-            print(f"Processing category {cat_name} (ID: {cat_id})")
+        _restore_secondary_indexes(cursor, dropped_indexes)
+        # Tell local replicas everywhere that their copies predate the restore
+        cursor.execute(
+            "INSERT INTO app_settings (name, value) VALUES ('data_epoch', %s) "
+            "ON DUPLICATE KEY UPDATE value = VALUES(value)",
+            (str(uuid.uuid4()),)
+        )
+        conn.commit()
+        _note_primary_write()
+        if LOCAL_REPLICA is not None:
+            LOCAL_REPLICA.reset()
+        _notify_expense_listeners(None, None)
+        return True, f"Restored {total_rows} rows from {path}"
+    except (mysql.connector.Error, OSError, ValueError, struct.error, zlib.error) as e:
+        print(f"Error restoring database: {e}")
+        conn.rollback()
+        while dropped_indexes:
             try:
-                # Get limit if exists
-                cursor.execute("SELECT limit_amount FROM category_limits WHERE category_id = %s", (cat_id,))
-                limit_result = cursor.fetchone()
-                limit = float(limit_result[0]) if limit_result else None
-                print(f"  - Limit: {limit}")
-                
-                # Get current month spending
-                cursor.execute(
-                    "SELECT SUM(amount) FROM expenses WHERE category_id = %s AND date >= %s", 
-                    (cat_id, start_date)
-                )
-                spent_result = cursor.fetchone()
-                spent = float(spent_result[0]) if spent_result[0] else 0
-                print(f"  - Spent: {spent}")
-                
-                # Check if exceeded
-                exceeded = False
-                if limit is not None:
-                    exceeded = spent > limit
-                    
-                result.append({
-                    'id': cat_id,
-                    'name': cat_name,
-                    'limit': limit,
-                    'spent': spent,
-                    'exceeded': exceeded
-                })
-            except Exception as e:
-                print(f"Error processing category {cat_name}: {e}")
-                # Continue with other categories even if one fails
-            
-        print(f"Returning data for {len(result)} categories")
-        return result
-    except mysql.connector.Error as e:
-        print(f"Database error in get_all_category_limits_with_spending: {e}")
-        return []
-    except Exception as e:
-        print(f"Unexpected error in get_all_category_limits_with_spending: {e}")
-        return []
+                _restore_secondary_indexes(cursor, dropped_indexes)
+            except mysql.connector.Error as index_error:
+                table = next(iter(dropped_indexes))
+                print(f"Error rebuilding indexes on {table} after failed restore: {index_error}")
+                del dropped_indexes[table]
+        return False, f"Restore failed: {e}"
     finally:
+        try:
+            cursor.execute("SET foreign_key_checks = 1, unique_checks = 1")
+        except mysql.connector.Error:
+            pass
         conn.close()
-        print("Database connection closed")
+        print("--- RESTORE COMPLETE ---\n")
 
 # --- UI Classes ---
 
+class UserSelectionDialog(QDialog):
+    """Dialog for choosing (or creating) the user whose data is shown."""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Select User")
+        self.setMinimumWidth(300)
+        self.setStyleSheet("background-color: black; color: white;")
+        self.user_id = None
+        self.username = None
+        
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel("User:"))
+        self.user_combo = QComboBox()
+        self.user_combo.setStyleSheet("background-color: #333333; color: white;")
+        layout.addWidget(self.user_combo)
+        self.load_users()
+        
+        button_layout = QHBoxLayout()
+        select_btn = QPushButton("Select")
+        select_btn.setStyleSheet("background-color: #333333; color: white;")
+        select_btn.clicked.connect(self.select_user)
+        button_layout.addWidget(select_btn)
+        
+        new_btn = QPushButton("New User")
+        new_btn.setStyleSheet("background-color: #333333; color: white;")
+        new_btn.clicked.connect(self.add_user)
+        button_layout.addWidget(new_btn)
+        
+        cancel_btn = QPushButton("Cancel")
+        cancel_btn.setStyleSheet("background-color: #444444; color: white;")
+        cancel_btn.clicked.connect(self.reject)
+        button_layout.addWidget(cancel_btn)
+        layout.addLayout(button_layout)
+        
+        self.setLayout(layout)
+    
+    def load_users(self, selected_id=None):
+        self.user_combo.clear()
+        for user_id, username in get_users():
+            self.user_combo.addItem(username, user_id)
+            if user_id == selected_id:
+                self.user_combo.setCurrentIndex(self.user_combo.count() - 1)
+    
+    def add_user(self):
+        name, ok = QInputDialog.getText(self, "New User", "Enter username:")
+        if ok and name.strip():
+            success, message, user_id = add_user(name.strip())
+            if success:
+                self.load_users(user_id)
+            else:
+                QMessageBox.critical(self, "Error", message)
+    
+    def select_user(self):
+        if self.user_combo.currentIndex() < 0:
+            QMessageBox.warning(self, "No User", "Please create a user first")
+            return
+        self.user_id = self.user_combo.currentData()
+        self.username = self.user_combo.currentText()
+        self.accept()
+
 class MainWindow(QMainWindow):
     """Main application window."""
-    def __init__(self):
+    def __init__(self, user_id, username):
         super().__init__()
+        self.user_id = user_id
+        self.username = username
+        if LOCAL_REPLICA is not None:
+            # Keep this user's local replica current from now on
+            LOCAL_REPLICA.active_user_id = user_id
+            SYNC_WORKER.wake()
         self.setWindowTitle("Expense Tracker")
         self.setGeometry(100, 100, 400, 300)
         self.setStyleSheet("background-color: black; color: white;")
@@ -687,7 +6418,11 @@ class MainWindow(QMainWindow):
         self.category_window = None
         self.expense_view_window = None
         self.add_expense_window = None
+        self.batch_window = None
+        self.import_window = None
         self.chart_window = None
+        self.pivot_window = None
+        self.payee_window = None
         self.limit_window = None
         
         central_widget = QWidget()
@@ -699,6 +6434,10 @@ class MainWindow(QMainWindow):
         title.setStyleSheet("font-size: 16pt; font-weight: bold;")
         layout.addWidget(title)
         
+        self.user_label = QLabel(f"Signed in as: {self.username}")
+        self.user_label.setStyleSheet("color: #CCCCCC;")
+        layout.addWidget(self.user_label)
+        
         # Add alert indicator for exceeded limits
         self.alert_label = QLabel("")
         self.alert_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
@@ -706,11 +6445,29 @@ class MainWindow(QMainWindow):
         layout.addWidget(self.alert_label)
         self.check_for_limit_alerts()
         
+        # Show operations waiting in the offline write queue
+        self.sync_label = QLabel("")
+        self.sync_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.sync_label.setStyleSheet("color: #FFCC66;")
+        layout.addWidget(self.sync_label)
+        self.pending_writes = 0
+        self.sync_timer = QTimer(self)
+        self.sync_timer.timeout.connect(self.update_sync_status)
+        self.sync_timer.start(2000)
+        self.update_sync_status()
+        
         buttons = [
             ("View Expenses", self.open_view_categories),
             ("Add Expense", self.open_add_categories),
+            ("Batch Entry", self.open_batch_entry),
+            ("Import Statement", self.open_import),
             ("Manage Limits", self.open_limits),
             ("View Chart", self.show_chart),
+            ("Spending by Month", self.show_pivot),
+            ("Spending by Payee", self.show_payees),
+            ("Switch User", self.switch_user),
+            ("Backup Data", self.backup_data),
+            ("Restore Data", self.restore_data),
             ("Exit", self.close)
         ]
         for text, slot in buttons:
@@ -725,17 +6482,17 @@ class MainWindow(QMainWindow):
         """Check for categories that have exceeded their limits and show alert."""
         exceeded_categories = []
         
-        categories_with_limits = get_all_category_limits_with_spending()
+        categories_with_limits = get_all_category_limits_with_spending(self.user_id)
         for cat in categories_with_limits:
-            if cat['limit'] and cat['exceeded']:
-                exceeded_categories.append(cat['name'])
+            if cat.limit and cat.exceeded:
+                exceeded_categories.append(cat.name)
         
         if exceeded_categories:
             if len(exceeded_categories) == 1:
-                alert_text = f"⚠️ Warning: '{exceeded_categories[0]}' has exceeded its monthly budget limit!"
+                alert_text = f"⚠️ Warning: '{exceeded_categories[0]}' has exceeded its budget limit!"
             else:
                 cat_list = ", ".join(f"'{cat}'" for cat in exceeded_categories)
-                alert_text = f"⚠️ Warning: {len(exceeded_categories)} categories have exceeded their monthly budget limits: {cat_list}"
+                alert_text = f"⚠️ Warning: {len(exceeded_categories)} categories have exceeded their budget limits: {cat_list}"
                 
             self.alert_label.setText(alert_text)
             self.alert_label.setStyleSheet("color: red; font-weight: bold; border: 2px solid red; padding: 10px; margin: 10px; border-radius: 5px; background-color: rgba(255, 0, 0, 0.1);")
@@ -743,18 +6500,99 @@ class MainWindow(QMainWindow):
             self.alert_label.setText("")
             self.alert_label.setStyleSheet("")
 
+    def update_sync_status(self):
+        """Show queued offline writes and whether the local replica is stale."""
+        messages = []
+        pending = OFFLINE_QUEUE.pending_count()
+        if pending:
+            messages.append(f"{pending} change(s) saved offline, waiting for the database")
+        elif self.pending_writes:
+            # The queue just drained; the alerts may have changed
+            self.check_for_limit_alerts()
+        self.pending_writes = pending
+        
+        if LOCAL_REPLICA is not None and LOCAL_REPLICA.last_error:
+            synced_at = LOCAL_REPLICA.synced_at(self.user_id)
+            if synced_at:
+                messages.append(f"Can't sync - showing data as of {synced_at.strftime('%d %b %H:%M')}")
+            else:
+                messages.append("Can't sync - local data not available yet")
+        
+        for name, (deleted, total) in CATEGORY_PURGE_WORKER.progress.items():
+            messages.append(f"Removing '{name}': {deleted:,} of {total:,} expenses deleted")
+        self.sync_label.setText("\n".join(messages))
+
+    def switch_user(self):
+        dialog = UserSelectionDialog(self)
+        if dialog.exec() and dialog.user_id:
+            self.user_id = dialog.user_id
+            self.username = dialog.username
+            if LOCAL_REPLICA is not None:
+                LOCAL_REPLICA.active_user_id = self.user_id
+                SYNC_WORKER.wake()
+            self.user_label.setText(f"Signed in as: {self.username}")
+            self.check_for_limit_alerts()
+
+    def _show_backup_progress(self, table, rows):
+        self.sync_label.setText(f"{table}: {rows} rows")
+        QApplication.processEvents()
+
+    def backup_data(self):
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Backup Data", f"expensevault-{datetime.now():%Y%m%d-%H%M}.evbak",
+            "ExpenseVault backups (*.evbak)"
+        )
+        if not path:
+            return
+        success, message = backup_database(path, self._show_backup_progress)
+        self.update_sync_status()
+        if success:
+            QMessageBox.information(self, "Backup", message)
+        else:
+            QMessageBox.warning(self, "Backup", message)
+
+    def restore_data(self):
+        path, _ = QFileDialog.getOpenFileName(
+            self, "Restore Data", "", "ExpenseVault backups (*.evbak)"
+        )
+        if not path:
+            return
+        reply = QMessageBox.question(
+            self, "Confirm Restore",
+            "Restoring replaces ALL data for every user with the contents of the backup. Continue?",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+        )
+        if reply != QMessageBox.StandardButton.Yes:
+            return
+        success, message = restore_database(path, self._show_backup_progress)
+        self.update_sync_status()
+        if success:
+            SYNC_WORKER.wake()
+            self.check_for_limit_alerts()
+            QMessageBox.information(self, "Restore", message)
+        else:
+            QMessageBox.warning(self, "Restore", message)
+
     def open_view_categories(self):
-        self.category_window = CategorySelectionWindow(self.view_expenses)
+        self.category_window = CategorySelectionWindow(self.user_id, self.view_expenses)
         self.category_window.show()
 
     def open_add_categories(self):
-        self.category_window = CategorySelectionWindow(self.add_expense)
+        self.category_window = CategorySelectionWindow(self.user_id, self.add_expense)
         self.category_window.show()
+
+    def open_batch_entry(self):
+        self.batch_window = BatchEntryWindow(self.user_id, self.check_for_limit_alerts)
+        self.batch_window.show()
+
+    def open_import(self):
+        self.import_window = ImportWindow(self.user_id, self.check_for_limit_alerts)
+        self.import_window.show()
         
     def open_limits(self):
         print("--- Opening CategoryLimitsWindow ---")
         try:
-            self.limit_window = CategoryLimitsWindow()
+            self.limit_window = CategoryLimitsWindow(self.user_id)
             self.limit_window.show()
             print("--- CategoryLimitsWindow opened successfully ---")
         except Exception as e:
@@ -763,22 +6601,151 @@ class MainWindow(QMainWindow):
             traceback.print_exc()
 
     def view_expenses(self, category):
-        self.expense_view_window = ExpenseViewWindow(category)
+        self.expense_view_window = ExpenseViewWindow(self.user_id, category)
         self.expense_view_window.show()
 
     def add_expense(self, category):
-        self.add_expense_window = AddExpenseWindow(category)
+        self.add_expense_window = AddExpenseWindow(self.user_id, category)
         self.add_expense_window.show()
 
     def show_chart(self):
         print("Opening chart window...")
-        self.chart_window = ChartWindow()
+        self.chart_window = ChartWindow(self.user_id)
         self.chart_window.show()
 
+    def show_pivot(self):
+        self.pivot_window = PivotWindow(self.user_id)
+        self.pivot_window.show()
+
+    def show_payees(self):
+        self.payee_window = PayeeWindow(self.user_id)
+        self.payee_window.show()
+
+class CategoryListModel(QAbstractListModel):
+    """A user's categories for a list view, handed to it in batches as it scrolls.
+    
+    The recently used categories are listed first, then every category in tree
+    order. The tree is read with one query; only the rows the view has reached
+    are exposed (canFetchMore/fetchMore), so opening the picker doesn't depend on
+    how many categories there are.
+    """
+    IdRole = Qt.ItemDataRole.UserRole
+    NameRole = Qt.ItemDataRole.UserRole + 1
+    SearchRole = Qt.ItemDataRole.UserRole + 2
+
+    def __init__(self, user_id, parent=None):
+        super().__init__(parent)
+        self.user_id = user_id
+        self.tree = []
+        self.rows = []
+        self.recent_count = 0
+        self.recent_ids = set()
+        self.loaded = 0
+        self.reload()
+
+    def reload(self):
+        self.beginResetModel()
+        self.tree = get_category_tree(self.user_id)
+        by_id = {node[0]: node for node in self.tree}
+        recent = [by_id[category_id] for category_id in get_recent_category_ids(self.user_id)
+                  if category_id in by_id]
+        # Each row is (id, name, path, display text, lower-case path to search)
+        self.rows = [
+            (category_id, name, path, "★ " + " > ".join(path), " > ".join(path).lower())
+            for category_id, name, _, path in recent
+        ] + [
+            (category_id, name, path, "    " * (len(path) - 1) + name, " > ".join(path).lower())
+            for category_id, name, _, path in self.tree
+        ]
+        self.recent_count = len(recent)
+        self.recent_ids = {node[0] for node in recent}
+        self.loaded = min(len(self.rows), CATEGORY_PICKER_CONFIG["batch_size"])
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.loaded
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.loaded < len(self.rows)
+
+    def fetchMore(self, parent):
+        count = min(len(self.rows) - self.loaded, CATEGORY_PICKER_CONFIG["batch_size"])
+        self.beginInsertRows(QModelIndex(), self.loaded, self.loaded + count - 1)
+        self.loaded += count
+        self.endInsertRows()
+
+    def fetch_all(self):
+        """Expose every row, e.g. before searching."""
+        if self.loaded < len(self.rows):
+            self.beginInsertRows(QModelIndex(), self.loaded, len(self.rows) - 1)
+            self.loaded = len(self.rows)
+            self.endInsertRows()
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= self.loaded:
+            return None
+        category_id, name, path, text, search = self.rows[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return text
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return " > ".join(path)
+        if role == self.IdRole:
+            return category_id
+        if role == self.NameRole:
+            return name
+        if role == self.SearchRole:
+            return search
+        return None
+
+class CategoryFilterProxy(QSortFilterProxyModel):
+    """Type-ahead filter over a CategoryListModel.
+    
+    A row matches when the search text appears anywhere in its path, so typing a
+    parent's name also finds its subcategories. Typing more letters can only
+    narrow the matches, so then only the rows that matched before are checked.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.search = ""
+        self.matches = set()
+        self.candidates = None
+
+    def set_search(self, text, narrow=True):
+        text = text.strip().lower()
+        narrowing = narrow and self.search and text.startswith(self.search)
+        self.candidates = self.matches if narrowing else None
+        self.search = text
+        self.matches = set()
+        if text:
+            self.sourceModel().fetch_all()
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if not self.search:
+            return True
+        if self.candidates is not None and source_row not in self.candidates:
+            return False
+        model = self.sourceModel()
+        category_id, _, _, _, search = model.rows[source_row]
+        if self.search not in search:
+            return False
+        # The recently used matches are already at the top; don't list them twice
+        if source_row >= model.recent_count and category_id in model.recent_ids:
+            return False
+        self.matches.add(source_row)
+        return True
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        # While searching, matches are shown with their full path instead of indented
+        if self.search and role == Qt.ItemDataRole.DisplayRole:
+            return super().data(index, Qt.ItemDataRole.ToolTipRole)
+        return super().data(index, role)
+
 class CategorySelectionWindow(QWidget):
     """Window for selecting and managing categories."""
-    def __init__(self, action):
+    def __init__(self, user_id, action):
         super().__init__()
+        self.user_id = user_id
         self.action = action
         self.setWindowTitle("Select Category")
         self.setGeometry(100, 100, 300, 400)
@@ -795,13 +6762,36 @@ class CategorySelectionWindow(QWidget):
         self.status_label.setStyleSheet("color: #FFCC66; margin: 10px;")
         self.layout.addWidget(self.status_label)
         
-        self.update_categories()
+        # Type to filter; Enter picks the highlighted (or first) match
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText("Type to search categories...")
+        self.search_edit.setStyleSheet("background-color: #333333; color: white; border: 1px solid white;")
+        self.search_edit.textChanged.connect(self.filter_categories)
+        self.search_edit.returnPressed.connect(self.select_current)
+        self.search_edit.installEventFilter(self)
+        self.layout.addWidget(self.search_edit)
+        
+        # Only the visible rows are drawn, however many categories there are
+        self.model = CategoryListModel(self.user_id, self)
+        self.proxy = CategoryFilterProxy(self)
+        self.proxy.setSourceModel(self.model)
+        self.list_view = QListView()
+        self.list_view.setModel(self.proxy)
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setStyleSheet("background-color: black; color: white; border: 1px solid white;")
+        self.list_view.activated.connect(self.select_index)
+        self.layout.addWidget(self.list_view)
         
         add_btn = QPushButton("Add Category")
         add_btn.setStyleSheet("background-color: #333333; color: white; border: 1px solid white;")
         add_btn.clicked.connect(self.add_category)
         self.layout.addWidget(add_btn)
         
+        move_btn = QPushButton("Move Category")
+        move_btn.setStyleSheet("background-color: #333333; color: white; border: 1px solid white;")
+        move_btn.clicked.connect(self.move_category)
+        self.layout.addWidget(move_btn)
+        
         remove_btn = QPushButton("Remove Category")
         remove_btn.setStyleSheet("background-color: #333333; color: white; border: 1px solid white;")
         remove_btn.clicked.connect(self.remove_category)
@@ -813,73 +6803,133 @@ class CategorySelectionWindow(QWidget):
         self.layout.addWidget(back_btn)
         
         self.setLayout(self.layout)
+        self.update_status()
+        self.search_edit.setFocus()
 
     def update_categories(self):
         print("Updating category selection window")
-        # Clear existing category buttons
-        for i in reversed(range(self.layout.count())):
-            widget = self.layout.itemAt(i).widget()
-            if isinstance(widget, QPushButton) and widget.text() not in ["Add Category", "Remove Category", "Back"]:
-                self.layout.removeWidget(widget)
-                widget.deleteLater()
-                
-        # Get categories from database
-        categories = get_categories()
-        
-        if not categories:
+        self.model.reload()
+        self.proxy.set_search(self.search_edit.text(), narrow=False)
+        self.update_status()
+
+    def update_status(self):
+        if not self.model.tree:
             self.status_label.setText("No categories found. Please add a category first.")
             self.status_label.setStyleSheet("color: #FF9966; font-size: 12pt; margin: 20px;")
             print("No categories found to display")
-            return
+        elif self.proxy.search and not self.proxy.rowCount():
+            self.status_label.setText("No matching categories")
+            self.status_label.setStyleSheet("color: #FFCC66; margin: 10px;")
         else:
             self.status_label.setText("")
-            
-        print(f"Adding {len(categories)} category buttons to window")
-        
-        # Create buttons for each category
-        for category in categories:
-            btn = QPushButton(category)
-            btn.setStyleSheet("background-color: #333333; color: white; border: 1px solid white;")
-            btn.clicked.connect(lambda checked, c=category: self.select_category(c))
-            self.layout.insertWidget(0, btn)
+
+    def filter_categories(self, text):
+        self.proxy.set_search(text)
+        if self.proxy.rowCount():
+            self.list_view.setCurrentIndex(self.proxy.index(0, 0))
+        self.update_status()
+
+    def eventFilter(self, obj, event):
+        # Up/Down in the search box move through the list
+        if obj is self.search_edit and event.type() == QEvent.Type.KeyPress \
+                and event.key() in (Qt.Key.Key_Up, Qt.Key.Key_Down):
+            row = self.list_view.currentIndex().row()
+            row = row + 1 if event.key() == Qt.Key.Key_Down else row - 1
+            if 0 <= row < self.proxy.rowCount():
+                self.list_view.setCurrentIndex(self.proxy.index(row, 0))
+            return True
+        return super().eventFilter(obj, event)
+
+    def selected_category(self):
+        """The highlighted category as (id, name), or None."""
+        index = self.list_view.currentIndex()
+        if not index.isValid():
+            return None
+        return index.data(CategoryListModel.IdRole), index.data(CategoryListModel.NameRole)
+
+    def select_current(self):
+        if not self.list_view.currentIndex().isValid() and self.proxy.rowCount():
+            self.list_view.setCurrentIndex(self.proxy.index(0, 0))
+        if self.list_view.currentIndex().isValid():
+            self.select_index(self.list_view.currentIndex())
+
+    def select_index(self, index):
+        remember_category_pick(self.user_id, index.data(CategoryListModel.IdRole))
+        self.select_category(index.data(CategoryListModel.NameRole))
 
     def select_category(self, category):
         self.action(category)
         self.close()
 
+    def choose_parent(self, title, exclude=None):
+        """Ask for a parent category; returns (ok, parent_id) with None for top level."""
+        tree = [node for node in self.model.tree if exclude is None or exclude not in node[3]]
+        options = ["(Top level)"] + [" > ".join(path) for _, _, _, path in tree]
+        choice, ok = QInputDialog.getItem(self, title, "Parent category:", options, 0, False)
+        if not ok:
+            return False, None
+        index = options.index(choice)
+        return True, tree[index - 1][0] if index else None
+
     def add_category(self):
         name, ok = QInputDialog.getText(self, "Add Category", "Enter category name:")
         if ok and name.strip():
-            success, message = add_category(name.strip())
+            ok, parent_id = self.choose_parent("Add Category")
+            if not ok:
+                return
+            success, message = add_category(self.user_id, name.strip(), parent_id)
             if success:
                 self.update_categories()
                 QMessageBox.information(self, "Success", message)
             else:
                 QMessageBox.critical(self, "Error", message)
 
+    def move_category(self):
+        selected = self.selected_category()
+        if not selected:
+            QMessageBox.information(self, "Info", "Select the category to move first")
+            return
+        category_id, name = selected
+        # A category can't go below itself, so its own subtree is left out
+        ok, parent_id = self.choose_parent(f"Move '{name}'", exclude=name)
+        if not ok:
+            return
+        success, message = move_category(self.user_id, category_id, parent_id)
+        if success:
+            self.update_categories()
+            QMessageBox.information(self, "Success", message)
+        else:
+            QMessageBox.critical(self, "Error", message)
+
     def remove_category(self):
-        categories = get_categories()
-        if not categories:
-            QMessageBox.information(self, "Info", "No categories to remove")
+        selected = self.selected_category()
+        if not selected:
+            QMessageBox.information(self, "Info", "Select the category to remove first")
             return
-        category, ok = QInputDialog.getItem(self, "Remove Category", "Select category:", categories, 0, False)
-        if ok:
-            reply = QMessageBox.question(self, "Confirm", f"Delete '{category}' and all its expenses?",
-                                        QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
-            if reply == QMessageBox.StandardButton.Yes and remove_category(category):
-                self.update_categories()
-                QMessageBox.information(self, "Success", f"Deleted '{category}'")
+        category = selected[1]
+        reply = QMessageBox.question(self, "Confirm", f"Delete '{category}', its subcategories and all their expenses?",
+                                    QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
+        if reply == QMessageBox.StandardButton.Yes and remove_category(self.user_id, category):
+            self.update_categories()
+            QMessageBox.information(
+                self, "Success",
+                f"Deleted '{category}'. Its expenses are being removed in the background."
+            )
 
 class ExpenseViewWindow(QWidget):
     """Window for viewing and managing expenses."""
-    def __init__(self, category):
+    def __init__(self, user_id, category):
         print(f"--- Initializing ExpenseViewWindow for category: {category} ---")
         super().__init__()
+        self.user_id = user_id
         self.category = category
         self.setWindowTitle(f"{category} Expenses")
         self.setGeometry(100, 100, 600, 400)
         self.setStyleSheet("background-color: black; color: white;")
         self.edit_window = None  # Store reference to edit window
+        self.row_data = {}  # expense ID -> (amount, date) of the rows shown
+        self.row_tags = {}  # expense ID -> tag names of the rows shown
+        self.anomalies = {}  # expense ID -> reasons, from the last "Find Unusual" scan
         
         try:
             self.init_ui()
@@ -905,7 +6955,7 @@ class ExpenseViewWindow(QWidget):
         layout = QVBoxLayout()
         
         # Add a header with category name and limit info
-        self.category_id = get_category_id(self.category)
+        self.category_id = get_category_id(self.user_id, self.category)
         self.limit_label = QLabel()
         self.update_limit_info()
         layout.addWidget(self.limit_label)
@@ -937,12 +6987,43 @@ class ExpenseViewWindow(QWidget):
         filter_layout.addWidget(filter_btn)
         layout.addLayout(filter_layout)
         
+        # Optional tag query, applied together with the date range
+        tag_layout = QHBoxLayout()
+        tag_layout.addWidget(QLabel("Tags:"))
+        self.tag_filter = QLineEdit()
+        self.tag_filter.setPlaceholderText("e.g. trip-2026 AND NOT reimbursable")
+        self.tag_filter.setStyleSheet("background-color: #333333; color: white;")
+        self.tag_filter.setToolTip("Combine tags with AND, OR, NOT and parentheses; "
+                                   "tags next to each other must all match")
+        self.tag_filter.returnPressed.connect(self.update_table)
+        tag_layout.addWidget(self.tag_filter)
+        layout.addLayout(tag_layout)
+        
         self.table = QTableWidget()
-        self.table.setColumnCount(5)
-        self.table.setHorizontalHeaderLabels(["ID", "Amount", "Date", "Edit", "Delete"])
+        self.table.setColumnCount(6)
+        self.table.setHorizontalHeaderLabels(["ID", "Amount", "Date", "Tags", "Edit", "Delete"])
         self.table.setStyleSheet("background-color: black; color: white; border: 1px solid white;")
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
         layout.addWidget(self.table)
         
+        # Actions on all selected rows (Ctrl/Shift+click to select several)
+        bulk_layout = QHBoxLayout()
+        for text, slot in [
+            ("Delete Selected", self.bulk_delete),
+            ("Change Date", self.bulk_redate),
+            ("Move to Category", self.bulk_recategorize),
+            ("Adjust Amount", self.bulk_adjust_amount),
+            ("Edit Tags", self.bulk_tag),
+            ("Find Unusual", self.find_anomalies),
+        ]:
+            btn = QPushButton(text)
+            btn.setStyleSheet("background-color: #333333; color: white;")
+            btn.clicked.connect(slot)
+            bulk_layout.addWidget(btn)
+        layout.addLayout(bulk_layout)
+        
         self.total_label = QLabel("Total: Rs0.00")
         layout.addWidget(self.total_label)
         
@@ -978,10 +7059,15 @@ class ExpenseViewWindow(QWidget):
                 return
                 
             print(f"Found category ID: {self.category_id}, checking limit...")
-            # When checking limit exceeded, we still want to show all expenses based on the filter
-            # so we pass current_month=True just for the limit display, but not for expense fetching
-            exceeded, spent, limit = check_limit_exceeded(self.category_id)
+            # The limit display covers the current budget period, independent of
+            # the date filter used for the expense list
+            budget = get_budget_status(self.user_id, self.category_id)
+            if not budget:
+                self.limit_label.setText(f"Category: {self.category}")
+                return
+            exceeded, spent, limit = budget.exceeded, budget.spent, budget.available
             print(f"Limit check result: exceeded={exceeded}, spent={spent}, limit={limit}")
+            period = _describe_period(budget.period, budget.rolling_days)
             
             if limit:
                 percentage = (spent / limit) * 100 if limit > 0 else 0
@@ -996,17 +7082,18 @@ class ExpenseViewWindow(QWidget):
                     style = "color: green; font-weight: bold;"
                     status = f"{percentage:.1f}% used"
                 
+                carried = f" (incl. Rs{budget.carried:.2f} carried over)" if budget.carried else ""
                 self.limit_label.setText(
                     f"Category: {self.category} | " 
-                    f"Monthly Limit: Rs{limit:.2f} | "
+                    f"{period} Limit: Rs{limit:.2f}{carried} | "
                     f"Spent: Rs{spent:.2f} | {status}"
                 )
                 self.limit_label.setStyleSheet(style)
             else:
                 self.limit_label.setText(
                     f"Category: {self.category} | "
-                    f"No monthly limit set | "
-                    f"Spent this month: Rs{spent:.2f}"
+                    f"No limit set | "
+                    f"{_spent_label(budget)}: Rs{spent:.2f}"
                 )
                 self.limit_label.setStyleSheet("color: white;")
             print("Limit info updated successfully")
@@ -1024,20 +7111,9 @@ class ExpenseViewWindow(QWidget):
             QMessageBox.critical(self, "Error", "Could not find category ID")
             return
             
-        current_limit = get_category_limit(self.category_id) or 0
-        
-        limit, ok = QInputDialog.getDouble(
-            self, 
-            "Set Monthly Limit", 
-            f"Set monthly spending limit for {self.category}:",
-            current_limit,
-            0,
-            1000000,
-            2
-        )
-        
-        if ok:
-            success, message = set_category_limit(self.category_id, limit)
+        dialog = LimitDialog(self.category, get_budget_status(self.user_id, self.category_id), self)
+        if dialog.exec() == QDialog.DialogCode.Accepted:
+            success, message = set_category_limit(self.user_id, self.category_id, *dialog.values())
             if success:
                 self.update_limit_info()
                 QMessageBox.information(self, "Success", message)
@@ -1047,12 +7123,17 @@ class ExpenseViewWindow(QWidget):
     def export_to_csv(self):
         start = self.start_date.date().toString("yyyy-MM-dd")
         end = self.end_date.date().toString("yyyy-MM-dd")
-        expenses, _ = get_expenses(self.category, start, end)
+        try:
+            expenses, _ = get_expenses(self.user_id, self.category, start, end, self.tag_filter.text().strip())
+        except ValueError as e:
+            QMessageBox.warning(self, "Invalid Tag Query", str(e))
+            return
+        tags = get_expense_tags(self.user_id, [e.id for e in expenses])
         with open(f"{self.category}_expenses.csv", "w", newline="") as f:
             writer = csv.writer(f)
-            writer.writerow(["ID", "Amount", "Date"])
+            writer.writerow(["ID", "Amount", "Date", "Tags"])
             for e in expenses:
-                writer.writerow([e[0], e[1], e[2].strftime("%Y-%m-%d")])
+                writer.writerow([e.id, e.amount, e.date.strftime("%Y-%m-%d"), " ".join(tags.get(e.id, []))])
         QMessageBox.information(self, "Success", "Exported to CSV")
 
     def update_table(self):
@@ -1064,9 +7145,15 @@ class ExpenseViewWindow(QWidget):
             end = self.end_date.date().toString("yyyy-MM-dd")
             print(f"Date range: {start} to {end}")
             
-            # Get expenses for the selected category and date range
+            # Get expenses for the selected category, date range and tags
             print(f"Getting expenses for category: {self.category}")
-            expenses, total = get_expenses(self.category, start, end)
+            try:
+                expenses, total = get_expenses(self.user_id, self.category, start, end,
+                                               self.tag_filter.text().strip())
+            except ValueError as e:
+                QMessageBox.warning(self, "Invalid Tag Query", str(e))
+                return
+            self.row_tags = get_expense_tags(self.user_id, [expense.id for expense in expenses])
             print(f"Retrieved {len(expenses)} expenses, total: {total}")
             
             # Update the limit info in case it changed
@@ -1080,36 +7167,10 @@ class ExpenseViewWindow(QWidget):
             
             # Populate the table with expense data
             print(f"Populating table with {len(expenses)} rows...")
-            for i, (id_, amount, date) in enumerate(expenses):
-                print(f"Row {i}: ID={id_}, Amount={amount}, Date={date}")
-                
-                # Make sure all data is properly converted to strings
-                id_item = QTableWidgetItem(str(id_))
-                amount_item = QTableWidgetItem(f"Rs{amount:.2f}")
-                
-                # Ensure date is properly formatted
-                if isinstance(date, datetime):
-                    date_str = date.strftime("%Y-%m-%d")
-                else:
-                    date_str = str(date)
-                date_item = QTableWidgetItem(date_str)
-                
-                # Add items to table with proper flags
-                self.table.setItem(i, 0, id_item)
-                self.table.setItem(i, 1, amount_item)
-                self.table.setItem(i, 2, date_item)
-                
-                # Create edit button
-                edit_btn = QPushButton("Edit")
-                edit_btn.setStyleSheet("background-color: #3357FF; color: white;")
-                edit_btn.clicked.connect(lambda checked, eid=id_, amt=amount, d=date: self.edit_expense(eid, amt, d))
-                self.table.setCellWidget(i, 3, edit_btn)
-                
-                # Create delete button
-                del_btn = QPushButton("Delete")
-                del_btn.setStyleSheet("background-color: #FF5733; color: white;")
-                del_btn.clicked.connect(lambda checked, eid=id_: self.delete_expense(eid))
-                self.table.setCellWidget(i, 4, del_btn)
+            self.row_data = {}
+            for i, expense in enumerate(expenses):
+                print(f"Row {i}: ID={expense.id}, Amount={expense.amount}, Date={expense.date}")
+                self.set_row(i, expense.id, expense.amount, expense.date)
             
             # Update total label
             self.total_label.setText(f"Total: Rs{total:.2f}")
@@ -1128,8 +7189,217 @@ class ExpenseViewWindow(QWidget):
             # Set fallback empty table
             self.table.clearContents()
             self.table.setRowCount(0)
+            self.row_data = {}
             self.total_label.setText("Total: Rs0.00")
+
+    def set_row(self, i, id_, amount, date):
+        """Fill table row i with an expense and remember its values."""
+        # Ensure date is properly formatted
+        if isinstance(date, datetime):
+            date_str = date.strftime("%Y-%m-%d")
+        else:
+            date_str = str(date)
+        self.row_data[id_] = (amount, date)
+        
+        self.table.setItem(i, 0, QTableWidgetItem(str(id_)))
+        self.table.setItem(i, 1, QTableWidgetItem(f"Rs{amount:.2f}"))
+        self.table.setItem(i, 2, QTableWidgetItem(date_str))
+        self.table.setItem(i, 3, QTableWidgetItem(", ".join(self.row_tags.get(id_, []))))
+        reasons = self.anomalies.get(id_)
+        for column in range(4):
+            item = self.table.item(i, column)
+            item.setForeground(QColor("orange" if reasons else "white"))
+            item.setToolTip("\n".join(reasons) if reasons else "")
+        
+        # Create edit button
+        edit_btn = QPushButton("Edit")
+        edit_btn.setStyleSheet("background-color: #3357FF; color: white;")
+        edit_btn.clicked.connect(lambda checked, eid=id_: self.edit_expense(eid, *self.row_data[eid]))
+        self.table.setCellWidget(i, 4, edit_btn)
+        
+        # Create delete button
+        del_btn = QPushButton("Delete")
+        del_btn.setStyleSheet("background-color: #FF5733; color: white;")
+        del_btn.clicked.connect(lambda checked, eid=id_: self.delete_expense(eid))
+        self.table.setCellWidget(i, 5, del_btn)
+
+    def row_of(self, expense_id):
+        for i in range(self.table.rowCount()):
+            if int(self.table.item(i, 0).text()) == expense_id:
+                return i
+        return None
+
+    def remove_rows(self, expense_ids):
+        """Drop expenses from the table without reloading it."""
+        rows = [self.row_of(expense_id) for expense_id in expense_ids if expense_id in self.row_data]
+        for i in sorted((row for row in rows if row is not None), reverse=True):
+            self.table.removeRow(i)
+        for expense_id in expense_ids:
+            self.row_data.pop(expense_id, None)
+        self.refresh_totals()
+
+    def patch_rows(self, rows):
+        """Apply updated Expenses to the table in place.
+        
+        Rows that moved to another category or out of the date filter are removed.
+        """
+        start = self.start_date.date().toString("yyyy-MM-dd")
+        end = self.end_date.date().toString("yyyy-MM-dd")
+        gone = []
+        for expense in rows:
+            i = self.row_of(expense.id)
+            if i is None:
+                continue
+            if expense.category_id != self.category_id or not start <= str(expense.date) <= end:
+                gone.append(expense.id)
+            else:
+                self.set_row(i, expense.id, expense.amount, expense.date)
+        self.remove_rows(gone)
+
+    def refresh_totals(self):
+        total = sum((amount for amount, _ in self.row_data.values()), Money())
+        self.total_label.setText(f"Total: Rs{total:.2f}")
+        self.update_limit_info()
+
+    def find_anomalies(self):
+        """Scan the user's whole history and highlight unusual expenses in this view."""
+        self.anomalies = scan_expense_anomalies(self.user_id)
+        for row in range(self.table.rowCount()):
+            expense_id = int(self.table.item(row, 0).text())
+            self.set_row(row, expense_id, *self.row_data[expense_id])
+        shown = [expense_id for expense_id in self.row_data if expense_id in self.anomalies]
+        if shown:
+            QMessageBox.information(
+                self, "Unusual Expenses",
+                f"{len(shown)} of the expenses shown look unusual and are highlighted in orange. "
+                f"Hover over a row to see why."
+            )
+        else:
+            QMessageBox.information(self, "Unusual Expenses", "No unusual expenses among the ones shown")
+    
+    def selected_ids(self):
+        return [int(self.table.item(index.row(), 0).text())
+                for index in self.table.selectionModel().selectedRows()]
+
+    def bulk_delete(self):
+        ids = self.selected_ids()
+        if not ids:
+            QMessageBox.information(self, "Bulk Delete", "Select one or more expenses first")
+            return
+        reply = QMessageBox.question(
+            self, "Confirm Delete", f"Delete {len(ids)} selected expense(s)?",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+        )
+        if reply != QMessageBox.StandardButton.Yes:
+            return
+        success, message, deleted_ids = bulk_delete_expenses(self.user_id, ids)
+        if success:
+            self.remove_rows(deleted_ids)
+        else:
+            QMessageBox.critical(self, "Error", message)
+
+    def apply_bulk_update(self, ids, **changes):
+        success, message, rows = bulk_update_expenses(self.user_id, ids, **changes)
+        if success:
+            self.patch_rows(rows)
+        else:
+            QMessageBox.critical(self, "Error", message)
+
+    def bulk_redate(self):
+        ids = self.selected_ids()
+        if not ids:
+            QMessageBox.information(self, "Change Date", "Select one or more expenses first")
+            return
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Change Date")
+        dialog.setStyleSheet("background-color: black; color: white;")
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel(f"New date for {len(ids)} expense(s):"))
+        date_edit = QDateEdit(QDate.currentDate())
+        date_edit.setStyleSheet("background-color: #333333; color: white;")
+        date_edit.setCalendarPopup(True)
+        layout.addWidget(date_edit)
+        ok_btn = QPushButton("OK")
+        ok_btn.setStyleSheet("background-color: #333333; color: white;")
+        ok_btn.clicked.connect(dialog.accept)
+        layout.addWidget(ok_btn)
+        dialog.setLayout(layout)
+        if dialog.exec():
+            self.apply_bulk_update(ids, date=date_edit.date().toString("yyyy-MM-dd"))
+
+    def bulk_recategorize(self):
+        ids = self.selected_ids()
+        if not ids:
+            QMessageBox.information(self, "Move to Category", "Select one or more expenses first")
+            return
+        others = [name for name in get_categories(self.user_id) if name != self.category]
+        if not others:
+            QMessageBox.information(self, "Move to Category", "There are no other categories")
+            return
+        name, ok = QInputDialog.getItem(
+            self, "Move to Category", f"Move {len(ids)} expense(s) to:", others, 0, False
+        )
+        if ok:
+            self.apply_bulk_update(ids, category_id=get_category_id(self.user_id, name))
+
+    def bulk_adjust_amount(self):
+        ids = self.selected_ids()
+        if not ids:
+            QMessageBox.information(self, "Adjust Amount", "Select one or more expenses first")
+            return
+        text, ok = QInputDialog.getText(
+            self, "Adjust Amount",
+            f"Adjust {len(ids)} expense(s):\n"
+            "+10 or -10 to add/subtract, +10% or -10% to scale, 50 to set"
+        )
+        if not ok or not text.strip():
+            return
+        text = text.strip().replace(" ", "")
+        try:
+            if text.endswith("%"):
+                self.apply_bulk_update(ids, amount_factor=1 + Decimal(text[:-1]) / 100)
+            elif text[0] in "+-":
+                self.apply_bulk_update(ids, amount_delta=Money.of(text))
+            else:
+                amount = Money.of(text)
+                if amount <= 0:
+                    raise ValueError
+                self.apply_bulk_update(ids, amount=amount)
+        except (ValueError, ArithmeticError):
+            QMessageBox.warning(self, "Invalid Input", f"Could not understand '{text}'")
     
+    def bulk_tag(self):
+        ids = self.selected_ids()
+        if not ids:
+            QMessageBox.information(self, "Edit Tags", "Select one or more expenses first")
+            return
+        existing = get_tags(self.user_id)
+        text, ok = QInputDialog.getText(
+            self, "Edit Tags",
+            f"Tags for {len(ids)} expense(s), e.g. \"trip-2026 -work\"\n"
+            "Tags are added; prefix a tag with - to remove it."
+            + (f"\n\nExisting tags: {', '.join(existing[:30])}" if existing else "")
+        )
+        if not ok or not text.strip():
+            return
+        words = text.replace(",", " ").split()
+        try:
+            add = parse_tags(" ".join(word for word in words if not word.startswith("-")))
+            remove = parse_tags(" ".join(word[1:] for word in words if word.startswith("-")))
+        except ValueError as e:
+            QMessageBox.warning(self, "Invalid Tags", str(e))
+            return
+        success, message = tag_expenses(self.user_id, ids, add, remove)
+        if not success:
+            QMessageBox.critical(self, "Error", message)
+            return
+        self.row_tags.update({expense_id: [] for expense_id in ids})
+        self.row_tags.update(get_expense_tags(self.user_id, ids))
+        for expense_id in ids:
+            i = self.row_of(expense_id)
+            if i is not None:
+                self.set_row(i, expense_id, *self.row_data[expense_id])
+
     def edit_expense(self, expense_id, amount, date):
         """Open a dialog to edit an expense."""
         try:
@@ -1194,7 +7464,7 @@ class ExpenseViewWindow(QWidget):
         """Save changes to an edited expense."""
         try:
             # Get new values
-            new_amount = float(amount_edit.text())
+            new_amount = Money.of(amount_edit.text())
             if new_amount <= 0:
                 QMessageBox.warning(dialog, "Invalid Amount", "Amount must be greater than zero")
                 return
@@ -1202,9 +7472,9 @@ class ExpenseViewWindow(QWidget):
             new_date = date_edit.date().toString("yyyy-MM-dd")
             
             # Update expense in database
-            if update_expense(expense_id, new_amount, new_date):
+            if update_expense(self.user_id, expense_id, new_amount, new_date):
                 dialog.accept()
-                self.update_table()
+                self.patch_rows([Expense(expense_id, self.category_id, new_amount, new_date)])
                 QMessageBox.information(self, "Success", "Expense updated successfully")
             else:
                 QMessageBox.critical(dialog, "Error", "Failed to update expense")
@@ -1224,8 +7494,8 @@ class ExpenseViewWindow(QWidget):
         )
         
         if reply == QMessageBox.StandardButton.Yes:
-            if delete_expense(expense_id):
-                self.update_table()
+            if delete_expense(self.user_id, expense_id):
+                self.remove_rows([expense_id])
                 QMessageBox.information(self, "Success", "Expense deleted successfully")
             else:
                 QMessageBox.critical(self, "Error", "Failed to delete expense")
@@ -1244,9 +7514,10 @@ class ExpenseViewWindow(QWidget):
 
 class AddExpenseWindow(QWidget):
     """Window for adding new expenses."""
-    def __init__(self, category):
+    def __init__(self, user_id, category):
         print(f"--- Initializing AddExpenseWindow for category: {category} ---")
         super().__init__()
+        self.user_id = user_id
         self.category = category
         self.setWindowTitle(f"Add - {category}")
         self.setGeometry(100, 100, 300, 200)
@@ -1278,22 +7549,21 @@ class AddExpenseWindow(QWidget):
         
         # Add limit information at the top
         try:
-            category_id = get_category_id(self.category)
+            category_id = get_category_id(self.user_id, self.category)
             print(f"Retrieved category ID: {category_id}")
-            if category_id:
-                limit = get_category_limit(category_id)
-                spent = get_category_spending(category_id, datetime.now().strftime("%Y-%m-01"), None)
+            budget = get_budget_status(self.user_id, category_id) if category_id else None
+            if budget:
+                limit, spent = budget.available, budget.spent
                 print(f"Retrieved limit: {limit}, spent: {spent}")
                 
-                # Convert values to float to ensure consistent types
-                if limit is not None:
-                    limit = float(limit)
-                spent = float(spent)
-                
                 if limit:
                     remaining = limit - spent
                     percentage = (spent / limit) * 100
-                    limit_text = f"Monthly limit: Rs{limit:.2f}\nSpent: Rs{spent:.2f} ({percentage:.1f}%)\nRemaining: Rs{remaining:.2f}"
+                    period = _describe_period(budget.period, budget.rolling_days)
+                    limit_text = (
+                        f"{period} limit: Rs{limit:.2f}\nSpent: Rs{spent:.2f} ({percentage:.1f}%)\n"
+                        f"Remaining: Rs{remaining:.2f}"
+                    )
                     
                     if spent > limit:
                         limit_color = "red"
@@ -1302,7 +7572,7 @@ class AddExpenseWindow(QWidget):
                     else:
                         limit_color = "green"
                 else:
-                    limit_text = f"No monthly limit set\nSpent this month: Rs{spent:.2f}"
+                    limit_text = f"No limit set\n{_spent_label(budget)}: Rs{spent:.2f}"
                     limit_color = "white"
                     
                 limit_info = QLabel(limit_text)
@@ -1318,87 +7588,802 @@ class AddExpenseWindow(QWidget):
         self.amount_entry.setStyleSheet("background-color: #333333; color: white;")
         layout.addWidget(self.amount_entry)
         
-        layout.addWidget(QLabel("Date:"))
-        self.date_entry = QDateEdit(QDate.currentDate())
-        self.date_entry.setStyleSheet("background-color: #333333; color: white;")
-        self.date_entry.setCalendarPopup(True)  # Add calendar popup for better UX
-        layout.addWidget(self.date_entry)
+        layout.addWidget(QLabel("Date:"))
+        self.date_entry = QDateEdit(QDate.currentDate())
+        self.date_entry.setStyleSheet("background-color: #333333; color: white;")
+        self.date_entry.setCalendarPopup(True)  # Add calendar popup for better UX
+        layout.addWidget(self.date_entry)
+        
+        layout.addWidget(QLabel("Payee (optional):"))
+        self.payee_entry = QLineEdit()
+        self.payee_entry.setPlaceholderText("Where was it spent?")
+        self.payee_entry.setStyleSheet("background-color: #333333; color: white;")
+        # Suggestions come from the prefix index, already ranked, so the
+        # completer shows them as given instead of filtering them again
+        self.payee_index = payee_prefix_index(self.user_id)
+        self.payee_model = QStringListModel()
+        completer = QCompleter(self.payee_model, self)
+        completer.setCompletionMode(QCompleter.CompletionMode.UnfilteredPopupCompletion)
+        completer.popup().setStyleSheet("background-color: #333333; color: white;")
+        self.payee_entry.setCompleter(completer)
+        self.payee_entry.textEdited.connect(self.suggest_payees)
+        layout.addWidget(self.payee_entry)
+        
+        layout.addWidget(QLabel("Tags (optional):"))
+        self.tags_entry = QLineEdit()
+        self.tags_entry.setPlaceholderText("e.g. trip-2026, reimbursable")
+        self.tags_entry.setStyleSheet("background-color: #333333; color: white;")
+        layout.addWidget(self.tags_entry)
+        
+        submit_btn = QPushButton("Submit")
+        submit_btn.setStyleSheet("background-color: #333333; color: white;")
+        submit_btn.clicked.connect(self.submit)
+        layout.addWidget(submit_btn)
+        
+        # Add a cancel button
+        cancel_btn = QPushButton("Cancel")
+        cancel_btn.setStyleSheet("background-color: #444444; color: white;")
+        cancel_btn.clicked.connect(self.close)
+        layout.addWidget(cancel_btn)
+        
+        self.setLayout(layout)
+        print("AddExpenseWindow UI setup complete")
+
+    def confirm_not_duplicate(self, amount, date, payee):
+        """Ask before adding an expense that looks like one already stored."""
+        category_id = get_category_id(self.user_id, self.category)
+        if not category_id:
+            return True
+        try:
+            matches = find_duplicate_expenses(self.user_id, [(category_id, amount, date, payee, None)])[0]
+        except ValueError:
+            return True
+        if not matches:
+            return True
+        listed = "".join(
+            f"<p>• Rs{amount:.2f} on {match_date} (#{expense_id}){' - same day' if exact else ''}</p>"
+            for expense_id, match_date, exact in matches[:5]
+        )
+        reply = QMessageBox.question(
+            self, "Possible Duplicate",
+            f"<p>This {self.category} expense{f' at {payee}' if payee else ''} looks like one already added:</p>"
+            f"{listed}<p>Add it anyway?</p>",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+        )
+        return reply == QMessageBox.StandardButton.Yes
+
+    def suggest_payees(self, text):
+        self.payee_model.setStringList(self.payee_index.suggest(text) if text.strip() else [])
+        if self.payee_model.rowCount():
+            self.payee_entry.completer().complete()
+
+    def submit(self):
+        try:
+            amount_text = self.amount_entry.text().strip()
+            if not amount_text:
+                raise ValueError("Amount cannot be empty")
+            
+            amount = Money.of(amount_text)
+            if amount <= 0:
+                raise ValueError("Amount must be positive")
+            
+            date = self.date_entry.date().toString("yyyy-MM-dd")
+            tags = parse_tags(self.tags_entry.text())
+            payee = self.payee_entry.text().strip() or None
+            print(f"Submitting expense: {self.category}, Rs{amount}, {date}, payee {payee}, tags {tags}")
+            if not self.confirm_not_duplicate(amount, date, payee):
+                return
+            
+            success, message, status = add_expense_with_status(
+                self.user_id, self.category, amount, date, tags, payee
+            )
+            if success:
+                QMessageBox.information(self, "Success", message)
+                
+                # The status comes back with the insert (None while the expense
+                # is waiting in the offline queue)
+                if status:
+                    exceeded, spent, limit = status.exceeded, status.spent, status.available
+                    
+                    if exceeded and limit > 0:
+                        over_amount = spent - limit
+                        percentage = (spent / limit) * 100
+                        
+                        alert_msg = QMessageBox(self)
+                        alert_msg.setIcon(QMessageBox.Icon.Warning)
+                        alert_msg.setWindowTitle("⚠️ SPENDING LIMIT EXCEEDED ⚠️")
+                        alert_msg.setText(f"<h3 style='color: red;'>Budget Alert!</h3>")
+                        alert_msg.setInformativeText(
+                            f"<p>Your spending for <b>{self.category}</b> has exceeded the {_describe_period(status.period, status.rolling_days).lower()} limit!</p>"
+                            f"<p>Limit: <b>Rs{limit:.2f}</b><br>"
+                            f"Current spending: <b>Rs{spent:.2f}</b> ({percentage:.1f}%)<br>"
+                            f"Over by: <b>Rs{over_amount:.2f}</b></p>"
+                            f"<p>Consider adjusting your spending or increasing your budget.</p>"
+                        )
+                        alert_msg.setStandardButtons(QMessageBox.StandardButton.Ok)
+                        alert_msg.setDefaultButton(QMessageBox.StandardButton.Ok)
+                        alert_msg.exec()
+
+                    # Limits on parent categories cover this expense too
+                    over_parents = [parent for parent in status.ancestors if parent.exceeded]
+                    if over_parents:
+                        QMessageBox.warning(
+                            self, "Parent Category Limit Exceeded",
+                            "".join(
+                                f"<p><b>{parent.name}</b> is over its "
+                                f"{_describe_period(parent.period, parent.rolling_days).lower()} limit: "
+                                f"Rs{parent.spent:.2f} of Rs{parent.available:.2f}</p>"
+                                for parent in over_parents
+                            )
+                        )
+
+                    if status.anomalies:
+                        QMessageBox.warning(
+                            self, "Unusual Expense",
+                            f"<p>This {self.category} expense looks unusual:</p>"
+                            + "".join(f"<p>• {reason}</p>" for reason in status.anomalies)
+                            + "<p>Check the amount and date if it was a typo.</p>"
+                        )
+                
+                self.close()
+            else:
+                QMessageBox.critical(self, "Error", message)
+        except ValueError as e:
+            QMessageBox.critical(self, "Error", str(e))
+        except Exception as e:
+            print(f"Unexpected error in submit: {e}")
+            import traceback
+            traceback.print_exc()
+            QMessageBox.critical(self, "Error", f"An unexpected error occurred: {str(e)}")
+
+class BatchEntryDelegate(QStyledItemDelegate):
+    """Editors for the batch entry grid: a category picker and a date editor.
+    
+    Also used by the statement import grid, whose columns are laid out differently.
+    """
+    def __init__(self, categories, parent=None, category_column=None, date_column=None):
+        super().__init__(parent)
+        self.categories = categories
+        self.category_column = BatchEntryWindow.CATEGORY_COLUMN if category_column is None else category_column
+        self.date_column = BatchEntryWindow.DATE_COLUMN if date_column is None else date_column
+
+    def createEditor(self, parent, option, index):
+        if index.column() == self.category_column:
+            editor = QComboBox(parent)
+            editor.setEditable(True)
+            editor.addItems(self.categories)
+            editor.setStyleSheet("background-color: #333333; color: white;")
+            return editor
+        if index.column() == self.date_column:
+            editor = QDateEdit(parent)
+            editor.setDisplayFormat("yyyy-MM-dd")
+            editor.setCalendarPopup(True)
+            editor.setStyleSheet("background-color: #333333; color: white;")
+            return editor
+        return super().createEditor(parent, option, index)
+
+    def setEditorData(self, editor, index):
+        text = index.data() or ""
+        if isinstance(editor, QComboBox):
+            editor.setCurrentText(text)
+            editor.lineEdit().selectAll()
+        elif isinstance(editor, QDateEdit):
+            date = QDate.fromString(text, "yyyy-MM-dd")
+            editor.setDate(date if date.isValid() else QDate.currentDate())
+        else:
+            super().setEditorData(editor, index)
+
+    def setModelData(self, editor, model, index):
+        if isinstance(editor, QComboBox):
+            model.setData(index, editor.currentText().strip())
+        elif isinstance(editor, QDateEdit):
+            model.setData(index, editor.date().toString("yyyy-MM-dd"))
+        else:
+            super().setModelData(editor, model, index)
+
+class BatchEntryWindow(QWidget):
+    """Keyboard-driven grid for entering many expenses across categories at once.
+    
+    Type to edit a cell, Tab/Enter to move on; a blank row is always kept at the
+    bottom so entry never stops. Ctrl+Enter saves the whole batch in one transaction.
+    """
+    CATEGORY_COLUMN, AMOUNT_COLUMN, DATE_COLUMN = range(3)
+    INVALID_COLOR = QColor(120, 0, 0)
+
+    def __init__(self, user_id, on_saved=None):
+        super().__init__()
+        self.user_id = user_id
+        self.on_saved = on_saved
+        self.categories = get_categories(user_id)
+        self.setWindowTitle("Batch Entry")
+        self.setGeometry(100, 100, 500, 450)
+        self.setStyleSheet("background-color: black; color: white;")
+        self.init_ui()
+
+    def init_ui(self):
+        layout = QVBoxLayout()
+        
+        help_label = QLabel("Type to edit, Tab/Enter to move, Delete to clear, Ctrl+Enter to save")
+        help_label.setStyleSheet("color: #CCCCCC;")
+        layout.addWidget(help_label)
+        
+        self.table = QTableWidget(0, 3)
+        self.table.setHorizontalHeaderLabels(["Category", "Amount", "Date"])
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.table.setStyleSheet("background-color: #333333; color: white;")
+        self.table.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.table.setItemDelegate(BatchEntryDelegate(self.categories, self.table))
+        self.table.installEventFilter(self)
+        self.table.cellChanged.connect(self.on_cell_changed)
+        layout.addWidget(self.table)
+        
+        self.status_label = QLabel("")
+        layout.addWidget(self.status_label)
+        
+        button_layout = QHBoxLayout()
+        self.save_btn = QPushButton("Save All")
+        self.save_btn.setStyleSheet("background-color: #333333; color: white; border: 1px solid white;")
+        self.save_btn.clicked.connect(self.save)
+        button_layout.addWidget(self.save_btn)
+        
+        close_btn = QPushButton("Close")
+        close_btn.setStyleSheet("background-color: #444444; color: white;")
+        close_btn.clicked.connect(self.close)
+        button_layout.addWidget(close_btn)
+        layout.addLayout(button_layout)
+        
+        for key in ("Ctrl+Return", "Ctrl+Enter"):
+            QShortcut(QKeySequence(key), self).activated.connect(self.save)
+        
+        self.setLayout(layout)
+        self.append_row()
+        self.table.setCurrentCell(0, self.CATEGORY_COLUMN)
+        self.validate()
+
+    def append_row(self, category="", date=None):
+        """Add a blank row, pre-filled with the previous row's category and date."""
+        self.table.blockSignals(True)
+        row = self.table.rowCount()
+        self.table.insertRow(row)
+        self.table.setItem(row, self.CATEGORY_COLUMN, QTableWidgetItem(category))
+        self.table.setItem(row, self.AMOUNT_COLUMN, QTableWidgetItem(""))
+        self.table.setItem(row, self.DATE_COLUMN, QTableWidgetItem(date or QDate.currentDate().toString("yyyy-MM-dd")))
+        self.table.blockSignals(False)
+
+    def row_is_blank(self, row):
+        item = self.table.item(row, self.AMOUNT_COLUMN)
+        return not (item and item.text().strip())
+
+    def on_cell_changed(self, row, column):
+        if row == self.table.rowCount() - 1 and not self.row_is_blank(row):
+            self.append_row(
+                self.table.item(row, self.CATEGORY_COLUMN).text(),
+                self.table.item(row, self.DATE_COLUMN).text()
+            )
+        self.validate()
+
+    def eventFilter(self, obj, event):
+        if obj is self.table and event.type() == QEvent.Type.KeyPress \
+                and self.table.state() != QAbstractItemView.State.EditingState:
+            if event.key() in (Qt.Key.Key_Return, Qt.Key.Key_Enter) \
+                    and not event.modifiers() & Qt.KeyboardModifier.ControlModifier:
+                row, column = self.table.currentRow(), self.table.currentColumn()
+                if column < self.DATE_COLUMN:
+                    self.table.setCurrentCell(row, column + 1)
+                elif row + 1 < self.table.rowCount():
+                    self.table.setCurrentCell(row + 1, self.AMOUNT_COLUMN)
+                return True
+            if event.key() in (Qt.Key.Key_Delete, Qt.Key.Key_Backspace):
+                for item in self.table.selectedItems():
+                    if item.column() != self.DATE_COLUMN:
+                        item.setText("")
+                return True
+        return super().eventFilter(obj, event)
+
+    def parse_row(self, row):
+        """Return (entry, errors) for a row; entry is (category, amount, date) or None."""
+        category_item = self.table.item(row, self.CATEGORY_COLUMN)
+        category = category_item.text().strip()
+        matches = [name for name in self.categories if name.lower() == category.lower()]
+        errors = {}
+        if not matches:
+            errors[self.CATEGORY_COLUMN] = f"Unknown category '{category}'" if category else "Category required"
+        try:
+            amount = Money.of(self.table.item(row, self.AMOUNT_COLUMN).text())
+            if amount <= 0:
+                errors[self.AMOUNT_COLUMN] = "Amount must be positive"
+        except ValueError:
+            errors[self.AMOUNT_COLUMN] = "Invalid amount"
+        date = self.table.item(row, self.DATE_COLUMN).text().strip()
+        if not QDate.fromString(date, "yyyy-MM-dd").isValid():
+            errors[self.DATE_COLUMN] = "Date must be YYYY-MM-DD"
+        if errors:
+            return None, errors
+        return (matches[0], amount, date), errors
+
+    def validate(self):
+        """Highlight invalid cells and return the parsed entries (None if any row is invalid)."""
+        entries, invalid_rows, first_error = [], 0, None
+        self.table.blockSignals(True)
+        for row in range(self.table.rowCount()):
+            blank = self.row_is_blank(row)
+            entry, errors = (None, {}) if blank else self.parse_row(row)
+            for column in range(3):
+                item = self.table.item(row, column)
+                item.setBackground(self.INVALID_COLOR if column in errors else QColor("#333333"))
+                item.setToolTip(errors.get(column, ""))
+            if errors:
+                invalid_rows += 1
+                first_error = first_error or f"Row {row + 1}: {next(iter(errors.values()))}"
+            elif entry:
+                entries.append(entry)
+        self.table.blockSignals(False)
+        
+        if invalid_rows:
+            self.status_label.setText(f"{len(entries)} ready, {invalid_rows} with errors - {first_error}")
+            self.status_label.setStyleSheet("color: red;")
+        else:
+            total = sum((amount for _, amount, _ in entries), Money())
+            self.status_label.setText(f"{len(entries)} expenses ready, total Rs{total:.2f}")
+            self.status_label.setStyleSheet("color: #CCCCCC;")
+        self.save_btn.setEnabled(bool(entries) and not invalid_rows)
+        return None if invalid_rows else entries
+
+    def save(self):
+        if self.table.state() == QAbstractItemView.State.EditingState:
+            # Moving focus off the open editor makes the delegate commit it
+            self.save_btn.setFocus()
+        entries = self.validate()
+        if not entries:
+            return
+        success, message, statuses = add_expenses_batch(self.user_id, entries)
+        if not success:
+            QMessageBox.critical(self, "Error", message)
+            return
+        
+        exceeded = [status for status in statuses or [] if status.exceeded]
+        if exceeded:
+            details = "".join(
+                f"<p><b>{status.name}</b>: Rs{status.spent:.2f} of Rs{status.available:.2f} "
+                f"(over by Rs{status.spent - status.available:.2f})</p>"
+                for status in exceeded
+            )
+            QMessageBox.warning(
+                self, "⚠️ SPENDING LIMIT EXCEEDED ⚠️",
+                f"<p>{message}, but these categories are over their limit:</p>{details}"
+            )
+        else:
+            QMessageBox.information(self, "Success", message)
+        
+        unusual = [
+            (status.name, amount, date, reasons)
+            for status in statuses or [] for amount, date, reasons in status.anomalies
+        ]
+        if unusual:
+            QMessageBox.warning(
+                self, "Unusual Expenses",
+                "<p>These expenses look unusual:</p>" + "".join(
+                    f"<p><b>{name}</b> Rs{amount:.2f} on {date}: {'; '.join(reasons)}</p>"
+                    for name, amount, date, reasons in unusual
+                )
+            )
+        
+        self.table.setRowCount(0)
+        self.append_row()
+        self.table.setCurrentCell(0, self.CATEGORY_COLUMN)
+        self.validate()
+        if self.on_saved:
+            self.on_saved()
+
+class RuleDialog(QDialog):
+    """Dialog for a new categorization rule."""
+    KIND_LABELS = {
+        "substring": "Description contains", "regex": "Description matches regex",
+        "payee": "Payee is", "amount": "Amount only",
+    }
+
+    def __init__(self, categories, pattern="", category=None, kind="substring", parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Add Rule")
+        self.setStyleSheet("background-color: black; color: white;")
+        form = QFormLayout(self)
+        
+        self.kind_combo = QComboBox()
+        for rule_kind in RULE_KINDS:
+            self.kind_combo.addItem(self.KIND_LABELS[rule_kind], rule_kind)
+        self.kind_combo.setCurrentIndex(RULE_KINDS.index(kind))
+        self.kind_combo.setStyleSheet("background-color: #333333; color: white;")
+        self.kind_combo.currentIndexChanged.connect(self.update_fields)
+        form.addRow("Rule:", self.kind_combo)
+        
+        self.pattern_entry = QLineEdit(pattern)
+        self.pattern_entry.setStyleSheet("background-color: #333333; color: white;")
+        form.addRow("Text:", self.pattern_entry)
+        
+        self.min_entry = QLineEdit()
+        self.min_entry.setPlaceholderText("optional")
+        self.min_entry.setStyleSheet("background-color: #333333; color: white;")
+        form.addRow("Amount from:", self.min_entry)
+        self.max_entry = QLineEdit()
+        self.max_entry.setPlaceholderText("optional")
+        self.max_entry.setStyleSheet("background-color: #333333; color: white;")
+        form.addRow("Amount to:", self.max_entry)
+        
+        self.category_combo = QComboBox()
+        self.category_combo.addItems(categories)
+        if category in categories:
+            self.category_combo.setCurrentText(category)
+        self.category_combo.setStyleSheet("background-color: #333333; color: white;")
+        form.addRow("Category:", self.category_combo)
+        
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        buttons.setStyleSheet("background-color: #333333; color: white;")
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        form.addRow(buttons)
+        self.update_fields()
+
+    def update_fields(self):
+        self.pattern_entry.setEnabled(self.kind() != "amount")
+
+    def kind(self):
+        return self.kind_combo.currentData()
+
+    def values(self):
+        """Return (kind, pattern, min_amount, max_amount, category name)."""
+        return (self.kind(), self.pattern_entry.text(), self.min_entry.text().strip(),
+                self.max_entry.text().strip(), self.category_combo.currentText())
+
+def add_rule_interactively(parent, user_id, pattern="", category=None, kind="substring"):
+    """Ask for a rule with RuleDialog and save it. Returns whether a rule was added."""
+    categories = get_categories(user_id)
+    if not categories:
+        QMessageBox.warning(parent, "Add Rule", "Add a category first")
+        return False
+    dialog = RuleDialog(categories, pattern, category, kind, parent)
+    while dialog.exec():
+        kind, pattern, min_amount, max_amount, category = dialog.values()
+        success, message = add_category_rule(
+            user_id, get_category_id(user_id, category), kind, pattern, min_amount, max_amount
+        )
+        if success:
+            return True
+        QMessageBox.warning(parent, "Add Rule", message)
+    return False
+
+class RulesWindow(QWidget):
+    """The user's categorization rules for statement import, in priority order."""
+    def __init__(self, user_id, on_changed=None):
+        super().__init__()
+        self.user_id = user_id
+        self.on_changed = on_changed
+        self.rules = []
+        self.setWindowTitle("Categorization Rules")
+        self.setGeometry(150, 150, 600, 400)
+        self.setStyleSheet("background-color: black; color: white;")
+        layout = QVBoxLayout()
+        
+        help_label = QLabel("Imported rows get the category of the first rule they match.")
+        help_label.setStyleSheet("color: #CCCCCC;")
+        layout.addWidget(help_label)
+        
+        self.table = QTableWidget(0, 2)
+        self.table.setHorizontalHeaderLabels(["Rule", "Category"])
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        self.table.setStyleSheet("background-color: black; color: white; border: 1px solid white;")
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        layout.addWidget(self.table)
+        
+        buttons = QHBoxLayout()
+        for text, slot in (("Add Rule", self.add_rule), ("Remove", self.remove_rule),
+                           ("Move Up", lambda: self.move_rule(-1)), ("Move Down", lambda: self.move_rule(1)),
+                           ("Close", self.close)):
+            btn = QPushButton(text)
+            btn.setStyleSheet("background-color: #333333; color: white;")
+            btn.clicked.connect(slot)
+            buttons.addWidget(btn)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+        self.refresh()
+
+    def refresh(self, select_row=None):
+        self.rules = get_category_rules(self.user_id)
+        self.table.setRowCount(len(self.rules))
+        for row, rule in enumerate(self.rules):
+            self.table.setItem(row, 0, QTableWidgetItem(_describe_rule(rule)))
+            self.table.setItem(row, 1, QTableWidgetItem(rule['category']))
+        if select_row is not None and 0 <= select_row < len(self.rules):
+            self.table.selectRow(select_row)
+
+    def selected_rule(self):
+        rows = self.table.selectionModel().selectedRows()
+        return (rows[0].row(), self.rules[rows[0].row()]) if rows else (None, None)
+
+    def changed(self, select_row=None):
+        self.refresh(select_row)
+        if self.on_changed:
+            self.on_changed()
+
+    def add_rule(self):
+        if add_rule_interactively(self, self.user_id):
+            self.changed(len(self.rules))
+
+    def remove_rule(self):
+        row, rule = self.selected_rule()
+        if rule is None:
+            return
+        success, message = remove_category_rule(self.user_id, rule['id'])
+        if not success:
+            QMessageBox.warning(self, "Remove Rule", message)
+        self.changed(row)
+
+    def move_rule(self, offset):
+        row, rule = self.selected_rule()
+        if rule is None:
+            return
+        success, _ = move_category_rule(self.user_id, rule['id'], offset)
+        if success:
+            self.changed(row + offset)
+
+class ImportWindow(QWidget):
+    """Import a bank statement CSV, categorizing each row with the user's rules.
+    
+    The grid shows which rule categorized each row; rows no rule matched can be
+    given a category by hand (or a rule made from them) before importing. Rows
+    are checked against stored expenses (see find_duplicate_expenses), so
+    importing the same statement twice skips what is already there.
+    """
+    (CATEGORY_COLUMN, RULE_COLUMN, DATE_COLUMN, AMOUNT_COLUMN, DESCRIPTION_COLUMN, PAYEE_COLUMN,
+     DUPLICATE_COLUMN) = range(7)
+    UNMATCHED_COLOR = QColor(90, 60, 0)
+    DUPLICATE_COLOR = QColor(90, 0, 0)
+
+    def __init__(self, user_id, on_saved=None):
+        super().__init__()
+        self.user_id = user_id
+        self.on_saved = on_saved
+        self.categories = get_categories(user_id)
+        self.rows = []
+        self.read_message = ""
+        self.rules_window = None
+        self.setWindowTitle("Import Statement")
+        self.setGeometry(100, 100, 900, 550)
+        self.setStyleSheet("background-color: black; color: white;")
+        self.init_ui()
+
+    def init_ui(self):
+        layout = QVBoxLayout()
+        
+        buttons = QHBoxLayout()
+        for text, slot in (("Choose File", self.choose_file), ("Edit Rules", self.edit_rules),
+                           ("Rule from Row", self.rule_from_row)):
+            btn = QPushButton(text)
+            btn.setStyleSheet("background-color: #333333; color: white;")
+            btn.clicked.connect(slot)
+            buttons.addWidget(btn)
+        buttons.addStretch()
+        layout.addLayout(buttons)
         
-        submit_btn = QPushButton("Submit")
-        submit_btn.setStyleSheet("background-color: #333333; color: white;")
-        submit_btn.clicked.connect(self.submit)
-        layout.addWidget(submit_btn)
+        self.table = QTableWidget(0, 7)
+        self.table.setHorizontalHeaderLabels(
+            ["Category", "Rule", "Date", "Amount", "Description", "Payee", "Duplicate"]
+        )
+        self.table.horizontalHeader().setSectionResizeMode(self.DESCRIPTION_COLUMN, QHeaderView.ResizeMode.Stretch)
+        self.table.setStyleSheet("background-color: #333333; color: white;")
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setItemDelegate(BatchEntryDelegate(
+            self.categories, self.table, self.CATEGORY_COLUMN, self.DATE_COLUMN
+        ))
+        self.table.cellChanged.connect(self.on_cell_changed)
+        layout.addWidget(self.table)
         
-        # Add a cancel button
-        cancel_btn = QPushButton("Cancel")
-        cancel_btn.setStyleSheet("background-color: #444444; color: white;")
-        cancel_btn.clicked.connect(self.close)
-        layout.addWidget(cancel_btn)
+        self.status_label = QLabel("Choose a CSV statement with date, amount and description columns")
+        self.status_label.setStyleSheet("color: #CCCCCC;")
+        self.status_label.setWordWrap(True)
+        layout.addWidget(self.status_label)
         
+        bottom = QHBoxLayout()
+        self.skip_duplicates = QCheckBox("Skip exact duplicates")
+        self.skip_duplicates.setChecked(True)
+        bottom.addWidget(self.skip_duplicates)
+        self.import_btn = QPushButton("Import Categorized Rows")
+        self.import_btn.setStyleSheet("background-color: #333333; color: white; border: 1px solid white;")
+        self.import_btn.setEnabled(False)
+        self.import_btn.clicked.connect(self.import_rows)
+        bottom.addWidget(self.import_btn)
+        close_btn = QPushButton("Close")
+        close_btn.setStyleSheet("background-color: #444444; color: white;")
+        close_btn.clicked.connect(self.close)
+        bottom.addWidget(close_btn)
+        layout.addLayout(bottom)
         self.setLayout(layout)
-        print("AddExpenseWindow UI setup complete")
 
-    def submit(self):
+    def choose_file(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Import Statement", "", "CSV files (*.csv);;All files (*)")
+        if path:
+            self.load_file(path)
+
+    def load_file(self, path):
         try:
-            amount_text = self.amount_entry.text().strip()
-            if not amount_text:
-                raise ValueError("Amount cannot be empty")
-            
-            amount = float(amount_text)
-            if amount <= 0:
-                raise ValueError("Amount must be positive")
-            
-            date = self.date_entry.date().toString("yyyy-MM-dd")
-            print(f"Submitting expense: {self.category}, Rs{amount}, {date}")
-            
-            success, message = add_expense(self.category, amount, date)
-            if success:
-                QMessageBox.information(self, "Success", message)
-                
-                # Check if limit is exceeded after adding expense
-                category_id = get_category_id(self.category)
-                if category_id:
-                    exceeded, spent, limit = check_limit_exceeded(category_id)
-                    
-                    # Ensure consistent types for calculations
-                    if limit:
-                        limit = float(limit)
-                    spent = float(spent)
-                    
-                    if exceeded and limit > 0:
-                        over_amount = spent - limit
-                        percentage = (spent / limit) * 100
-                        
-                        alert_msg = QMessageBox(self)
-                        alert_msg.setIcon(QMessageBox.Icon.Warning)
-                        alert_msg.setWindowTitle("⚠️ SPENDING LIMIT EXCEEDED ⚠️")
-                        alert_msg.setText(f"<h3 style='color: red;'>Budget Alert!</h3>")
-                        alert_msg.setInformativeText(
-                            f"<p>Your spending for <b>{self.category}</b> has exceeded the monthly limit!</p>"
-                            f"<p>Limit: <b>Rs{limit:.2f}</b><br>"
-                            f"Current spending: <b>Rs{spent:.2f}</b> ({percentage:.1f}%)<br>"
-                            f"Over by: <b>Rs{over_amount:.2f}</b></p>"
-                            f"<p>Consider adjusting your spending or increasing your budget.</p>"
-                        )
-                        alert_msg.setStandardButtons(QMessageBox.StandardButton.Ok)
-                        alert_msg.setDefaultButton(QMessageBox.StandardButton.Ok)
-                        alert_msg.exec()
-                
-                self.close()
+            self.rows, message = read_statement_csv(path)
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            QMessageBox.warning(self, "Import Statement", f"Can't read {os.path.basename(path)}: {e}")
+            return
+        self.read_message = message
+        self.categorize()
+
+    def categorize(self):
+        """(Re)apply the rules to every row not categorized by hand and refill the grid."""
+        known = {name.casefold(): name for name in self.categories}
+        matcher = CategoryRuleMatcher(get_category_rules(self.user_id))
+        started = datetime.now()
+        for row, rule in zip(self.rows, matcher.categorize(self.rows)):
+            if row.get('manual'):
+                continue
+            if rule:
+                row['assigned'], row['rule'] = rule['category'], _describe_rule(rule)
+            elif row['category'].casefold() in known:
+                row['assigned'], row['rule'] = known[row['category'].casefold()], "From file"
             else:
-                QMessageBox.critical(self, "Error", message)
-        except ValueError as e:
-            QMessageBox.critical(self, "Error", str(e))
-        except Exception as e:
-            print(f"Unexpected error in submit: {e}")
-            import traceback
-            traceback.print_exc()
-            QMessageBox.critical(self, "Error", f"An unexpected error occurred: {str(e)}")
+                row['assigned'], row['rule'] = "", ""
+        elapsed = (datetime.now() - started).total_seconds()
+        self.check_duplicates(self.rows)
+        
+        self.table.blockSignals(True)
+        self.table.setRowCount(len(self.rows))
+        for index, row in enumerate(self.rows):
+            values = (row['assigned'], row['rule'], row['date'], f"{row['amount']:.2f}",
+                      row['description'], row['payee'],
+                      _describe_duplicates(row['duplicates']) if row['duplicates'] else "")
+            for column, text in enumerate(values):
+                item = QTableWidgetItem(text)
+                if column not in (self.CATEGORY_COLUMN, self.DATE_COLUMN):
+                    item.setFlags(item.flags() & ~Qt.ItemFlag.ItemIsEditable)
+                self.table.setItem(index, column, item)
+            self.highlight(index)
+        self.table.blockSignals(False)
+        
+        matched = sum(1 for row in self.rows if row['assigned'])
+        fired = {}
+        for row in self.rows:
+            if row['rule']:
+                fired[row['rule']] = fired.get(row['rule'], 0) + 1
+        top = ", ".join(f"{rule} ×{count}" for rule, count in sorted(fired.items(), key=lambda item: -item[1])[:5])
+        exact = sum(1 for row in self.rows if self.is_exact_duplicate(row))
+        near = sum(1 for row in self.rows if row['duplicates'] and not self.is_exact_duplicate(row))
+        self.status_label.setText(
+            f"{self.read_message}. {matched} of {len(self.rows)} categorized in {elapsed * 1000:.0f} ms"
+            + (f". Rules used: {top}" if top else "")
+            + (f". {exact} already imported" if exact else "")
+            + (f". {near} look like expenses a few days apart" if near else "")
+        )
+        self.import_btn.setEnabled(matched > 0)
+
+    @staticmethod
+    def is_exact_duplicate(row):
+        return any(exact for _, _, exact in row['duplicates'])
+
+    def check_duplicates(self, rows):
+        """Look up the stored expenses each categorized row duplicates, in one batch."""
+        categorized = [row for row in rows if row['assigned']]
+        for row in rows:
+            row['duplicates'] = []
+        ids = {name: get_category_id(self.user_id, name) for name in {row['assigned'] for row in categorized}}
+        candidates = [
+            (ids[row['assigned']], row['amount'], row['date'], row['payee'] or None, row['description'])
+            for row in categorized
+        ]
+        for row, matches in zip(categorized, find_duplicate_expenses(self.user_id, candidates)):
+            row['duplicates'] = matches
+
+    def highlight(self, index):
+        row = self.rows[index]
+        if not row['assigned']:
+            color = self.UNMATCHED_COLOR
+        elif self.is_exact_duplicate(row):
+            color = self.DUPLICATE_COLOR
+        else:
+            color = QColor("#333333")
+        for column in range(self.table.columnCount()):
+            self.table.item(index, column).setBackground(color)
+
+    def on_cell_changed(self, index, column):
+        row = self.rows[index]
+        text = self.table.item(index, column).text().strip()
+        self.table.blockSignals(True)
+        if column == self.CATEGORY_COLUMN:
+            matches = [name for name in self.categories if name.casefold() == text.casefold()]
+            row['assigned'] = matches[0] if matches else ""
+            row['rule'] = "Manual" if matches else ""
+            row['manual'] = bool(matches)
+            self.check_duplicates([row])
+            self.table.item(index, column).setText(row['assigned'])
+            self.table.item(index, self.RULE_COLUMN).setText(row['rule'])
+            self.table.item(index, self.DUPLICATE_COLUMN).setText(
+                _describe_duplicates(row['duplicates']) if row['duplicates'] else ""
+            )
+            self.highlight(index)
+        elif column == self.DATE_COLUMN:
+            row['date'] = text
+        self.table.blockSignals(False)
+        self.import_btn.setEnabled(any(row['assigned'] for row in self.rows))
+
+    def edit_rules(self):
+        self.rules_window = RulesWindow(self.user_id, self.rules_changed)
+        self.rules_window.show()
+
+    def rules_changed(self):
+        if self.rows:
+            self.categorize()
+
+    def rule_from_row(self):
+        selected = self.table.selectionModel().selectedRows()
+        if not selected:
+            QMessageBox.information(self, "Rule from Row", "Select a row first")
+            return
+        row = self.rows[selected[0].row()]
+        kind, pattern = ("payee", row['payee']) if row['payee'] else ("substring", row['description'])
+        if add_rule_interactively(self, self.user_id, pattern, row['assigned'] or None, kind):
+            self.categorize()
+
+    def import_rows(self):
+        if self.table.state() == QAbstractItemView.State.EditingState:
+            self.import_btn.setFocus()
+        ready = [row for row in self.rows if row['assigned']]
+        skipped = 0
+        if self.skip_duplicates.isChecked():
+            skipped = sum(1 for row in ready if self.is_exact_duplicate(row))
+            ready = [row for row in ready if not self.is_exact_duplicate(row)]
+        batch_size = IMPORT_CONFIG.get("batch_size", 5000)
+        statuses, imported = {}, 0
+        for start in range(0, len(ready), batch_size):
+            batch = ready[start:start + batch_size]
+            success, message, batch_statuses = add_expenses_batch(self.user_id, [
+                (row['assigned'], row['amount'], row['date'], row['payee'], row['description']) for row in batch
+            ])
+            if not success:
+                QMessageBox.critical(self, "Import Statement", f"Imported {imported} rows, then: {message}")
+                break
+            imported += len(batch)
+            # Later batches report the spending including earlier ones
+            for status in batch_statuses or []:
+                statuses[status.id] = status
+        
+        done = {id(row) for row in ready[:imported]}
+        self.rows = [row for row in self.rows if id(row) not in done]
+        self.categorize()
+        if imported or skipped:
+            exceeded = [status for status in statuses.values() if status.exceeded]
+            message = f"Imported {imported} expenses"
+            if skipped:
+                message += f", skipped {skipped} already imported"
+            if self.rows:
+                message += f"; {len(self.rows)} rows are still listed"
+            if exceeded:
+                message += "".join(
+                    f"<p><b>{status.name}</b> is over its limit: "
+                    f"Rs{status.spent:.2f} of Rs{status.available:.2f}</p>"
+                    for status in exceeded
+                )
+                QMessageBox.warning(self, "⚠️ SPENDING LIMIT EXCEEDED ⚠️", message)
+            else:
+                QMessageBox.information(self, "Import Statement", message)
+            if imported and self.on_saved:
+                self.on_saved()
 
 class ChartWindow(QWidget):
     """Window for displaying expense distribution pie chart using matplotlib."""
-    def __init__(self):
+    PRESETS = ["All Time", "This Month", "Last 3 Months", "This Year", "Custom"]
+
+    def __init__(self, user_id):
         super().__init__()
+        self.user_id = user_id
+        # The category being drilled into (None for the top level) and the way back up
+        self.parent_id = None
+        self.parent_stack = []
+        self.date_range = (None, None)
         self.setWindowTitle("Expense Distribution")
         self.setGeometry(100, 100, 800, 600)  # Larger size for better visibility
         self.setStyleSheet("background-color: black; color: white;")
@@ -1414,102 +8399,50 @@ class ChartWindow(QWidget):
         self.status_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         layout.addWidget(self.status_label)
         
-        try:
-            # First check if there are any categories
-            categories = get_categories()
-            if not categories:
-                self.status_label.setText("No expense categories found")
-                message = QLabel("Please add expense categories before viewing the chart.")
-                message.setStyleSheet("color: #FF9966; font-size: 12pt; margin: 20px;")
-                message.setAlignment(Qt.AlignmentFlag.AlignCenter)
-                layout.addWidget(message)
-            else:
-                # Try to get category totals
-                totals = get_category_totals()
-                print(f"Retrieved category totals: {totals}")
-                
-                if not totals:
-                    self.status_label.setText("No expenses found in any category")
-                    message = QLabel("Add some expenses to see the expense distribution chart.")
-                    message.setStyleSheet("color: #FF9966; font-size: 12pt; margin: 20px;")
-                    message.setAlignment(Qt.AlignmentFlag.AlignCenter)
-                    layout.addWidget(message)
-                else:
-                    # Create matplotlib chart
-                    self.status_label.setText("Expense Distribution Chart")
-                    print("Creating matplotlib pie chart...")
-                    
-                    # Convert dictionary to lists for matplotlib
-                    categories = list(totals.keys())
-                    amounts = [float(val) for val in totals.values()]
-                    
-                    # Create the figure and canvas
-                    self.figure = Figure(figsize=(8, 6), facecolor='black')
-                    self.canvas = FigureCanvas(self.figure)
-                    
-                    # Create the pie chart
-                    ax = self.figure.add_subplot(111)
-                    ax.set_facecolor('black')
-                    
-                    # Vibrant colors for the pie slices
-                    colors = [
-                        "#FF5733", "#33FF57", "#3357FF", "#FF33A8", "#33FFF5",
-                        "#FFD133", "#B133FF", "#FF8333", "#33FFBD", "#7BFF33"
-                    ]
-                    
-                    # Create the pie chart with percentages
-                    wedges, texts, autotexts = ax.pie(
-                        amounts, 
-                        labels=categories,
-                        autopct='%1.1f%%',
-                        startangle=90,
-                        colors=colors,
-                        explode=[0.1 if float(amount)/sum(amounts) > 0.2 else 0 for amount in amounts],
-                        shadow=True,
-                        textprops={'color': 'white', 'weight': 'bold'}
-                    )
-                    
-                    # Customize the percentage text
-                    for autotext in autotexts:
-                        autotext.set_size(10)
-                        autotext.set_weight('bold')
-                        
-                    # Add a title
-                    ax.set_title('Expense Distribution by Category', color='white', fontsize=16, pad=20)
-                    
-                    # Add total amount information
-                    total_amount = sum(amounts)
-                    total_text = f"Total Expenses: Rs{total_amount:.2f}"
-                    self.figure.text(0.5, 0.02, total_text, ha='center', color='white', fontsize=12)
-                    
-                    # Equal aspect ratio ensures that pie is drawn as a circle
-                    ax.axis('equal')
-                    
-                    # Add the canvas to the layout
-                    layout.addWidget(self.canvas)
-                    print("Matplotlib chart created successfully")
-                    
-                    # Force the canvas to update
-                    self.canvas.draw()
+        # Date range: a preset, or any start/end (which switches to Custom)
+        range_layout = QHBoxLayout()
+        self.preset_combo = QComboBox()
+        self.preset_combo.addItems(self.PRESETS)
+        self.preset_combo.setStyleSheet("background-color: #333333; color: white;")
+        self.preset_combo.currentIndexChanged.connect(self.apply_preset)
+        range_layout.addWidget(self.preset_combo)
         
-        except Exception as e:
-            print(f"Error creating chart: {e}")
-            self.status_label.setText("Error Creating Chart")
-            error_msg = QLabel(f"An error occurred while creating the chart:")
-            error_details = QLabel(f"{str(e)}")
-            tech_note = QLabel("Check the console for technical details.")
-            
-            error_msg.setStyleSheet("color: #FF6666; font-size: 12pt; margin-top: 20px;")
-            error_details.setStyleSheet("color: #FF9999; font-size: 11pt; margin: 5px 20px;")
-            tech_note.setStyleSheet("color: #CCCCCC; font-size: 10pt;")
-            
-            error_msg.setAlignment(Qt.AlignmentFlag.AlignCenter)
-            error_details.setAlignment(Qt.AlignmentFlag.AlignCenter)
-            tech_note.setAlignment(Qt.AlignmentFlag.AlignCenter)
-            
-            layout.addWidget(error_msg)
-            layout.addWidget(error_details)
-            layout.addWidget(tech_note)
+        range_layout.addWidget(QLabel("From:"))
+        self.start_date = QDateEdit(QDate.currentDate())
+        self.start_date.setCalendarPopup(True)
+        self.start_date.setStyleSheet("background-color: #333333; color: white;")
+        range_layout.addWidget(self.start_date)
+        
+        range_layout.addWidget(QLabel("To:"))
+        self.end_date = QDateEdit(QDate.currentDate())
+        self.end_date.setCalendarPopup(True)
+        self.end_date.setStyleSheet("background-color: #333333; color: white;")
+        range_layout.addWidget(self.end_date)
+        
+        apply_btn = QPushButton("Apply")
+        apply_btn.setStyleSheet("background-color: #333333; color: white;")
+        apply_btn.clicked.connect(self.apply_custom_range)
+        range_layout.addWidget(apply_btn)
+        
+        self.up_btn = QPushButton("Up")
+        self.up_btn.setStyleSheet("background-color: #333333; color: white;")
+        self.up_btn.setEnabled(False)
+        self.up_btn.clicked.connect(self.drill_up)
+        range_layout.addWidget(self.up_btn)
+        layout.addLayout(range_layout)
+        
+        self.message = QLabel("")
+        self.message.setStyleSheet("color: #FF9966; font-size: 12pt; margin: 20px;")
+        self.message.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.message.setWordWrap(True)
+        layout.addWidget(self.message)
+        
+        # Create the figure and canvas
+        self.figure = Figure(figsize=(8, 6), facecolor='black')
+        self.canvas = FigureCanvas(self.figure)
+        # Clicking a slice with subcategories drills down into it
+        self.canvas.mpl_connect('pick_event', self.on_pick)
+        layout.addWidget(self.canvas)
         
         # Add close button with better styling
         close_btn = QPushButton("Close")
@@ -1524,16 +8457,410 @@ class ChartWindow(QWidget):
         layout.addWidget(close_btn)
         
         self.setLayout(layout)
+        self.apply_preset()
         print("Chart window UI initialization complete")
 
+    def apply_preset(self):
+        """Set the date pickers for the selected preset and redraw."""
+        preset = self.preset_combo.currentText()
+        today = QDate.currentDate()
+        if preset == "Custom":
+            return
+        if preset == "This Month":
+            start = QDate(today.year(), today.month(), 1)
+        elif preset == "Last 3 Months":
+            start = QDate(today.year(), today.month(), 1).addMonths(-2)
+        elif preset == "This Year":
+            start = QDate(today.year(), 1, 1)
+        else:
+            start = None
+        self.start_date.setEnabled(start is not None)
+        self.end_date.setEnabled(start is not None)
+        if start is not None:
+            self.start_date.setDate(start)
+            self.end_date.setDate(today)
+            self.update_chart(start.toString("yyyy-MM-dd"), today.toString("yyyy-MM-dd"))
+        else:
+            self.update_chart(None, None)
+
+    def apply_custom_range(self):
+        self.preset_combo.blockSignals(True)
+        self.preset_combo.setCurrentText("Custom")
+        self.preset_combo.blockSignals(False)
+        self.start_date.setEnabled(True)
+        self.end_date.setEnabled(True)
+        self.update_chart(
+            self.start_date.date().toString("yyyy-MM-dd"),
+            self.end_date.date().toString("yyyy-MM-dd")
+        )
+
+    def on_pick(self, event):
+        category_id = getattr(event.artist, 'category_id', None)
+        if category_id is None or category_id == self.parent_id:
+            return
+        if not any(parent == category_id for _, _, parent, _ in get_category_tree(self.user_id)):
+            return
+        self.parent_stack.append(self.parent_id)
+        self.parent_id = category_id
+        self.update_chart(*self.date_range)
+
+    def drill_up(self):
+        if self.parent_stack:
+            self.parent_id = self.parent_stack.pop()
+            self.update_chart(*self.date_range)
+
+    def update_chart(self, start_date, end_date):
+        """Redraw the pie chart for a date range (None for all time)."""
+        self.date_range = (start_date, end_date)
+        self.up_btn.setEnabled(bool(self.parent_stack))
+        self.figure.clear()
+        self.message.setText("")
+        try:
+            # First check if there are any categories
+            if not get_categories(self.user_id):
+                self.status_label.setText("No expense categories found")
+                self.message.setText("Please add expense categories before viewing the chart.")
+                self.canvas.draw()
+                return
+            
+            # Totals are rolled up over each slice's subcategories by the database
+            # for just this range (and cached)
+            totals = get_subtree_totals(self.user_id, self.parent_id, start_date, end_date)
+            print(f"Retrieved category totals for {start_date} to {end_date}: {totals}")
+            
+            if not totals:
+                self.status_label.setText("No expenses found in this period")
+                self.message.setText("Add some expenses or pick a different date range to see the chart.")
+                self.canvas.draw()
+                return
+            
+            self.status_label.setText("Expense Distribution Chart")
+            print("Creating matplotlib pie chart...")
+            
+            # Convert dictionary to lists for matplotlib; the drilled-into category's
+            # own expenses get a slice next to its subcategories
+            category_ids = list(totals.keys())
+            categories = [
+                f"{name} (direct)" if category_id == self.parent_id else name
+                for category_id, (name, _) in totals.items()
+            ]
+            amounts = [total for _, total in totals.values()]
+            total_amount = sum(amounts, Money())
+            
+            # Create the pie chart
+            ax = self.figure.add_subplot(111)
+            ax.set_facecolor('black')
+            
+            # Vibrant colors for the pie slices
+            colors = [
+                "#FF5733", "#33FF57", "#3357FF", "#FF33A8", "#33FFF5",
+                "#FFD133", "#B133FF", "#FF8333", "#33FFBD", "#7BFF33"
+            ]
+            
+            # Create the pie chart with percentages
+            wedges, texts, autotexts = ax.pie(
+                [amount.cents for amount in amounts],
+                labels=categories,
+                autopct='%1.1f%%',
+                startangle=90,
+                colors=colors,
+                explode=[0.1 if amount / total_amount > 0.2 else 0 for amount in amounts],
+                shadow=True,
+                textprops={'color': 'white', 'weight': 'bold'}
+            )
+            
+            for wedge, category_id in zip(wedges, category_ids):
+                wedge.category_id = category_id
+                wedge.set_picker(True)
+            
+            # Customize the percentage text
+            for autotext in autotexts:
+                autotext.set_size(10)
+                autotext.set_weight('bold')
+                
+            # Add a title
+            period = f"{start_date} to {end_date}" if start_date else "All Time"
+            title = 'Expense Distribution by Category'
+            if self.parent_id is not None:
+                path = next((path for category_id, _, _, path in get_category_tree(self.user_id)
+                             if category_id == self.parent_id), ())
+                if path:
+                    title += f" in {' > '.join(path)}"
+            ax.set_title(f'{title} ({period})', color='white', fontsize=16, pad=20)
+            
+            # Add total amount information
+            total_text = f"Total Expenses: Rs{total_amount:.2f}"
+            self.figure.text(0.5, 0.02, total_text, ha='center', color='white', fontsize=12)
+            
+            # Equal aspect ratio ensures that pie is drawn as a circle
+            ax.axis('equal')
+            print("Matplotlib chart created successfully")
+        except Exception as e:
+            print(f"Error creating chart: {e}")
+            self.status_label.setText("Error Creating Chart")
+            self.message.setText(
+                f"An error occurred while creating the chart:\n{str(e)}\n"
+                f"Check the console for technical details."
+            )
+        
+        # Force the canvas to update
+        self.canvas.draw()
+
+class PivotWindow(QWidget):
+    """Spending per category per month, with row and column totals."""
+    RANGES = [("Last 12 months", 12), ("Last 3 years", 36), ("All time", None)]
+
+    def __init__(self, user_id):
+        super().__init__()
+        self.user_id = user_id
+        self.cube = get_category_month_cube(user_id)
+        self.shown_version = None
+        self.setWindowTitle("Spending by Month")
+        self.setGeometry(100, 100, 900, 500)
+        self.setStyleSheet("background-color: black; color: white;")
+        self.init_ui()
+
+    def init_ui(self):
+        layout = QVBoxLayout()
+        
+        controls = QHBoxLayout()
+        controls.addWidget(QLabel("Range:"))
+        self.range_combo = QComboBox()
+        self.range_combo.addItems([label for label, _ in self.RANGES])
+        self.range_combo.setStyleSheet("background-color: #333333; color: white;")
+        self.range_combo.currentIndexChanged.connect(self.refresh)
+        controls.addWidget(self.range_combo)
+        
+        controls.addWidget(QLabel("Sort by:"))
+        self.sort_combo = QComboBox()
+        self.sort_combo.addItems(["Name", "Total"])
+        self.sort_combo.setStyleSheet("background-color: #333333; color: white;")
+        self.sort_combo.currentIndexChanged.connect(self.refresh)
+        controls.addWidget(self.sort_combo)
+        controls.addStretch()
+        layout.addLayout(controls)
+        
+        self.table = QTableWidget()
+        self.table.setStyleSheet("background-color: black; color: white; border: 1px solid white;")
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        layout.addWidget(self.table)
+        
+        close_btn = QPushButton("Close")
+        close_btn.setStyleSheet("background-color: #333333; color: white;")
+        close_btn.clicked.connect(self.close)
+        layout.addWidget(close_btn)
+        self.setLayout(layout)
+        
+        # Redraw when expenses change (the cube is updated in the background)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh_if_changed)
+        self.timer.start(1000)
+        self.refresh()
+
+    def refresh_if_changed(self):
+        if self.cube.version != self.shown_version:
+            self.refresh()
+
+    def refresh(self):
+        months = self.RANGES[self.range_combo.currentIndex()][1]
+        this_month = _month_index(date_type.today())
+        first_month = this_month - months + 1 if months else None
+        last_month = this_month if months else None
+        pivot = self.cube.pivot(first_month, last_month, "total" if self.sort_combo.currentIndex() else "name")
+        self.shown_version = self.cube.version
+        
+        names, labels, values = pivot['names'], pivot['months'], pivot['values']
+        self.table.clear()
+        self.table.setRowCount(len(names) + 1)
+        self.table.setColumnCount(len(labels) + 1)
+        self.table.setHorizontalHeaderLabels(labels + ["Total"])
+        self.table.setVerticalHeaderLabels(names + ["Total"])
+        bold = QFont()
+        bold.setBold(True)
+        for row in range(len(names)):
+            for column in range(len(labels)):
+                if values[row, column]:
+                    self.table.setItem(row, column, QTableWidgetItem(str(_from_cents(values[row, column]))))
+            item = QTableWidgetItem(str(_from_cents(pivot['row_totals'][row])))
+            item.setFont(bold)
+            self.table.setItem(row, len(labels), item)
+        for column, total in enumerate([_from_cents(cents) for cents in pivot['column_totals']] + [pivot['total']]):
+            item = QTableWidgetItem(str(total))
+            item.setFont(bold)
+            self.table.setItem(len(names), column, item)
+
+class PayeeWindow(QWidget):
+    """Spending per payee over a date range, with the selected payee's monthly trend."""
+    RANGES = [("This year", "year"), ("Last 12 months", 12), ("Last 3 years", 36), ("All time", None)]
+
+    def __init__(self, user_id):
+        super().__init__()
+        self.user_id = user_id
+        self.rows = []
+        self.setWindowTitle("Spending by Payee")
+        self.setGeometry(100, 100, 800, 650)
+        self.setStyleSheet("background-color: black; color: white;")
+        self.init_ui()
+
+    def init_ui(self):
+        layout = QVBoxLayout()
+        
+        controls = QHBoxLayout()
+        controls.addWidget(QLabel("Range:"))
+        self.range_combo = QComboBox()
+        self.range_combo.addItems([label for label, _ in self.RANGES])
+        self.range_combo.setStyleSheet("background-color: #333333; color: white;")
+        self.range_combo.currentIndexChanged.connect(self.refresh)
+        controls.addWidget(self.range_combo)
+        controls.addStretch()
+        layout.addLayout(controls)
+        
+        self.table = QTableWidget()
+        self.table.setColumnCount(4)
+        self.table.setHorizontalHeaderLabels(["Payee", "Total", "Expenses", "Average"])
+        self.table.setStyleSheet("background-color: black; color: white; border: 1px solid white;")
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        self.table.itemSelectionChanged.connect(self.show_trend)
+        layout.addWidget(self.table)
+        
+        self.figure = Figure(figsize=(8, 3), facecolor='black')
+        self.canvas = FigureCanvas(self.figure)
+        layout.addWidget(self.canvas)
+        
+        close_btn = QPushButton("Close")
+        close_btn.setStyleSheet("background-color: #333333; color: white;")
+        close_btn.clicked.connect(self.close)
+        layout.addWidget(close_btn)
+        self.setLayout(layout)
+        self.refresh()
+
+    def start_date(self):
+        """First day of the selected range (None for all time)."""
+        months = self.RANGES[self.range_combo.currentIndex()][1]
+        today = date_type.today()
+        if months == "year":
+            return today.replace(month=1, day=1)
+        if months is None:
+            return None
+        return _month_start(today.year, today.month, -(months - 1))
+
+    def refresh(self):
+        self.rows = get_payee_totals(self.user_id, self.start_date())
+        self.table.setRowCount(len(self.rows))
+        for row, (_, name, total, count) in enumerate(self.rows):
+            self.table.setItem(row, 0, QTableWidgetItem(name))
+            for column, text in ((1, f"{total:.2f}"), (2, str(count)), (3, f"{total / count:.2f}")):
+                item = QTableWidgetItem(text)
+                item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+                self.table.setItem(row, column, item)
+        if self.rows:
+            self.table.selectRow(0)
+        else:
+            self.show_trend()
+
+    def show_trend(self):
+        """Plot the selected payee's spending per month over the range."""
+        self.figure.clear()
+        selected = self.table.selectionModel().selectedRows()
+        if selected:
+            payee_id, name = self.rows[selected[0].row()][:2]
+            start = self.start_date()
+            totals = dict(get_payee_month_totals(self.user_id, payee_id, start))
+            if totals:
+                first = _month_index(start) if start else min(totals)
+                months = list(range(first, _month_index(date_type.today()) + 1))
+                ax = self.figure.add_subplot(111, facecolor='black')
+                ax.bar(range(len(months)), [float(totals.get(month, 0)) for month in months], color='#66AAFF')
+                step = max(1, len(months) // 12)
+                ax.set_xticks(range(0, len(months), step))
+                ax.set_xticklabels([_month_label(month) for month in months[::step]], rotation=45, ha='right')
+                ax.set_title(f"{name} per month", color='white')
+                ax.tick_params(colors='white')
+                for spine in ax.spines.values():
+                    spine.set_color('white')
+                self.figure.tight_layout()
+        self.canvas.draw()
+
 # Add the CategoryLimitsWindow class for managing spending limits
+class LimitDialog(QDialog):
+    """Dialog for a category's limit amount, budget period and carry-over."""
+    PERIOD_LABELS = {
+        "weekly": "Weekly", "monthly": "Monthly", "quarterly": "Quarterly",
+        "yearly": "Yearly", "rolling": "Rolling window"
+    }
+    
+    def __init__(self, category_name, budget=None, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Set Spending Limit")
+        self.setStyleSheet("background-color: black; color: white;")
+        budget = budget or Category(None, category_name)
+        
+        layout = QFormLayout(self)
+        layout.addRow(QLabel(f"Spending limit for {category_name}:"))
+        
+        self.amount_edit = QDoubleSpinBox()
+        self.amount_edit.setRange(0, 1000000)
+        self.amount_edit.setDecimals(2)
+        self.amount_edit.setPrefix("Rs")
+        self.amount_edit.setValue(float(budget.limit or 0))
+        self.amount_edit.setStyleSheet("background-color: #333333; color: white;")
+        layout.addRow("Amount:", self.amount_edit)
+        
+        self.period_combo = QComboBox()
+        for period in BUDGET_PERIODS:
+            self.period_combo.addItem(self.PERIOD_LABELS[period], period)
+        self.period_combo.setCurrentIndex(BUDGET_PERIODS.index(budget.period or 'monthly'))
+        self.period_combo.setStyleSheet("background-color: #333333; color: white;")
+        layout.addRow("Period:", self.period_combo)
+        
+        self.days_edit = QSpinBox()
+        self.days_edit.setRange(1, 3650)
+        self.days_edit.setSuffix(" days")
+        self.days_edit.setValue(budget.rolling_days or 30)
+        self.days_edit.setStyleSheet("background-color: #333333; color: white;")
+        layout.addRow("Window:", self.days_edit)
+        
+        self.carry_check = QCheckBox("Carry unspent budget into the next period")
+        self.carry_check.setChecked(bool(budget.carry_over))
+        layout.addRow(self.carry_check)
+        
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
+        buttons.setStyleSheet("background-color: #333333; color: white;")
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+        
+        self.period_combo.currentIndexChanged.connect(self.update_enabled)
+        self.update_enabled()
+    
+    def update_enabled(self):
+        # Rolling windows have a length but nothing to carry over
+        rolling = self.period_combo.currentData() == "rolling"
+        self.days_edit.setEnabled(rolling)
+        self.carry_check.setEnabled(not rolling)
+    
+    def values(self):
+        """Return (limit_amount, period, rolling_days, carry_over) for set_category_limit."""
+        period = self.period_combo.currentData()
+        rolling = period == "rolling"
+        return (
+            Money.of(self.amount_edit.value()),
+            period,
+            self.days_edit.value() if rolling else None,
+            self.carry_check.isChecked() and not rolling
+        )
+
 class CategoryLimitsWindow(QWidget):
     """Window for viewing and setting category spending limits."""
-    def __init__(self):
+    def __init__(self, user_id):
         print("--- CategoryLimitsWindow constructor start ---")
         super().__init__()
+        self.user_id = user_id
         self.setWindowTitle("Category Spending Limits")
-        self.setGeometry(100, 100, 700, 500)
+        self.setGeometry(100, 100, 950, 500)
         self.setStyleSheet("background-color: black; color: white;")
         try:
             self.init_ui()
@@ -1548,14 +8875,15 @@ class CategoryLimitsWindow(QWidget):
         layout = QVBoxLayout()
         
         # Add header label
-        header = QLabel("Monthly Spending Limits by Category")
+        header = QLabel("Spending Limits by Category")
         header.setStyleSheet("font-size: 16pt; font-weight: bold; margin-bottom: 10px;")
         header.setAlignment(Qt.AlignmentFlag.AlignCenter)
         layout.addWidget(header)
         
         # Add instructions
         instructions = QLabel(
-            "Set monthly spending limits for each category. "
+            "Set weekly, monthly, quarterly, yearly or rolling spending limits for each category, "
+            "optionally carrying unspent budget over to the next period. "
             "You'll receive alerts when your spending approaches or exceeds these limits."
         )
         instructions.setStyleSheet("color: #CCCCCC; margin-bottom: 15px;")
@@ -1573,8 +8901,10 @@ class CategoryLimitsWindow(QWidget):
         # Create the table
         print("--- Creating table widget ---")
         self.table = QTableWidget()
-        self.table.setColumnCount(5)
-        self.table.setHorizontalHeaderLabels(["Category", "Current Limit", "Monthly Spending", "Status", "Actions"])
+        self.table.setColumnCount(7)
+        self.table.setHorizontalHeaderLabels(
+            ["Category", "Current Limit", "Period", "Spent This Period", "Forecast", "Status", "Actions"]
+        )
         self.table.setStyleSheet("background-color: black; color: white; border: 1px solid white;")
         layout.addWidget(self.table)
         
@@ -1630,8 +8960,8 @@ class CategoryLimitsWindow(QWidget):
         for row in range(row_count):
             try:
                 # Get category ID from the first column (assumed to be hidden or stored as user data)
-                category_name = self.table.item(row, 0).text()
-                category_id = get_category_id(category_name)
+                category_name = self.table.item(row, 0).text().strip()
+                category_id = get_category_id(self.user_id, category_name)
                 
                 if not category_id:
                     print(f"Could not find ID for category: {category_name}")
@@ -1646,13 +8976,13 @@ class CategoryLimitsWindow(QWidget):
                 
                 # Convert text to a number, handling "Not set" case
                 if limit_text == "Not set":
-                    limit_amount = 0
+                    limit_amount = Money()
                 else:
-                    # Remove Rs and convert to float
-                    limit_amount = float(limit_text.replace('Rs', '').strip())
+                    # Remove Rs and parse the amount
+                    limit_amount = Money.of(limit_text.replace('Rs', ''))
                 
                 # Save the limit to the database
-                success, message = set_category_limit(category_id, limit_amount)
+                success, message = set_category_limit(self.user_id, category_id, limit_amount)
                 
                 if success:
                     success_count += 1
@@ -1686,7 +9016,7 @@ class CategoryLimitsWindow(QWidget):
         """Add a new category."""
         name, ok = QInputDialog.getText(self, "Add Category", "Enter category name:")
         if ok and name.strip():
-            success, message = add_category(name.strip())
+            success, message = add_category(self.user_id, name.strip())
             if success:
                 QMessageBox.information(self, "Success", message)
                 self.update_table()
@@ -1697,7 +9027,7 @@ class CategoryLimitsWindow(QWidget):
         """Update the table with category limits and spending info."""
         print("--- update_table method start ---")
         try:
-            categories_data = get_all_category_limits_with_spending()
+            categories_data = forecast_budgets(self.user_id, get_all_category_limits_with_spending(self.user_id))
             print(f"Retrieved {len(categories_data)} categories with limit data")
             
             if not categories_data:
@@ -1711,48 +9041,79 @@ class CategoryLimitsWindow(QWidget):
             
             self.table.setRowCount(len(categories_data))
             
+            # Show subcategories indented under their parent
+            tree = get_category_tree(self.user_id)
+            positions = {category_id: (i, len(path) - 1) for i, (category_id, _, _, path) in enumerate(tree)}
+            parents = {parent_id for _, _, parent_id, _ in tree}
+            categories_data.sort(key=lambda cat: positions.get(cat.id, (len(tree), 0)))
+            
             for i, cat in enumerate(categories_data):
                 # Category name
-                name_item = QTableWidgetItem(cat['name'])
+                depth = positions.get(cat.id, (0, 0))[1]
+                name_item = QTableWidgetItem("    " * depth + cat.name)
                 name_item.setFlags(name_item.flags() & ~Qt.ItemFlag.ItemIsEditable)  # Make name non-editable
+                if cat.id in parents:
+                    name_item.setToolTip("Spending and limit include all subcategories")
                 self.table.setItem(i, 0, name_item)
                 
                 # Current limit - make this editable
-                limit_text = f"Rs{cat['limit']:.2f}" if cat['limit'] else "Not set"
+                limit_text = f"Rs{cat.limit:.2f}" if cat.limit else "Not set"
                 limit_item = QTableWidgetItem(limit_text)
-                if cat['limit'] is None:
+                if cat.limit is None:
                     limit_item.setToolTip("Double-click to set a limit")
                 else:
                     limit_item.setToolTip("Double-click to edit limit")
                 self.table.setItem(i, 1, limit_item)
                 
-                # Monthly spending - not editable
-                spent_item = QTableWidgetItem(f"Rs{cat['spent']:.2f}")
+                # Budget period - edited through the limit dialog
+                period_text = _describe_period(cat.period, cat.rolling_days)
+                if cat.carried:
+                    period_text += f" (+Rs{cat.carried:.2f} carried over)"
+                elif _carries_over(cat):
+                    period_text += " (carry-over)"
+                period_item = QTableWidgetItem(period_text)
+                period_item.setFlags(period_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
+                period_item.setToolTip(f"{cat.period_start:%d %b %Y} - {cat.period_end:%d %b %Y}")
+                self.table.setItem(i, 2, period_item)
+                
+                # Spending in the current period - not editable
+                spent_item = QTableWidgetItem(f"Rs{cat.spent:.2f}")
                 spent_item.setFlags(spent_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
-                self.table.setItem(i, 2, spent_item)
+                self.table.setItem(i, 3, spent_item)
                 
-                # Status - not editable
+                # Projected spending at the end of the period - not editable
+                forecast_item = QTableWidgetItem(f"Rs{cat.forecast:.2f}")
+                forecast_item.setFlags(forecast_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
+                forecast_item.setToolTip("Projected spending by the end of the period, from recent daily "
+                                         "spending adjusted for weekday and day-of-month patterns")
+                if cat.exceed_date:
+                    forecast_item.setText(f"Rs{cat.forecast:.2f} (over by {cat.exceed_date:%d %b})")
+                    forecast_item.setForeground(QColor("orange"))
+                self.table.setItem(i, 4, forecast_item)
+                
+                # Status against the limit plus any carried-over budget - not editable
                 status_item = QTableWidgetItem()
                 status_item.setFlags(status_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
-                if cat['limit'] is None:
+                available = cat.available
+                if available is None:
                     status_text = "No limit set"
                     status_color = "white"
-                elif cat['exceeded']:
-                    over_amount = cat['spent'] - cat['limit']
+                elif cat.exceeded:
+                    over_amount = cat.spent - available
                     status_text = f"EXCEEDED by Rs{over_amount:.2f}"
                     status_color = "red"
-                elif cat['spent'] >= 0.8 * (cat['limit'] or 0):
-                    percentage = (cat['spent'] / cat['limit']) * 100
+                elif cat.spent >= 0.8 * available:
+                    percentage = (cat.spent / available) * 100
                     status_text = f"WARNING: {percentage:.1f}% used"
                     status_color = "orange"
                 else:
-                    percentage = (cat['spent'] / cat['limit']) * 100 if cat['limit'] and cat['limit'] > 0 else 0
+                    percentage = (cat.spent / available) * 100
                     status_text = f"{percentage:.1f}% of limit"
                     status_color = "green"
                     
                 status_item.setText(status_text)
                 status_item.setForeground(QColor(status_color))
-                self.table.setItem(i, 3, status_item)
+                self.table.setItem(i, 5, status_item)
                 
                 # Actions button layout to contain multiple buttons
                 action_widget = QWidget()
@@ -1762,19 +9123,19 @@ class CategoryLimitsWindow(QWidget):
                 # Set limit button
                 set_btn = QPushButton("Set Limit")
                 set_btn.setStyleSheet("background-color: #333333; color: white;")
-                set_btn.clicked.connect(lambda checked, cat_id=cat['id'], cat_name=cat['name']: 
+                set_btn.clicked.connect(lambda checked, cat_id=cat.id, cat_name=cat.name: 
                                     self.set_limit(cat_id, cat_name))
                 action_layout.addWidget(set_btn)
                 
                 # Clear limit button (if limit exists)
-                if cat['limit'] is not None:
+                if cat.limit is not None:
                     clear_btn = QPushButton("Clear")
                     clear_btn.setStyleSheet("background-color: #444444; color: white;")
-                    clear_btn.clicked.connect(lambda checked, cat_id=cat['id'], cat_name=cat['name']: 
+                    clear_btn.clicked.connect(lambda checked, cat_id=cat.id, cat_name=cat.name: 
                                         self.clear_limit(cat_id, cat_name))
                     action_layout.addWidget(clear_btn)
                 
-                self.table.setCellWidget(i, 4, action_widget)
+                self.table.setCellWidget(i, 6, action_widget)
             
             # Connect the cellDoubleClicked signal to handle inline editing
             self.table.cellDoubleClicked.connect(self.handle_cell_double_click)
@@ -1791,13 +9152,13 @@ class CategoryLimitsWindow(QWidget):
     
     def handle_cell_double_click(self, row, column):
         """Handle double-click on table cells for inline editing."""
-        # Only handle limit column (column 1)
-        if column != 1:
+        # Only handle the limit and period columns
+        if column not in (1, 2):
             return
             
         # Get category information
-        category_name = self.table.item(row, 0).text()
-        category_id = get_category_id(category_name)
+        category_name = self.table.item(row, 0).text().strip()
+        category_id = get_category_id(self.user_id, category_name)
         
         if not category_id:
             QMessageBox.critical(self, "Error", f"Could not find ID for category: {category_name}")
@@ -1808,20 +9169,9 @@ class CategoryLimitsWindow(QWidget):
         
     def set_limit(self, category_id, category_name):
         """Open dialog to set a spending limit for the selected category."""
-        current_limit = get_category_limit(category_id) or 0
-        
-        limit, ok = QInputDialog.getDouble(
-            self, 
-            "Set Monthly Limit", 
-            f"Set monthly spending limit for {category_name}:",
-            current_limit,
-            0,
-            1000000,
-            2
-        )
-        
-        if ok:
-            success, message = set_category_limit(category_id, limit)
+        dialog = LimitDialog(category_name, get_budget_status(self.user_id, category_id), self)
+        if dialog.exec() == QDialog.DialogCode.Accepted:
+            success, message = set_category_limit(self.user_id, category_id, *dialog.values())
             if success:
                 QMessageBox.information(self, "Success", message)
                 self.update_table()
@@ -1838,7 +9188,7 @@ class CategoryLimitsWindow(QWidget):
         )
         
         if reply == QMessageBox.StandardButton.Yes:
-            success, message = set_category_limit(category_id, 0)
+            success, message = set_category_limit(self.user_id, category_id, 0)
             if success:
                 QMessageBox.information(self, "Success", f"Removed spending limit for '{category_name}'")
                 self.update_table()
@@ -1850,7 +9200,7 @@ class CategoryLimitsWindow(QWidget):
         limit, ok = QInputDialog.getDouble(
             self, 
             "Set All Limits", 
-            "Set the same monthly spending limit for all categories:",
+            "Set the same spending limit for all categories (each keeps its budget period):",
             0,
             0,
             1000000,
@@ -1858,17 +9208,17 @@ class CategoryLimitsWindow(QWidget):
         )
         
         if ok:
-            categories_data = get_all_category_limits_with_spending()
+            categories_data = get_all_category_limits_with_spending(self.user_id)
             
             success_count = 0
             error_count = 0
             for cat in categories_data:
-                success, message = set_category_limit(cat['id'], limit)
+                success, message = set_category_limit(self.user_id, cat.id, limit)
                 if success:
                     success_count += 1
                 else:
                     error_count += 1
-                    print(f"Error setting limit for {cat['name']}: {message}")
+                    print(f"Error setting limit for {cat.name}: {message}")
             
             if error_count == 0:
                 QMessageBox.information(
@@ -1927,15 +9277,32 @@ if __name__ == "__main__":
     # Setup the database
     setup_database()
     
+    # Replay writes queued while the database was unreachable, then keep retrying
+    SYNC_WORKER.start()
+    CATEGORY_PURGE_WORKER.start()
+    
     # Update dialog message
     progress_message.setText("Database setup complete!")
     app.processEvents()
     
-    # Create and show the main application window
-    window = MainWindow()
-    window.show()
-    
     # Close the loading dialog
     loading_dialog.close()
     
+    # Pick the user; ask only when there is more than one to choose from
+    users = get_users()
+    if len(users) == 1:
+        user_id, username = users[0]
+    else:
+        user_dialog = UserSelectionDialog()
+        if not user_dialog.exec() or not user_dialog.user_id:
+            sys.exit(0)
+        user_id, username = user_dialog.user_id, user_dialog.username
+    
+    # Create and show the main application window
+    window = MainWindow(user_id, username)
+    window.show()
+    app.aboutToQuit.connect(SYNC_WORKER.stop)
+    app.aboutToQuit.connect(CATEGORY_PURGE_WORKER.stop)
+    app.aboutToQuit.connect(save_spending_indexes)
+    
     sys.exit(app.exec())
\ No newline at end of file